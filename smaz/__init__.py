@@ -113,6 +113,12 @@ pathological case detection and backtracking in the compress routine.
 Backtracking buys modest improvements to larger strings (1%) and deals with pathological sub-strings, again - you are
 better off using zlib for strings longer than 100 bytes in most cases.
 
+Threads: compress and decompress keep no state between calls, and the tables they read are only ever replaced whole,
+never modified in place, so they are safe to call from several threads. Trees from make_trie are plain lists though, and
+build their bigram table on first use, so for a table shared between threads prefer compile_dictionary, which freezes
+it with its bigram table built up front. compress_many and decompress_many run batches over a thread pool, which scales
+on free threaded builds (3.13t and later).
+
 BACKGROUND
 ----------
 
@@ -201,62 +207,99 @@ __version__ = "1.0.1"
 __maintainer__ = "Max Smith"
 __email__ = None  # Sorry, I get far too much spam as it is. Track me down at http://www.notonbluray.com
 
+import sys
+import time
+
 try:
     # noinspection PyShadowingBuiltins
     xrange = range  # Fix for python 3 compatibility.
 except NameError:
     pass
 
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.time  # Python 2
+
 BACKTRACK_LIMIT = 254  # No point backtracking more than 255 characters
+_PROFILER = None  # The enabled smaz.profiling Profile, compress and decompress hand over to it when set
+ADAPTIVE_RUN = 3  # With compress(adaptive=True), verbatim runs this long or longer don't stop for one character codes
+
+
+class _Trie(list):
+    """ The root of a trie from make_trie, which carries its bigram table once built """
+    __slots__ = ('bigrams',)
 
+    def __reduce__(self):
+        return _Trie, (list(self),)  # The bigram table is rebuilt on first use, rather than pickled
 
-def make_trie(decode_table):
+
+class _FrozenTrie(tuple):
+    """ The root of a trie from freeze_trie, which carries its bigram table once built """
+
+    def __reduce__(self):
+        return freeze_trie, (tuple(self),)
+
+
+def make_trie(decode_table, utf8_table=None):
     """ Create a trie representing the encoding strategy implied by the passed table.
         For each string in the table, assign it an encoded value, walk through the string
         creating a node for each character at a position (if none already exists), and when
         we reach the end of the string populate that node with the assigned encoded value.
 
+        Nodes are [encoded byte or None, 256 entry list of child nodes or None]. The child list is only allocated
+        when a node gets a child, so there's no pruning pass over empty nodes afterwards.
+
+        Entries from utf8_table are added as their UTF-8 bytes, encoded as 254 followed by 128 + their index. For
+        compress(utf8=True) only, see UTF8_DECODE.
+
     :param decode_table: list
+    :param utf8_table: list
     """
-    empty_node = list(None for _ in xrange(0, 256))
-    root_node = list(empty_node)
     if not decode_table:
         raise ValueError('Empty data passed to make_tree')
     elif len(decode_table) > 254:
         raise ValueError('Too long list in make tree: %d' % len(decode_table))
-    else:
-        for enc_byte, sstr in enumerate(decode_table):
-            node_ptr = root_node
-            for str_pos, ch in enumerate(sstr):
-                if node_ptr[ord(ch)]:  # If a child node exists for character
-                    terminal_byte, children = node_ptr[ord(ch)]
-                    if len(sstr) == str_pos + 1:  # At the end ?
-                        if not terminal_byte:
-                            node_ptr[ord(ch)] = [chr(enc_byte), children]
-                            break
-                        else:
-                            raise ValueError('Unexpected terminal: duplicates in data (%s) (%s) (%s)' %
-                                             (sstr, ch, node_ptr))
-                    node_ptr = children
-                else:  # Create the child node
-                    if len(sstr) == str_pos + 1:  # At the end ?
-                        node_ptr[ord(ch)] = [chr(enc_byte), list(empty_node)]
-                    else:
-                        node_ptr[ord(ch)] = [None, list(empty_node)]
-                        _, node_ptr = node_ptr[ord(ch)]
-    # Now we've built the trie, we can optimize it a bit by replacing empty terminal nodes early with None
-    stack = list(root_node)
-    while stack:
-        node_ptr = stack.pop()
-        if node_ptr:
-            _, children = node_ptr
-            if children == empty_node:
-                node_ptr[1] = None  # Replace empty entries with None
+    entries = [(chr(enc_byte), sstr) for enc_byte, sstr in enumerate(decode_table)]
+    if utf8_table:
+        if len(utf8_table) > 128:
+            raise ValueError('Too long UTF-8 list in make tree: %d' % len(utf8_table))
+        entries.extend((chr(254) + chr(128 + index), _bytes_to_str(_text_to_bytes(text)))
+                       for index, text in enumerate(utf8_table))
+    root_node = _Trie([None] * 256)
+    for enc_byte, sstr in entries:
+        node_ptr = root_node
+        last_pos = len(sstr) - 1
+        for str_pos, ch in enumerate(sstr):
+            child = node_ptr[ord(ch)]
+            if child is None:  # Create the child node
+                child = node_ptr[ord(ch)] = [None, None]
+            if str_pos == last_pos:  # At the end ?
+                if child[0] is not None:
+                    raise ValueError('Unexpected terminal: duplicates in data (%s) (%s) (%s)' % (sstr, ch, node_ptr))
+                child[0] = enc_byte
             else:
-                stack.extend(children)
+                if child[1] is None:
+                    child[1] = [None] * 256
+                node_ptr = child[1]
     return root_node
 
 
+def _tree_decode_table(compression_tree):
+    """ Recover the decode table from a trie from make_trie, leaving out any UTF-8 entries """
+    decode_table = [''] * 254
+    nodes = [(compression_tree, '')]
+    while nodes:
+        node, prefix = nodes.pop()
+        for ch, child in enumerate(node):
+            if child is not None:
+                if child[0] is not None and len(child[0]) == 1:
+                    decode_table[ord(child[0])] = prefix + chr(ch)
+                if child[1] is not None:
+                    nodes.append((child[1], prefix + chr(ch)))
+    return decode_table
+
+
 def make_tree(decode_table):
     """ Create a tree representing the encoding strategy implied by the passed table.
         For each string in the table, assign it an encoded value, walk through the string
@@ -315,8 +358,177 @@ DECODE = [" ", "the", "e", "t", "a", "of", "o", "and", "i", "n", "s", "e ", "r",
           " we", "ly", "ee", " n", "id", " cl", "ac", "il", "</", "rt", " wi", "div",
           "e, ", " it", "whi", " ma", "ge", "x", "e c", "men", ".com"]
 
-# Can be regenerated with the below line
-SMAZ_TREE = make_trie(DECODE)
+# Secondary table for compress(utf8=True), common non-ASCII characters that would otherwise need a verbatim run. Up to
+# 128 entries, encoded as 254 followed by 128 + index - a lone verbatim byte above 127 is never valid UTF-8 by itself.
+UTF8_DECODE = [u"\u00e9", u"\u2019", u"\u201c", u"\u201d", u"\u2013", u"\u2014", u"\u2026", u"\u00e8", u"\u00e0",
+               u"\u00fc", u"\u00f6", u"\u00e4", u"\u00e1", u"\u00ed", u"\u00f3", u"\u00fa", u"\u00f1", u"\u00e7",
+               u"\u00ea", u"\u00e2", u"\u00f4", u"\u00ee", u"\u00fb", u"\u00eb", u"\u00ef", u"\u00e3", u"\u00f5",
+               u"\u00e5", u"\u00f8", u"\u00e6", u"\u0153", u"\u00df", u"\u00ec", u"\u00f2", u"\u00f9", u"\u00c9",
+               u"\u00c0", u"\u00c7", u"\u00d6", u"\u00dc", u"\u00c4", u"\u00d1", u"\u00c5", u"\u00d8", u"\u00c1",
+               u"\u2018", u"\u00ab", u"\u00bb", u"\u2022", u"\u00b7", u"\u00a0", u"\u20ac", u"\u00a3", u"\u00a9",
+               u"\u00ae", u"\u2122", u"\u00b0", u"\u00d7", u"\u00bd", u"\u00bf", u"\u00a1", u"\u0107", u"\u010d",
+               u"\u0161", u"\u017e", u"\u0142", u"\u0105", u"\u0119", u"\u015b", u"\u0131", u"\u011f", u"\u015f"]
+
+# The default trie is built on first use rather than at import, keeping 'import smaz' cheap for short lived
+# processes. The trie can be regenerated with make_trie(DECODE)
+_SMAZ_TREE = None
+
+
+def _smaz_tree():
+    """ The trie for DECODE, built on first use """
+    global _SMAZ_TREE
+    if _SMAZ_TREE is None:
+        _SMAZ_TREE = make_trie(DECODE)
+    return _SMAZ_TREE
+
+
+_UTF8_ENTRIES = {}  # Cache of secondary tables as UTF-8 encoded strs, keyed by the secondary table
+_UTF8_TREES = {}  # Cache of DECODE tries with a secondary table, keyed by the secondary table
+
+
+def _utf8_tree(utf8_table):
+    """ The trie for DECODE plus utf8_table, built on first use """
+    utf8_table = tuple(utf8_table)
+    tree = _UTF8_TREES.get(utf8_table)
+    if tree is None:
+        tree = _UTF8_TREES[utf8_table] = make_trie(DECODE, utf8_table)
+    return tree
+
+
+def _utf8_entries(utf8_table):
+    """ utf8_table as strs of UTF-8 bytes, as decompress outputs them before decoding the whole """
+    utf8_table = tuple(utf8_table)
+    entries = _UTF8_ENTRIES.get(utf8_table)
+    if entries is None:
+        entries = _UTF8_ENTRIES[utf8_table] = [_bytes_to_str(_text_to_bytes(text)) for text in utf8_table]
+    return entries
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        """ SMAZ_TREE is built lazily, on first access (PEP 562) """
+        if name == 'SMAZ_TREE':
+            return _smaz_tree()
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    SMAZ_TREE = _smaz_tree()
+
+
+def make_bigram_table(compression_tree):
+    """ Create a 128 x 128 jump table for the first two characters of a match, so compress can skip the first two steps
+        of the trie walk. Entry (ord(a) << 7 | ord(b)) is a tuple of (encoded byte or None, length of that match,
+        trie node to carry on walking from or None, number of characters consumed), for ASCII a and b.
+
+    :param compression_tree: A trie from make_trie
+    :type compression_tree: list
+
+    :rtype: list
+    """
+    no_match = (None, 0, None, 1)
+    table = []
+    for a in xrange(128):
+        node = compression_tree[a]
+        if node is None:
+            table.extend([no_match] * 128)
+            continue
+        byte_val, children = node
+        enc_len = 0 if byte_val is None else 1
+        stop = (byte_val, enc_len, None, 1)
+        for b in xrange(128):
+            child = children and children[b]
+            if child is None:
+                table.append(stop)
+            elif child[0] is None:
+                table.append((byte_val, enc_len, child[1], 2))
+            else:
+                table.append((child[0], 2, child[1], 2))
+    return table
+
+
+_BIGRAM_TABLES = {}  # Bigram tables for trees that can't carry one, id -> (tree, table)
+_BIGRAM_CACHE_SIZE = 16
+
+
+def _bigram_table(compression_tree):
+    """ The bigram table for compression_tree. Tries from make_trie and freeze_trie keep theirs, so it is built once
+        and goes when the trie does. Other trees (plain lists and tuples) are cached by id, and hold on to the tree so
+        the id isn't reused. They mustn't be changed once used.
+    """
+    bigrams = getattr(compression_tree, 'bigrams', None)
+    if bigrams is None:
+        cached = _BIGRAM_TABLES.get(id(compression_tree))
+        if cached is not None and cached[0] is compression_tree:
+            return cached[1]
+        bigrams = make_bigram_table(compression_tree)
+        try:
+            compression_tree.bigrams = bigrams
+        except AttributeError:  # A plain list or tuple
+            if len(_BIGRAM_TABLES) >= _BIGRAM_CACHE_SIZE:
+                _BIGRAM_TABLES.clear()
+            _BIGRAM_TABLES[id(compression_tree)] = (compression_tree, bigrams)
+    return bigrams
+
+
+_MATCHERS = {}  # Cache of compile_matcher output, keyed by the decode table
+
+
+def _matcher_pattern(decode_table):
+    """ Generate a regular expression shaped like the trie for decode_table: each node is a group of alternatives, one
+        per child character, and is optional if the node is itself an entry. Greedy matching then goes as deep as the
+        input allows and backs off to the deepest entry, which is exactly the longest match the trie walk finds.
+    """
+    import re
+    root = {}
+    for sstr in decode_table:
+        if sstr:
+            node = root
+            for ch in sstr:
+                node = node.setdefault(ch, {})
+            node[None] = True  # Terminal marker
+
+    def node_pattern(node):
+        children = ['%s%s' % (re.escape(ch), node_pattern(child)) for ch, child in sorted(
+            (ch, child) for ch, child in node.items() if ch is not None)]
+        if not children:
+            return ''
+        return '(?:%s)%s' % ('|'.join(children), '?' if None in node else '')
+    return node_pattern(root)
+
+
+class Matcher(object):
+    """ A longest-match tokenizer specialized to one decode table, see compile_matcher """
+    __slots__ = ('pattern', 'tokenize', 'codes')
+
+    def __init__(self, decode_table):
+        import re
+        self.pattern = _matcher_pattern(decode_table)
+        # Tokens are either a table entry, or (if nothing matches) a single unmatched character
+        self.tokenize = re.compile(self.pattern + '|.', re.DOTALL).findall
+        self.codes = dict((sstr, chr(enc_byte)) for enc_byte, sstr in enumerate(decode_table) if sstr)
+
+
+def compile_matcher(decode_table=None):
+    """ Generate, compile and cache a matcher specialized to decode_table, for use with the matcher argument of compress
+        and compress_classic. The table is turned into a trie shaped regular expression, so the longest match at each
+        position is found in one C level pass over the input instead of a Python trie walk per character. It finds
+        the same matches as make_trie, so output is identical.
+
+        It only pays off for compress_classic on whole texts, around 15-20% faster. compress's trie walk starts from
+        its bigram table, which is as fast as the regular expression, and slower on short strings. With compress a
+        matcher saves building the trie (see smaz.shared), not time.
+
+        :type decode_table: list
+        :param decode_table Decode table to match against, by default uses SMAZ
+
+        :rtype: Matcher
+    """
+    decode_table = tuple(decode_table or DECODE)
+    matcher = _MATCHERS.get(decode_table)
+    if matcher is None:
+        if len(decode_table) > 254:
+            raise ValueError('Too long list in compile_matcher: %d' % len(decode_table))
+        matcher = _MATCHERS[decode_table] = Matcher(decode_table)
+    return matcher
 
 
 def _check_ascii(sstr):
@@ -324,8 +536,9 @@ def _check_ascii(sstr):
     return all(ord(ch) < 128 for ch in sstr)
 
 
-def _encapsulate(input_str):
-    """ There are some pathological cases, where it may be better to just encapsulate the string in 255 code chunks
+def _encapsulate(input_str, utf8=False):
+    """ There are some pathological cases, where it may be better to just encapsulate the string in 255 code chunks.
+        With utf8 set, a single byte above 127 is put in a run, as 254 followed by it is a UTF8_DECODE entry.
     """
     if not input_str:
         return input_str
@@ -334,7 +547,7 @@ def _encapsulate(input_str):
         output_append = output.append
         output_extend = output.extend
         for chunk in (input_str[i:i+255] for i in xrange(0, len(input_str), 255)):
-            if 1 == len(chunk):
+            if 1 == len(chunk) and not (utf8 and chunk > '\x7f'):
                 output_append(chr(254) + chunk)
             else:
                 output_append(chr(255) + chr(len(chunk) - 1))
@@ -342,8 +555,9 @@ def _encapsulate(input_str):
         return "".join(output)
 
 
-def _encapsulate_list(input_list):
-    """ There are some pathological cases, where it may be better to just encapsulate the string in 255 code chunks
+def _encapsulate_list(input_list, utf8=False):
+    """ There are some pathological cases, where it may be better to just encapsulate the string in 255 code chunks.
+        See _encapsulate for utf8.
     """
     if not input_list:
         return input_list
@@ -352,7 +566,7 @@ def _encapsulate_list(input_list):
         output_append = output.append
         output_extend = output.extend
         for chunk in (input_list[i:i+255] for i in xrange(0, len(input_list), 255)):
-            if 1 == len(chunk):
+            if 1 == len(chunk) and not (utf8 and chunk[0] > '\x7f'):
                 output_append(chr(254))
                 output_extend(chunk)
             else:
@@ -379,7 +593,8 @@ def compress_no_backtracking(input_str):
 
 
 def compress(input_str, check_ascii=True, raise_on_error=True, compression_tree=None, backtracking=True,
-             pathological_case_detection=True, backtrack_limit=BACKTRACK_LIMIT):
+             pathological_case_detection=True, backtrack_limit=BACKTRACK_LIMIT, matcher=None, case_folding=False,
+             utf8=False, utf8_table=None, adaptive=False):
     """ Compress the passed string using the SMAZ algorithm. Returns the encoded string. Performance is a O(N), but the
         constant will vary depending on the relationship between the compression tree and input_str, in particular the
         average depth explored/average characters per encoded symbol.
@@ -397,6 +612,21 @@ def compress(input_str, check_ascii=True, raise_on_error=True, compression_tree=
     :param backtrack_limit: How many characters to look backwards for backtracking, defaults to 255 - setting it higher
                             may achieve slightly higher compression ratios (0.1% on big strings) at the expense of much
                             worse performance, particularly on random data. You probably want this left as default
+    :param matcher: A Matcher from compile_matcher, used instead of walking compression_tree. No faster, see
+                    compile_matcher
+    :param case_folding: Use the case folding variant of the format, which matches capitalized and uppercase words
+                         through a modifier code (see CASE_FOLD_CODE). Decode with decompress(case_folding=True).
+                         Backtracking and matcher don't apply in this mode.
+    :param utf8: Compress any text, as UTF-8. Non-ASCII characters from utf8_table get two byte codes, the rest go in
+                 verbatim runs. Decode with decompress(utf8=True). If you pass compression_tree, build it with
+                 make_trie(table, utf8_table)
+    :param utf8_table: The secondary table of non-ASCII characters for utf8, by default UTF8_DECODE
+    :param adaptive: Let the input decide how hard to work. Once a verbatim run reaches ADAPTIVE_RUN characters the
+                     stretch is treated as noise, and one character codes are passed over instead of switching out of
+                     the run for them, so noisy and random text skips most of the backtracking merges. Clean text is
+                     compressed as with backtracking. Output is at most 0.15% larger than the default on the test
+                     corpora (fields.c, the others are within 0.03%), at about the throughput of backtracking=False
+                     (up to twice as fast as the default on random data).
 
     :type input_str: str
     :type check_ascii: bool
@@ -404,110 +634,438 @@ def compress(input_str, check_ascii=True, raise_on_error=True, compression_tree=
     :type compression_tree: dict
     :type backtracking: bool
     :type pathological_case_detection: bool
+    :type matcher: Matcher
+    :type case_folding: bool
+    :type utf8: bool
+    :type utf8_table: list
+    :type adaptive: bool
 
     :rtype: str
     :return: The compressed input_str
     """
+    if _PROFILER is not None:
+        return _PROFILER.compress(input_str, check_ascii, raise_on_error, compression_tree, backtracking,
+                                  pathological_case_detection, backtrack_limit, matcher, case_folding, utf8, utf8_table,
+                                  adaptive)
+    return _compress(input_str, check_ascii, raise_on_error, compression_tree, backtracking,
+                     pathological_case_detection, backtrack_limit, matcher, case_folding, utf8, utf8_table, adaptive)
+
+
+def _lap(times, counts, phase, lap, count=1):
+    """ Add the time since lap to phase, for smaz.profiling. Returns the new lap. """
+    now = _timer()
+    times[phase] += now - lap
+    counts[phase] += count
+    return now
+
+
+def _compress(input_str, check_ascii, raise_on_error, compression_tree, backtracking, pathological_case_detection,
+              backtrack_limit, matcher, case_folding, utf8, utf8_table, adaptive, times=None, counts=None):
+    """ compress, see there. smaz.profiling passes times and counts (phase -> seconds, phase -> count, see
+        profiling.COMPRESS_PHASES) to add up where the time goes.
+    """
     if not input_str:
         return input_str
     else:
-        if check_ascii and not _check_ascii(input_str):
-            if raise_on_error:
-                raise ValueError('SMAZ can only process ASCII text.')
-            else:
-                return None
+        timing = times is not None
+        if timing:
+            lap = _timer()
+        if utf8:
+            if case_folding:
+                raise ValueError('case_folding and utf8 can not be combined')
+            input_str = _bytes_to_str(_text_to_bytes(input_str))
+            # Secondary table codes are two bytes, backtracking counts them as one, which is close enough
+            compression_tree = compression_tree or _utf8_tree(UTF8_DECODE if utf8_table is None else utf8_table)
+            check_ascii = False
+            if timing:
+                lap = _lap(times, counts, 'utf8_encode', lap)
+        if check_ascii:
+            ascii_ok = _check_ascii(input_str)
+            if timing:
+                lap = _lap(times, counts, 'check_ascii', lap)
+            if not ascii_ok:
+                if raise_on_error:
+                    raise ValueError('SMAZ can only process ASCII text.')
+                else:
+                    return None
+        if case_folding:
+            output = _compress_case_folded(input_str, compression_tree, pathological_case_detection)
+            if timing:
+                _lap(times, counts, 'case_folding', lap)
+            return output
+
+        if matcher is None:
+            compression_tree = compression_tree or _SMAZ_TREE or _smaz_tree()
+        state = _EncoderState()
+        _encode(input_str, state, compression_tree, backtracking, backtrack_limit, adaptive, matcher, utf8,
+                times=times, counts=counts)
+        if timing:
+            lap = _timer()
+        output = state.flush(utf8)
+        if timing:
+            lap = _lap(times, counts, 'encapsulate', lap)
 
-        # Invariants:
-        terminal_tree_node = (None, None)
-        compression_tree = compression_tree or SMAZ_TREE
-        input_str_len = len(input_str)
+        # This may look a bit clunky, but it is worth 20% in cPython and O(n^2) -> O(n) in PyPy
+        output = "".join(output)
+        if timing:
+            lap = _lap(times, counts, 'join', lap)
+
+        # Pathological case detection - Did we grow more than we would by encapsulating the string ?
+        # There are some cases where backtracking doesn't work correctly, examples:
+        # Y OF
+        if pathological_case_detection:
+            worst = _worst_size(len(input_str))
+            if len(output) > worst:
+                output = _encapsulate(input_str, utf8)
+            if timing:
+                _lap(times, counts, 'worst_size_check', lap)
+        return output
+
+
+class _EncoderState(object):
+    """ Where the compress encoder is up to, so it can stop and carry on later, see _encode. Positions are into the
+        text passed to _encode.
+    """
 
+    def __init__(self):
         # Invariant: All of these arrays assume len(array) = number of bytes in array
-        output = []          # Single bytes. Committed, non-back-track-able output
-        unmatched = []       # Single bytes. Current pool for encapsulating (i.e. 255/254 + unmatched)
-        backtrack_buff = []  # Single bytes. Encoded between last_backtrack_pos and pos (excl enc_buf and unmatched)
-        enc_buf = []         # Single bytes. Encoded output for the current run of compression codes
+        self.pos = 0
+        self.last_backtrack_pos = 0
+        self.output = []          # Single bytes. Committed, non-back-track-able output
+        self.unmatched = []       # Single bytes. Current pool for encapsulating (i.e. 255/254 + unmatched)
+        self.backtrack_buff = []  # Single bytes. Encoded since last_backtrack_pos (excl enc_buf and unmatched)
+        self.enc_buf = []         # Single bytes. Encoded output for the current run of compression codes
+        self.merged = False       # Whether backtracking has merged codes into a verbatim run
+
+    def copy(self):
+        state = _EncoderState()
+        state.pos = self.pos
+        state.last_backtrack_pos = self.last_backtrack_pos
+        state.merged = self.merged
+        state.output = list(self.output)
+        state.unmatched = list(self.unmatched)
+        state.backtrack_buff = list(self.backtrack_buff)
+        state.enc_buf = list(self.enc_buf)
+        return state
+
+    def size(self):
+        """ Exact size of the output so far, with the buffers """
+        return len(self.output) + len(self.backtrack_buff) + len(self.enc_buf) + _run_size(len(self.unmatched))
+
+    def flush(self, utf8=False):
+        """ Finish the output with the buffers, as at the end of the text. Returns the output list. """
+        output = self.output
+        output.extend(self.backtrack_buff)
+        output.extend(_encapsulate_list(self.unmatched, utf8))
+        output.extend(self.enc_buf)
+        self.backtrack_buff = []
+        self.unmatched = []
+        self.enc_buf = []
+        return output
 
-        # Ugly but fast
-        output_extend = output.extend
 
-        last_backtrack_pos = pos = 0
-        while pos < input_str_len:
-            tree_ptr = compression_tree
-            enc_byte = None
-            j = 0
-            while j < input_str_len - pos:  # Search the tree for the longest matching sequence
+def _encode(input_str, state, compression_tree, backtracking=True, backtrack_limit=BACKTRACK_LIMIT, adaptive=False,
+            matcher=None, utf8=False, stop=None, max_bytes=None, times=None, counts=None):
+    """ The compress encoder. Greedy longest matches from compression_tree, with backtracking at mode switches, carried
+        on from state and leaving its buffers in state. This is the one copy of the loop, compress, compress_to_fit,
+        IncrementalCompressed and smaz.profiling all drive it.
+
+        :param stop Stop before this position, rather than the end of input_str. Tree walks still read on to the end.
+        :param max_bytes A budget for the size of the output (see compress_to_fit), the encoder stops before the first
+                         character it can't be kept to. Only from the start of input_str.
+        :param times Phase timings to add to, for smaz.profiling, see _compress
+        :param matcher A Matcher, used instead of compression_tree (which can then be None). Only from the start of
+                       input_str, without stop.
+    """
+    terminal_tree_node = (None, None)
+    input_str_len = len(input_str)
+    if stop is None:
+        stop = input_str_len
+    pos = state.pos
+    last_backtrack_pos = state.last_backtrack_pos
+    output = state.output
+    unmatched = state.unmatched
+    backtrack_buff = state.backtrack_buff
+    enc_buf = state.enc_buf
+
+    # Ugly but fast
+    output_extend = output.extend
+
+    if matcher is not None:
+        tokens = iter(matcher.tokenize(input_str))  # Longest matches, already split out by the matcher
+        code_get = matcher.codes.get
+    else:
+        bigrams = _bigram_table(compression_tree)
+
+    budget = max_bytes is not None
+    if budget:
+        size = state.size()  # Exact size of output + backtrack_buff + enc_buf + unmatched once encapsulated
+    timing = times is not None
+    if timing:
+        walk_time = backtrack_time = encapsulate_time = 0.0
+        walks = backtracks = encapsulates = 0
+        lap = _timer()
+
+    while pos < stop:
+        if matcher is None:
+            if pos + 1 < input_str_len:
+                # Jump straight past the first two characters, and only walk the tree for longer entries
+                first, second = ord(input_str[pos]), ord(input_str[pos + 1])
+                if first < 128 and second < 128:
+                    enc_byte, enc_len, tree_ptr, j = bigrams[first << 7 | second]
+                else:
+                    tree_ptr = compression_tree
+                    enc_byte = None
+                    j = 0
+            else:
+                tree_ptr = compression_tree
+                enc_byte = None
+                j = 0
+            while tree_ptr and j < input_str_len - pos:  # Search the tree for the longest matching sequence
                 byte_val, tree_ptr = tree_ptr[ord(input_str[pos + j])] or terminal_tree_node
                 j += 1
                 if byte_val is not None:
                     enc_byte = byte_val  # Remember this match, and search for a longer one
                     enc_len = j
-                if not tree_ptr:
-                    break  # No more matching characters in the tree
-
-            if enc_byte is None:
-                unmatched.append(input_str[pos])
-                pos += 1  # We didn't match any stems, add the character the unmatched list
-
-                # Backtracking - sometimes it makes sense to go back and not use a length one symbol between two runs of
-                # raw text, since the cost of the context switch is 2 bytes. The following code looks backwards and
-                # tries to judge if the mode switches left us better or worse off. If worse off, re-encode the text as
-                # a raw text run.
-                if len(enc_buf) > 0 or input_str_len == pos:
-                    # Mode switch ! or end of string
-                    merge_len = _worst_size(pos - last_backtrack_pos)
-                    unmerge_len = len(backtrack_buff) + len(enc_buf) + _worst_size(len(unmatched))
-                    if merge_len > unmerge_len + 2 or pos - last_backtrack_pos > backtrack_limit or not backtracking:
-                        # Unmerge: gained at least 3 bytes through encoding, reset the backtrack marker to here
-                        output_extend(backtrack_buff)
-                        output_extend(enc_buf)
-                        backtrack_buff = []
-                        last_backtrack_pos = pos - 1
-                    elif merge_len < unmerge_len:
-                        # Merge: Mode switch doesn't make sense, don't move backtrack marker
-                        backtrack_buff = []
-                        unmatched = list(input_str[last_backtrack_pos:pos])
-                    else:
-                        # Gains are two bytes or less - don't move the backtrack marker till we have a clear gain
-                        backtrack_buff.extend(enc_buf)
-                        if input_str_len == pos:
-                            backtrack_buff.extend(_encapsulate_list(unmatched))
-                            unmatched = []
-                    enc_buf = []
-            else:
-                # noinspection PyUnboundLocalVariable
-                pos += enc_len  # We did match in the tree, advance along, by the number of bytes matched
-                enc_buf.append(enc_byte)
-                if unmatched:  # Entering an encoding run
-                        backtrack_buff.extend(_encapsulate_list(unmatched))
+        else:
+            token = next(tokens)
+            enc_byte = code_get(token)
+            enc_len = len(token)
+
+        # noinspection PyUnboundLocalVariable
+        if adaptive and enc_byte is not None and enc_len == 1 and len(unmatched) >= ADAPTIVE_RUN:
+            enc_byte = None  # Noisy stretch, a one character code costs more in mode switches than it saves
+        if timing:
+            now = _timer()
+            walk_time += now - lap
+            walks += 1
+            lap = now
+
+        if budget and enc_byte is not None and size + 1 > max_bytes and _run_size(pos + enc_len) > max_bytes:
+            # The code doesn't fit, but as a verbatim character it may, if backtracking merges it into the run before
+            enc_byte = None
+
+        if enc_byte is None:
+            saved = None
+            if budget and (size + _run_size(len(unmatched) + 1) - _run_size(len(unmatched)) > max_bytes and
+                           _run_size(pos + 1) > max_bytes):
+                # Going over the budget here may still pay off, as backtracking can merge the codes before into the
+                # run. Backtrack as at the end, and undo if it doesn't
+                saved = (len(output), list(backtrack_buff), list(enc_buf), list(unmatched), last_backtrack_pos, size)
+
+            unmatched.append(input_str[pos])
+            pos += 1  # We didn't match any stems, add the character the unmatched list
+
+            # Backtracking - sometimes it makes sense to go back and not use a length one symbol between two runs of
+            # raw text, since the cost of the context switch is 2 bytes. The following code looks backwards and
+            # tries to judge if the mode switches left us better or worse off. If worse off, re-encode the text as
+            # a raw text run.
+            if len(enc_buf) > 0 or input_str_len == pos or saved is not None:
+                # Mode switch ! or end of string
+                merge_len = _worst_size(pos - last_backtrack_pos)
+                unmerge_len = len(backtrack_buff) + len(enc_buf) + _worst_size(len(unmatched))
+                if merge_len > unmerge_len + 2 or pos - last_backtrack_pos > backtrack_limit or not backtracking:
+                    # Unmerge: gained at least 3 bytes through encoding, reset the backtrack marker to here
+                    output_extend(backtrack_buff)
+                    output_extend(enc_buf)
+                    backtrack_buff = []
+                    last_backtrack_pos = pos - 1
+                elif merge_len < unmerge_len:
+                    # Merge: Mode switch doesn't make sense, don't move backtrack marker
+                    backtrack_buff = []
+                    unmatched = list(input_str[last_backtrack_pos:pos])
+                    state.merged = True
+                else:
+                    # Gains are two bytes or less - don't move the backtrack marker till we have a clear gain
+                    backtrack_buff.extend(enc_buf)
+                    if input_str_len == pos:
+                        if timing:
+                            now = _timer()
+                            backtrack_time += now - lap
+                            lap = now
+                        backtrack_buff.extend(_encapsulate_list(unmatched, utf8))
                         unmatched = []
+                        if timing:
+                            now = _timer()
+                            encapsulate_time += now - lap
+                            encapsulates += 1
+                            lap = now
+                enc_buf = []
+                if timing:
+                    now = _timer()
+                    backtrack_time += now - lap
+                    backtracks += 1
+                    lap = now
+
+            if budget:
+                size = len(output) + len(backtrack_buff) + len(enc_buf) + _run_size(len(unmatched))
+                if saved is not None and size > max_bytes:
+                    # Neither the encoding nor the whole prefix as one verbatim run fits, undo the character and stop
+                    output_len, backtrack_buff, enc_buf, unmatched, last_backtrack_pos, size = saved
+                    del output[output_len:]
+                    pos -= 1
+                    break
+        else:
+            pos += enc_len  # We did match in the tree, advance along, by the number of bytes matched
+            enc_buf.append(enc_byte)
+            if unmatched:  # Entering an encoding run
+                backtrack_buff.extend(_encapsulate_list(unmatched, utf8))
+                unmatched = []
+                if timing:
+                    now = _timer()
+                    encapsulate_time += now - lap
+                    encapsulates += 1
+                    lap = now
+            if budget:
+                size += 1
+
+    state.pos = pos
+    state.last_backtrack_pos = last_backtrack_pos
+    state.unmatched = unmatched
+    state.backtrack_buff = backtrack_buff
+    state.enc_buf = enc_buf
+    if timing:
+        times['trie_walk'] += walk_time
+        counts['trie_walk'] += walks
+        times['backtracking'] += backtrack_time
+        counts['backtracking'] += backtracks
+        times['encapsulate'] += encapsulate_time
+        counts['encapsulate'] += encapsulates
+
+
+def _run_size(run_len):
+    """ Exact size of a verbatim run of run_len bytes once encapsulated, see _encapsulate_list """
+    full, rest = divmod(run_len, 255)
+    return full * 257 + (0 if rest == 0 else 2 if rest == 1 else rest + 2)
+
+
+def compress_to_fit(input_str, max_bytes, check_ascii=True, compression_tree=None, backtracking=True,
+                    backtrack_limit=BACKTRACK_LIMIT):
+    """ Compress as much of input_str as fits in max_bytes, for fixed size slots and columns. A single pass of the
+        compress encoder, which keeps the exact size of its output so far. A character that would take it over the
+        budget is tried as verbatim, backtracking as if the text ended there, and is only given up if that doesn't fit
+        either. So consumed is never less than the longest prefix that compress fits in max_bytes. The cut is always on
+        a code boundary.
+
+        :param input_str The ASCII str to be compressed
+        :param max_bytes The most bytes of output to return
+        :param check_ascii Check the input_str is ASCII before we encode it (default True)
+        :param compression_tree As compress
+        :param backtracking As compress
+        :param backtrack_limit As compress
 
-        output_extend(backtrack_buff)
-        output_extend(_encapsulate_list(unmatched))
-        output_extend(enc_buf)
+        :type input_str: str
+        :type max_bytes: int
+        :type check_ascii: bool
+        :type compression_tree: list
+        :type backtracking: bool
+        :type backtrack_limit: int
 
-        # This may look a bit clunky, but it is worth 20% in cPython and O(n^2) -> O(n) in PyPy
-        output = "".join(output)
+        :rtype: tuple
+        :return: (compressed, consumed) - compressed decompresses to input_str[:consumed]
+    """
+    if max_bytes < 0:
+        raise ValueError('max_bytes can not be negative')
+    if not input_str:
+        return input_str, 0
+    if check_ascii and not _check_ascii(input_str):
+        raise ValueError('SMAZ can only process ASCII text.')
 
-        # Pathological case detection - Did we grow more than we would by encapsulating the string ?
-        # There are some cases where backtracking doesn't work correctly, examples:
-        # Y OF
-        if pathological_case_detection:
-            worst = _worst_size(input_str_len)
-            if len(output) > worst:
-                return _encapsulate(input_str)
-        return output
+    state = _EncoderState()
+    _encode(input_str, state, compression_tree or _SMAZ_TREE or _smaz_tree(), backtracking, backtrack_limit,
+            max_bytes=max_bytes)
+    pos = state.pos
+    if state.size() > _run_size(pos):  # Pathological case, or the encoding went over the budget but a verbatim run fits
+        return _encapsulate(input_str[:pos]), pos
+    return "".join(state.flush()), pos
+
+
+def compress_optimal(input_str, check_ascii=True, raise_on_error=True, compression_tree=None):
+    """ The shortest possible encoding of input_str with the table, rather than the greedy longest match. Dynamic
+        programming over every match and every verbatim run split, O(N) but several times slower than compress. Use it
+        for data that's written once and read many times, or to see how far compress is from the best a table can do.
 
+        :param input_str The ASCII str to be compressed
+        :param check_ascii Check the input_str is ASCII before we encode it (default True)
+        :param raise_on_error Throw a value type exception (default True)
+        :param compression_tree As compress
 
-def compress_classic(input_str, pathological_case_detection=True):
+        :type input_str: str
+        :type check_ascii: bool
+        :type raise_on_error: bool
+        :type compression_tree: list
+
+        :rtype: str
+        :return: The compressed input_str, never longer than compress or compress_classic output
+    """
+    if not input_str:
+        return input_str
+    if check_ascii and not _check_ascii(input_str):
+        if raise_on_error:
+            raise ValueError('SMAZ can only process ASCII text.')
+        else:
+            return None
+    from collections import deque
+
+    terminal_tree_node = (None, None)
+    compression_tree = compression_tree or _SMAZ_TREE or _smaz_tree()
+    input_str_len = len(input_str)
+
+    best = [0] + [3 * input_str_len + 3] * input_str_len  # Fewest bytes that input_str[:i] can be encoded in
+    prev = [0] * (input_str_len + 1)                       # Start of the last code or run in that encoding
+    codes = [None] * (input_str_len + 1)                   # The last code, or None for a verbatim run
+    run_starts = deque()  # Candidate starts for a run ending here, best[k] - k increasing, at most 255 back
+
+    for i in xrange(input_str_len + 1):
+        if i:
+            # A single verbatim byte, or a run of 2 to 255 bytes costing 2 + its length
+            cost = best[i - 1] + 2
+            if cost < best[i]:
+                best[i], prev[i], codes[i] = cost, i - 1, None
+            k = i - 2
+            if k >= 0:
+                while run_starts and best[run_starts[-1]] - run_starts[-1] >= best[k] - k:
+                    run_starts.pop()
+                run_starts.append(k)
+                if run_starts[0] < i - 255:
+                    run_starts.popleft()
+                k = run_starts[0]
+                cost = best[k] + i - k + 2
+                if cost < best[i]:
+                    best[i], prev[i], codes[i] = cost, k, None
+            if i == input_str_len:
+                break
+        # Every match starting here, not just the longest
+        tree_ptr = compression_tree
+        j = i
+        cost = best[i]
+        while tree_ptr and j < input_str_len:
+            byte_val, tree_ptr = tree_ptr[ord(input_str[j])] or terminal_tree_node
+            j += 1
+            if byte_val is not None and cost + len(byte_val) < best[j]:
+                best[j], prev[j], codes[j] = cost + len(byte_val), i, byte_val
+
+    output = []
+    i = input_str_len
+    while i:
+        k = prev[i]
+        output.append(_encapsulate(input_str[k:i]) if codes[i] is None else codes[i])
+        i = k
+    output.reverse()
+    return "".join(output)
+
+
+def compress_classic(input_str, pathological_case_detection=True, matcher=None):
     """ A trie version of the original SMAZ compressor, should give identical output to C version.
         Faster on typical material, but can be tripped up by pathological cases.
         :type input_str: str
         :type pathological_case_detection: bool
+        :type matcher: Matcher
 
         :param input_str The string to be compressed
         :param pathological_case_detection Look for growth beyond the worst case of encapsulation and encapsulate
                default is True, you probably want this enabled.
+        :param matcher A Matcher from compile_matcher, used instead of walking the SMAZ tree
 
         :rtype: str
         :return: The compressed input_str
@@ -527,30 +1085,53 @@ def compress_classic(input_str, pathological_case_detection=True):
         output_extend = output.extend
         output_append = output.append
 
-        pos = 0
-        while pos < input_str_len:
-            tree_ptr = SMAZ_TREE
-            enc_byte = None
-            j = 0
-            while j < input_str_len - pos:  # Search the tree for the longest matching sequence
-                byte_val, tree_ptr = tree_ptr[ord(input_str[pos + j])] or terminal_tree_node
-                j += 1
-                if byte_val is not None:
-                    enc_byte = byte_val  # Remember this match, and search for a longer one
-                    enc_len = j
-                if not tree_ptr:
-                    break  # No more matching characters in the tree
-
-            if enc_byte is None:
-                unmatched.append(input_str[pos])
-                pos += 1  # We didn't match any stems, add the character the unmatched list
-            else:
-                # noinspection PyUnboundLocalVariable
-                pos += enc_len  # We did match in the tree, advance along, by the number of bytes matched
-                if unmatched:  # Entering an encoding run
-                    output_extend(_encapsulate_list(unmatched))
-                    unmatched = []
-                output_append(enc_byte)
+        if matcher is not None:
+            # The matcher has already split the input into longest matches, so we can just walk the tokens
+            code_get = matcher.codes.get
+            for token in matcher.tokenize(input_str):
+                enc_byte = code_get(token)
+                if enc_byte is None:
+                    unmatched.append(token)
+                else:
+                    if unmatched:  # Entering an encoding run
+                        output_extend(_encapsulate_list(unmatched))
+                        unmatched = []
+                    output_append(enc_byte)
+        else:
+            smaz_tree = _SMAZ_TREE or _smaz_tree()
+            bigrams = _bigram_table(smaz_tree)
+            pos = 0
+            while pos < input_str_len:
+                if pos + 1 < input_str_len:
+                    # Jump straight past the first two characters, and only walk the tree for longer entries
+                    first, second = ord(input_str[pos]), ord(input_str[pos + 1])
+                    if first < 128 and second < 128:
+                        enc_byte, enc_len, tree_ptr, j = bigrams[first << 7 | second]
+                    else:
+                        tree_ptr = smaz_tree
+                        enc_byte = None
+                        j = 0
+                else:
+                    tree_ptr = smaz_tree
+                    enc_byte = None
+                    j = 0
+                while tree_ptr and j < input_str_len - pos:  # Search the tree for the longest matching sequence
+                    byte_val, tree_ptr = tree_ptr[ord(input_str[pos + j])] or terminal_tree_node
+                    j += 1
+                    if byte_val is not None:
+                        enc_byte = byte_val  # Remember this match, and search for a longer one
+                        enc_len = j
+
+                if enc_byte is None:
+                    unmatched.append(input_str[pos])
+                    pos += 1  # We didn't match any stems, add the character the unmatched list
+                else:
+                    # noinspection PyUnboundLocalVariable
+                    pos += enc_len  # We did match in the tree, advance along, by the number of bytes matched
+                    if unmatched:  # Entering an encoding run
+                        output_extend(_encapsulate_list(unmatched))
+                        unmatched = []
+                    output_append(enc_byte)
         if unmatched:
             output_extend(_encapsulate_list(unmatched))
 
@@ -560,55 +1141,1297 @@ def compress_classic(input_str, pathological_case_detection=True):
             return "".join(output)
 
 
-def decompress(input_str, raise_on_error=True, check_ascii=False, decompress_table=None):
-    """ Returns decoded text from the input_str using the SMAZ algorithm by default
+# Case folding format variant. The one capitalized entry ("The") gives up its code to act as a modifier:
+#   CASE_FOLD_CODE X        - entry X with its first letter uppercased
+#   CASE_FOLD_CODE x2 N ... - the next N + 1 entries uppercased
+# Everything else is as normal SMAZ. Only ASCII letters change case.
+CASE_FOLD_CODE = 72
+
+if sys.version_info[0] >= 3:
+    _ASCII_LOWER = dict((c, c + 32) for c in xrange(65, 91))
+    _ASCII_UPPER = dict((c + 32, c) for c in xrange(65, 91))
+else:
+    _ASCII_LOWER = "".join(chr(c + 32) if 65 <= c < 91 else chr(c) for c in xrange(256))
+    _ASCII_UPPER = "".join(chr(c - 32) if 97 <= c < 123 else chr(c) for c in xrange(256))
+
+
+def _capitalize(sstr):
+    """ Uppercase the first ASCII letter in sstr """
+    for pos, ch in enumerate(sstr):
+        if 'a' <= ch <= 'z':
+            return sstr[:pos] + ch.upper() + sstr[pos + 1:]
+    return sstr
+
+
+def _case_folded_matches(tree, folded, pos, modifier):
+    """ Every match in tree starting at folded[pos], as a list of (encoded byte, end position), shortest first """
+    matches = []
+    input_str_len = len(folded)
+    node = tree
+    j = pos
+    while node and j < input_str_len:
+        child = node[ord(folded[j])]
+        if child is None:
+            break
+        j += 1
+        if child[0] is not None and child[0] != modifier:
+            matches.append((child[0], j))
+        node = child[1]
+    return matches
+
+
+def _compress_case_folded(input_str, compression_tree=None, pathological_case_detection=True):
+    """ The encoder for compress(case_folding=True). Matches against the lowercased input, and keeps the longest match
+        whose case it can describe: as is, capitalized or, as part of an uppercase run, uppercased.
+    """
+    tree = compression_tree or _SMAZ_TREE or _smaz_tree()
+    modifier = chr(CASE_FOLD_CODE)
+    folded = input_str.translate(_ASCII_LOWER)
+    input_str_len = len(input_str)
+    output = []
+    unmatched = []
+    output_extend = output.extend
+    pos = 0
+    while pos < input_str_len:
+        for byte_val, end in reversed(_case_folded_matches(tree, folded, pos, modifier)):
+            segment = input_str[pos:end]
+            if segment == folded[pos:end]:  # No case to restore
+                enc = [byte_val]
+            elif end - pos > 1 and segment == _capitalize(folded[pos:end]):
+                enc = [modifier, byte_val]
+            elif segment == folded[pos:end].translate(_ASCII_UPPER):
+                # Uppercase: extend into a run of uppercased entries, and use it if it beats a verbatim run
+                run = [byte_val]
+                run_end = end
+                while len(run) < 256 and run_end < input_str_len:
+                    for run_byte, next_end in reversed(_case_folded_matches(tree, folded, run_end, modifier)):
+                        if input_str[run_end:next_end] == folded[run_end:next_end].translate(_ASCII_UPPER):
+                            run.append(run_byte)
+                            run_end = next_end
+                            break
+                    else:
+                        break
+                if len(run) + 1 < run_end - pos:
+                    enc = [modifier, modifier, chr(len(run) - 1)] + run
+                    end = run_end
+                else:
+                    unmatched.extend(segment)  # Not worth it, leave the uppercase part verbatim
+                    pos = end
+                    break
+            else:
+                continue  # Mixed case, try a shorter match
+            if unmatched:
+                output_extend(_encapsulate_list(unmatched))
+                unmatched = []
+            output_extend(enc)
+            pos = end
+            break
+        else:
+            unmatched.append(input_str[pos])
+            pos += 1
+    if unmatched:
+        output_extend(_encapsulate_list(unmatched))
+
+    if pathological_case_detection and len(output) > _worst_size(input_str_len):
+        return _encapsulate(input_str)
+    return "".join(output)
+
+
+def _decompress_case_folded(input_str, decompress_table):
+    """ The decoder for decompress(case_folding=True), errors are left to decompress to handle """
+    modifier = CASE_FOLD_CODE
+    input_str_len = len(input_str)
+    output = []
+    output_append = output.append
+    pos = 0
+    while pos < input_str_len:
+        ch = ord(input_str[pos])
+        pos += 1
+        if ch == modifier:
+            ch = ord(input_str[pos])
+            pos += 1
+            if ch == modifier:  # Uppercase run
+                end_pos = pos + ord(input_str[pos]) + 2
+                if end_pos > input_str_len:
+                    raise ValueError('Invalid input to decompress - buffer overflow')
+                for code in input_str[pos + 1:end_pos]:
+                    code = ord(code)
+                    if code >= 254 or code == modifier:
+                        raise ValueError('Invalid input to decompress - bad code in uppercase run')
+                    output_append(decompress_table[code].translate(_ASCII_UPPER))
+                pos = end_pos
+            elif ch < 254:
+                output_append(_capitalize(decompress_table[ch]))
+            else:
+                raise ValueError('Invalid input to decompress - capitalized escape')
+        elif ch < 254:
+            output_append(decompress_table[ch])
+        else:
+            next_byte = input_str[pos]
+            pos += 1
+            if 254 == ch:
+                output_append(next_byte)
+            else:
+                end_pos = pos + ord(next_byte) + 1
+                if end_pos > input_str_len:
+                    raise ValueError('Invalid input to decompress - buffer overflow')
+                output_append(input_str[pos:end_pos])
+                pos = end_pos
+    return "".join(output)
+
+
+def decompress(input_str, raise_on_error=True, check_ascii=False, decompress_table=None, case_folding=False,
+               utf8=False, utf8_table=None):
+    """ Returns decoded text from the input_str using the SMAZ algorithm by default. On Python 3 input_str can also be
+        bytes, bytearray, memoryview or mmap - compressed data straight from a file or socket - and the output is then
+        bytes (text with utf8). Verbatim runs are sliced out of the buffer and copied once, into the output.
+
         :type input_str: str
         :type raise_on_error: bool
         :type check_ascii: bool
         :type decompress_table: list
+        :type case_folding: bool
+        :type utf8: bool
+        :type utf8_table: list
 
         :param raise_on_error Throw an exception on any kind of decode error, if false, return None on error
         :param check_ascii Check that all output is ASCII. Will raise or return None depending on raise_on_error
         :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+        :param case_folding Decode the case folding variant, output of compress(case_folding=True)
+        :param utf8 Decode the output of compress(utf8=True), returns text
+        :param utf8_table The secondary table used by compress, by default UTF8_DECODE
 
         :rtype: str
         :return: The decompressed input_str
     """
+    if _PROFILER is not None:
+        return _PROFILER.decompress(input_str, raise_on_error, check_ascii, decompress_table, case_folding, utf8,
+                                    utf8_table)
+    if isinstance(input_str, _BUFFER_TYPES):
+        return _decompress_buffer(input_str, raise_on_error, check_ascii, decompress_table, case_folding, utf8,
+                                  utf8_table)
     if not input_str:
         return input_str
-    else:
-        decompress_table = decompress_table or DECODE
-        input_str_len = len(input_str)
-        output = []
-        output_append = output.append
-        pos = 0
-        try:
-            while pos < input_str_len:
-                ch = ord(input_str[pos])
+    return _decompress(input_str, raise_on_error, check_ascii, decompress_table, case_folding, utf8, utf8_table)
+
+
+def _decompress(input_str, raise_on_error, check_ascii, decompress_table, case_folding, utf8, utf8_table, times=None,
+                counts=None):
+    """ decompress of a str, see there. smaz.profiling passes times and counts, as _compress. Code table entries and
+        single verbatim bytes are timed together as decode, verbatim runs on their own.
+    """
+    decompress_table = decompress_table or DECODE
+    input_str_len = len(input_str)
+    output = []
+    output_append = output.append
+    pos = 0
+    if utf8:
+        utf8_entries = _utf8_entries(UTF8_DECODE if utf8_table is None else utf8_table)
+    timing = times is not None
+    if timing:
+        decode_time = verbatim_time = 0.0
+        verbatims = 0
+        lap = _timer()
+    try:
+        if case_folding:
+            output.append(_decompress_case_folded(input_str, decompress_table))
+            pos = input_str_len
+            if timing:
+                lap = _lap(times, counts, 'case_folding', lap)
+        while pos < input_str_len:
+            ch = ord(input_str[pos])
+            pos += 1
+            if ch < 254:
+                # Code table entry
+                output_append(decompress_table[ch])
+            else:
+                next_byte = input_str[pos]
                 pos += 1
-                if ch < 254:
-                    # Code table entry
-                    output_append(decompress_table[ch])
-                else:
-                    next_byte = input_str[pos]
-                    pos += 1
-                    if 254 == ch:
+                if 254 == ch:
+                    if utf8 and next_byte > '\x7f':
+                        # Secondary table entry
+                        output_append(utf8_entries[ord(next_byte) - 128])
+                    else:
                         # Verbatim byte
                         output_append(next_byte)
-                    else:  # 255 == ch:
-                        # Verbatim string
-                        end_pos = pos + ord(next_byte) + 1
-                        if end_pos > input_str_len:
-                            raise ValueError('Invalid input to decompress - buffer overflow')
-                        output_append(input_str[pos:end_pos])
-                        pos = end_pos
-            # This may look a bit clunky, but it is worth 20% in cPython and O(n^2)->O(n) in PyPy
-            output = "".join(output)
-            if check_ascii and not _check_ascii(output):
+                else:  # 255 == ch:
+                    # Verbatim string
+                    if timing:
+                        now = _timer()
+                        decode_time += now - lap
+                        lap = now
+                    end_pos = pos + ord(next_byte) + 1
+                    if end_pos > input_str_len:
+                        raise ValueError('Invalid input to decompress - buffer overflow')
+                    output_append(input_str[pos:end_pos])
+                    pos = end_pos
+                    if timing:
+                        now = _timer()
+                        verbatim_time += now - lap
+                        verbatims += 1
+                        lap = now
+        if timing:
+            now = _timer()
+            times['decode'] += decode_time + now - lap
+            counts['decode'] += len(output) - verbatims - (1 if case_folding else 0)
+            times['verbatim'] += verbatim_time
+            counts['verbatim'] += verbatims
+            lap = now
+        # This may look a bit clunky, but it is worth 20% in cPython and O(n^2)->O(n) in PyPy
+        output = "".join(output)
+        if timing:
+            lap = _lap(times, counts, 'join', lap)
+        if utf8:
+            output = _bytes_to_text(_str_to_bytes(output))  # A UnicodeDecodeError is a ValueError
+            if timing:
+                lap = _lap(times, counts, 'utf8_decode', lap)
+        if check_ascii:
+            ascii_ok = _check_ascii(output)
+            if timing:
+                _lap(times, counts, 'check_ascii', lap)
+            if not ascii_ok:
                 raise ValueError('Invalid input to decompress - non-ascii byte payload')
-        except (IndexError, ValueError) as e:
+    except (IndexError, ValueError) as e:
+        if raise_on_error:
+            raise ValueError(str(e))
+        else:
+            return None
+    return output
+
+if sys.version_info[0] >= 3:
+    import mmap
+    _BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)  # Inputs decompress takes as bytes
+    _BYTE_VALUES = [bytes((i,)) for i in xrange(256)]
+    _ASCII_BYTES = bytes(xrange(128))
+else:
+    _BUFFER_TYPES = ()  # bytes is str
+
+_DECODE_TABLE_BYTES = {}  # Cache of decode tables as bytes, keyed by the decode table
+_DECODE_TABLE_BYTES_CACHE_SIZE = 64
+
+
+def _decode_table_bytes(decode_table):
+    """ decode_table entries as bytes, for decompressing buffers """
+    decode_table = tuple(decode_table)
+    entries = _DECODE_TABLE_BYTES.get(decode_table)
+    if entries is None:
+        if len(_DECODE_TABLE_BYTES) >= _DECODE_TABLE_BYTES_CACHE_SIZE:
+            _DECODE_TABLE_BYTES.clear()
+        entries = _DECODE_TABLE_BYTES[decode_table] = [_str_to_bytes(x) for x in decode_table]
+    return entries
+
+
+def _decompress_buffer(input_buff, raise_on_error=True, check_ascii=False, decompress_table=None, case_folding=False,
+                       utf8=False, utf8_table=None):
+    """ decompress for bytes-like input_buff, see decompress. The output is joined once from table entries and
+        memoryview slices of input_buff, so there are no intermediate strings.
+
+        :rtype: bytes
+    """
+    base = memoryview(input_buff)
+    view = base if base.format == 'B' else base.cast('B')
+    view_len = len(view)
+    output = []
+    output_append = output.append
+    pos = 0
+    try:
+        if case_folding:
+            output_append(_str_to_bytes(_decompress_case_folded(_bytes_to_str(view.tobytes()),
+                                                                decompress_table or DECODE)))
+            pos = view_len
+        decode_bytes = _DECODE_BYTES if decompress_table is None else _decode_table_bytes(decompress_table)
+        if utf8:
+            utf8_entries = _decode_table_bytes(_utf8_entries(UTF8_DECODE if utf8_table is None else utf8_table))
+        while pos < view_len:
+            ch = view[pos]
+            pos += 1
+            if ch < 254:
+                # Code table entry
+                output_append(decode_bytes[ch])
+            else:
+                next_byte = view[pos]
+                pos += 1
+                if 254 == ch:
+                    if utf8 and next_byte > 0x7f:
+                        # Secondary table entry
+                        output_append(utf8_entries[next_byte - 128])
+                    else:
+                        # Verbatim byte
+                        output_append(_BYTE_VALUES[next_byte])
+                else:  # 255 == ch:
+                    # Verbatim string, a view that the join copies from
+                    end_pos = pos + next_byte + 1
+                    if end_pos > view_len:
+                        raise ValueError('Invalid input to decompress - buffer overflow')
+                    output_append(view[pos:end_pos])
+                    pos = end_pos
+        output = b"".join(output)
+        if check_ascii and output.translate(None, _ASCII_BYTES):
+            raise ValueError('Invalid input to decompress - non-ascii byte payload')
+        if utf8:
+            output = _bytes_to_text(output)  # A UnicodeDecodeError is a ValueError
+    except (IndexError, ValueError) as e:
+        output = None  # Drop the views of input_buff
+        if raise_on_error:
+            raise ValueError(str(e))
+        else:
+            return None
+    finally:
+        view.release()
+        base.release()
+    return output
+
+
+def freeze_trie(compression_tree):
+    """ Convert a trie from make_trie into nested tuples, which can't be modified, so can be shared between threads
+        without locking. Its bigram table is built here rather than on first use, so compress never writes to it.
+        Works anywhere a make_trie tree does.
+
+        :type compression_tree: list
+        :rtype: tuple
+    """
+    frozen = _FrozenTrie(_freeze_nodes(compression_tree))
+    frozen.bigrams = make_bigram_table(frozen)
+    return frozen
+
+
+def _freeze_nodes(nodes):
+    return tuple(None if node is None else (node[0], None if node[1] is None else _freeze_nodes(node[1]))
+                 for node in nodes)
+
+
+class Dictionary(object):
+    """ An immutable compiled decode table, see compile_dictionary """
+    __slots__ = ('decode_table', 'tree')
+
+    def __init__(self, decode_table):
+        self.decode_table = tuple(decode_table)
+        self.tree = freeze_trie(make_trie(self.decode_table))  # Comes with its bigram table
+
+    def compress(self, input_str, **kwargs):
+        """ As compress, using this dictionary """
+        return compress(input_str, compression_tree=self.tree, **kwargs)
+
+    def decompress(self, input_str, **kwargs):
+        """ As decompress, using this dictionary """
+        return decompress(input_str, decompress_table=self.decode_table, **kwargs)
+
+
+_DICTIONARIES = {}  # Cache of compile_dictionary output, keyed by the decode table
+
+
+def compile_dictionary(decode_table=None):
+    """ Compile and cache an immutable Dictionary for decode_table. Nothing in it changes after construction, so one
+        Dictionary can be used from any number of threads at once, including on free threaded builds.
+
+        :type decode_table: list
+        :param decode_table Decode table to compile, by default uses SMAZ
+
+        :rtype: Dictionary
+    """
+    decode_table = tuple(decode_table or DECODE)
+    dictionary = _DICTIONARIES.get(decode_table)
+    if dictionary is None:
+        # Two threads may race to build the same dictionary, they are identical so it doesn't matter which is kept
+        dictionary = _DICTIONARIES.setdefault(decode_table, Dictionary(decode_table))
+    return dictionary
+
+
+def _run_many(func, input_strs, threads, executor, kwargs):
+    """ Apply func to each of input_strs, spread over a thread pool in chunks to keep the per task overhead down """
+    input_strs = list(input_strs)
+    if executor is None and (not threads or threads <= 1 or len(input_strs) < 2):
+        return [func(input_str, **kwargs) for input_str in input_strs]
+
+    def run_chunk(chunk):
+        return [func(input_str, **kwargs) for input_str in chunk]
+
+    chunk_size = max(1, len(input_strs) // ((threads or 4) * 4))  # A few chunks per thread evens out uneven inputs
+    chunks = [input_strs[i:i + chunk_size] for i in xrange(0, len(input_strs), chunk_size)]
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(threads) as pool:
+            results = list(pool.map(run_chunk, chunks))
+    else:
+        results = list(executor.map(run_chunk, chunks))
+    return [output for chunk in results for output in chunk]
+
+
+def compress_many(input_strs, threads=None, dictionary=None, executor=None, **kwargs):
+    """ Compress a batch of strings, optionally across a pool of threads. On a free threaded build (3.13t and later)
+        this scales with the number of threads, with the GIL it only helps if something else releases it. Unlike a
+        process pool nothing is pickled.
+
+        :type input_strs: list
+        :type threads: int
+        :type dictionary: Dictionary
+        :param input_strs Strings to compress
+        :param threads Number of threads to use, None or 1 compresses in the calling thread
+        :param dictionary A Dictionary from compile_dictionary, by default uses SMAZ. Can't be combined with a
+                          compression_tree
+        :param executor An existing concurrent.futures executor to use instead of starting threads, threads then
+                        only guides how the batch is split up
+        :param kwargs Passed to compress
+
+        :rtype: list
+        :return: The compressed strings, in the same order as input_strs
+    """
+    if dictionary is not None:
+        if kwargs.get('compression_tree') is not None:
+            raise ValueError('dictionary and compression_tree can not be combined')
+        kwargs['compression_tree'] = dictionary.tree
+    elif kwargs.get('compression_tree') is None and not kwargs.get('utf8'):  # utf8 defaults to its own tree
+        kwargs['compression_tree'] = compile_dictionary().tree
+    return _run_many(compress, input_strs, threads, executor, kwargs)
+
+
+def decompress_many(input_strs, threads=None, dictionary=None, executor=None, **kwargs):
+    """ Decompress a batch of strings, optionally across a pool of threads. See compress_many, dictionary can't be
+        combined with a decompress_table.
+
+        :type input_strs: list
+        :type threads: int
+        :type dictionary: Dictionary
+
+        :rtype: list
+        :return: The decompressed strings, in the same order as input_strs
+    """
+    if dictionary is not None:
+        if kwargs.get('decompress_table') is not None:
+            raise ValueError('dictionary and decompress_table can not be combined')
+        kwargs['decompress_table'] = dictionary.decode_table
+    return _run_many(decompress, input_strs, threads, executor, kwargs)
+
+
+# Tags for compress_auto, stored as the first byte of the output
+AUTO_RAW = 0           # Payload is the UTF-8 text, stored as is
+AUTO_SMAZ = 1          # Payload is compress() output
+AUTO_SMAZ_CLASSIC = 2  # Payload is compress_classic() output
+AUTO_ZLIB = 3          # Payload is a raw deflate stream, using AUTO_ZLIB_DICT as the preset dictionary
+
+# zlib prefers recent dictionary content, so the most common SMAZ entries go last
+AUTO_ZLIB_DICT = "".join(reversed(DECODE))
+AUTO_SAMPLE_SIZE = 512      # Inputs longer than this have their SMAZ size estimated from a sample first
+AUTO_ESTIMATE_SLACK = 1.1   # Only skip SMAZ when the estimate is this much worse than the best so far
+
+_MAX_DECODE_LEN = max(len(x) for x in DECODE)
+_ZLIB_HAS_ZDICT = sys.version_info >= (3, 3)
+
+if sys.version_info[0] >= 3:
+    def _text_to_bytes(text):
+        return text.encode('utf-8')
+
+    def _bytes_to_text(data):
+        return data.decode('utf-8')
+
+    def _bytes_to_str(data):
+        """ Bytes to a str of byte-valued characters, the representation used for compressed data """
+        return data.decode('latin-1')
+
+    def _str_to_bytes(sstr):
+        return sstr.encode('latin-1')
+else:
+    def _text_to_bytes(text):
+        return text.encode('utf-8') if isinstance(text, unicode) else text
+
+    def _bytes_to_text(data):
+        return data
+
+    def _bytes_to_str(data):
+        return data
+
+    def _str_to_bytes(sstr):
+        return sstr
+
+
+def _zlib_compress(data, level=9):
+    """ Raw deflate (no header or checksum) of data, primed with AUTO_ZLIB_DICT """
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY,
+                                  _str_to_bytes(AUTO_ZLIB_DICT))
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompress(data):
+    """ Inverse of _zlib_compress """
+    import zlib
+    decompressor = zlib.decompressobj(-15, _str_to_bytes(AUTO_ZLIB_DICT))
+    output = decompressor.decompress(data) + decompressor.flush()
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError('Invalid input to decompress_auto - truncated or overlong zlib stream')
+    return output
+
+
+def _zlib_min_size(data_len):
+    """ The fewest bytes a raw deflate stream for data_len bytes can take. Each symbol covers at most 258 bytes (the
+        longest match). A fixed Huffman block costs 3 header bits, 8 or more bits per symbol and a 7 bit end code. A
+        dynamic one costs at least 29 header bits and a bit per symbol, plus the end code.
+    """
+    symbols = -(-data_len // 258)
+    return (min(10 + 8 * symbols, 30 + symbols) + 7) // 8
+
+
+def compress_auto(input_str, zlib_level=9):
+    """ Compress the passed string with whichever of compress, compress_classic, zlib (primed with a preset dictionary
+        of SMAZ entries) or no compression at all gives the smallest output. The choice is recorded in a leading tag
+        byte (see AUTO_RAW etc.), so decompress_auto can reverse it.
+
+        compress_classic is only tried when compress's backtracking merged codes into a verbatim run, as otherwise
+        they give the same output. Short inputs try SMAZ first, and zlib only if the best so far is bigger than the smallest deflate stream for
+        the input, which skips it for the shortest strings. Long inputs try zlib first, then skip SMAZ when it can't
+        possibly win, as each SMAZ byte encodes at most len('http://') characters. SMAZ is also skipped when its
+        size, estimated from a sample, is more than AUTO_ESTIMATE_SLACK times the best so far. That is a guess, so
+        occasionally SMAZ would have been smaller. Non-ASCII input is accepted, SMAZ is simply not considered for it.
+
+    :param input_str The str to be compressed
+    :param zlib_level Compression level passed to zlib (default 9)
+
+    :type input_str: str
+    :type zlib_level: int
+
+    :rtype: str
+    :return: The tagged, compressed input_str
+    """
+    if not input_str:
+        return input_str
+    else:
+        raw = _text_to_bytes(input_str)
+        best_tag, best = AUTO_RAW, _bytes_to_str(raw)
+        input_str_len = len(input_str)
+        ascii_ok = len(raw) == input_str_len and _check_ascii(input_str)
+        zlib_first = input_str_len > AUTO_SAMPLE_SIZE or not ascii_ok
+        if _ZLIB_HAS_ZDICT and zlib_first:
+            zlib_data = _bytes_to_str(_zlib_compress(raw, zlib_level))
+            if len(zlib_data) < len(best):
+                best_tag, best = AUTO_ZLIB, zlib_data
+
+        if ascii_ok:
+            lower_bound = -(-input_str_len // _MAX_DECODE_LEN)
+            if lower_bound < len(best) and input_str_len > AUTO_SAMPLE_SIZE:
+                sample_len = len(compress_classic(input_str[:AUTO_SAMPLE_SIZE]))
+                estimate = sample_len * input_str_len // AUTO_SAMPLE_SIZE
+                if estimate > len(best) * AUTO_ESTIMATE_SLACK:
+                    return chr(best_tag) + best
+            if lower_bound < len(best):
+                # compress, keeping the encoder state
+                state = _EncoderState()
+                _encode(input_str, state, _SMAZ_TREE or _smaz_tree())
+                output = "".join(state.flush())
+                if len(output) > _worst_size(input_str_len):
+                    output = _encapsulate(input_str)
+                if len(output) < len(best) or (len(output) == len(best) and best_tag != AUTO_RAW):
+                    best_tag, best = AUTO_SMAZ, output
+                # Unless backtracking merged something, compress_classic would give the same output
+                if state.merged:
+                    output = compress_classic(input_str)
+                    if len(output) < len(best) or (len(output) == len(best) and best_tag == AUTO_ZLIB):
+                        best_tag, best = AUTO_SMAZ_CLASSIC, output
+
+        if _ZLIB_HAS_ZDICT and not zlib_first and _zlib_min_size(len(raw)) < len(best):
+            zlib_data = _bytes_to_str(_zlib_compress(raw, zlib_level))
+            if len(zlib_data) < len(best):
+                best_tag, best = AUTO_ZLIB, zlib_data
+        return chr(best_tag) + best
+
+
+def decompress_auto(input_str, raise_on_error=True):
+    """ Returns decoded text from the tagged input_str produced by compress_auto
+        :type input_str: str
+        :type raise_on_error: bool
+
+        :param raise_on_error Throw an exception on any kind of decode error, if false, return None on error
+
+        :rtype: str
+        :return: The decompressed input_str
+    """
+    if not input_str:
+        return input_str
+    else:
+        import zlib
+        tag = ord(input_str[0])
+        payload = input_str[1:]
+        try:
+            if tag in (AUTO_SMAZ, AUTO_SMAZ_CLASSIC):
+                return decompress(payload)
+            elif tag == AUTO_RAW:
+                return _bytes_to_text(_str_to_bytes(payload))
+            elif tag == AUTO_ZLIB and _ZLIB_HAS_ZDICT:
+                return _bytes_to_text(_zlib_decompress(_str_to_bytes(payload)))
+            else:
+                raise ValueError('Invalid input to decompress_auto - unknown tag %d' % tag)
+        except (UnicodeError, ValueError, zlib.error) as e:
             if raise_on_error:
                 raise ValueError(str(e))
             else:
                 return None
+
+
+class SmazStr(bytes):
+    """ A compact, immutable string value that holds only its compress() output, and decompresses on demand. It is
+        bytes: a varint of the plain length (little endian base 128, as smaz.framing), then the compressed payload,
+        so each value costs one bytes object and is smaller than the str it replaces.
+
+        Equality and hashing are those of the bytes, so set membership and dict lookups between SmazStr values never
+        decompress (compress is deterministic). A SmazStr never equals a plain str, wrap the key instead:
+
+            names = set(SmazStr(x) for x in big_list_of_names)
+            SmazStr('Salvatore') in names
+    """
+    __slots__ = ()
+
+    def __new__(cls, input_str):
+        """ :param input_str The ASCII str to be stored
+            :type input_str: str
+        """
+        header = bytearray()
+        length = len(input_str)
+        while length > 0x7f:
+            header.append((length & 0x7f) | 0x80)
+            length >>= 7
+        header.append(length)
+        return bytes.__new__(cls, bytes(header) + _str_to_bytes(compress(input_str) or ''))
+
+    @classmethod
+    def from_compressed(cls, compressed_str):
+        """ Build a SmazStr from existing SMAZ data. The data is re-encoded with compress so that equality with
+            other SmazStr values holds even if it was produced by compress_classic or other options.
+
+            :type compressed_str: str
+            :rtype: SmazStr
+        """
+        return cls(decompress(compressed_str))
+
+    def _header(self):
+        """ :return: (plain length, offset of the payload) """
+        length = shift = pos = 0
+        for byte in bytearray(self[:10]):
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        return length, pos
+
+    @property
+    def compressed(self):
+        """ The canonical compress() output for this value """
+        return _bytes_to_str(self[self._header()[1]:])
+
+    def __str__(self):
+        return decompress(self.compressed)
+
+    def __len__(self):
+        return self._header()[0]
+
+    def __reduce__(self):
+        return _smaz_str, (bytes(self),)
+
+    def __repr__(self):
+        return 'SmazStr(%r)' % str(self)
+
+
+def _smaz_str(data):
+    """ Unpickle a SmazStr from its bytes, without compressing again """
+    return bytes.__new__(SmazStr, data)
+
+
+class InternPool(object):
+    """ A deduplicating store of compressed strings. Each distinct string is compressed and stored once, in a single
+        contiguous buffer, and is referred to by a small integer handle. Repeats are found by hashing the compressed
+        form, which is deterministic for a given table and flags.
+
+            pool = InternPool()
+            handle = pool.intern('Status: OK')
+            pool.intern('Status: OK') == handle  # True, stored once with two references
+            pool.lookup(handle)  # 'Status: OK'
+
+        Released handles are reused, and their space in the buffer is reclaimed by compact.
+
+        :param cache_size Number of decompressed strings to keep for lookup, 0 to disable
+        :param compression_tree Passed to compress, see make_trie
+        :param decompress_table Passed to decompress, the table compression_tree was built from
+        :param utf8 Store any text, see compress(utf8=True)
+    """
+
+    def __init__(self, cache_size=1024, compression_tree=None, decompress_table=None, utf8=False):
+        from array import array
+        self.cache_size = cache_size
+        self.compression_tree = compression_tree
+        self.decompress_table = decompress_table
+        self.utf8 = utf8
+        self._buffer = bytearray()
+        self._offsets = array('l')    # Handle -> offset of its payload in _buffer, -1 once released
+        self._lengths = array('l')    # Handle -> payload length
+        self._refcounts = array('l')  # Handle -> references, 0 once released
+        self._plain_lengths = array('l')
+        self._index = {}              # Hash of payload -> handle, or list of handles if hashes collide
+        self._free = []               # Released handles, for reuse
+        self._garbage = 0             # Bytes in _buffer belonging to released handles
+        self._cache = {}
+
+    def intern(self, input_str):
+        """ Store input_str, or add a reference to it if it is already stored
+
+            :type input_str: str
+            :rtype: int
+            :return: The handle for input_str
+        """
+        payload = _str_to_bytes(compress(input_str, compression_tree=self.compression_tree, utf8=self.utf8) or '')
+        key = hash(payload)
+        entry = self._index.get(key)
+        if entry is not None:
+            for handle in (entry if isinstance(entry, list) else (entry,)):
+                offset = self._offsets[handle]
+                if self._lengths[handle] == len(payload) and self._buffer[offset:offset + len(payload)] == payload:
+                    self._refcounts[handle] += 1
+                    return handle
+
+        offset = len(self._buffer)
+        self._buffer += payload
+        plain_length = len(_text_to_bytes(input_str)) if self.utf8 else len(input_str)
+        if self._free:
+            handle = self._free.pop()
+            self._offsets[handle] = offset
+            self._lengths[handle] = len(payload)
+            self._refcounts[handle] = 1
+            self._plain_lengths[handle] = plain_length
+        else:
+            handle = len(self._offsets)
+            self._offsets.append(offset)
+            self._lengths.append(len(payload))
+            self._refcounts.append(1)
+            self._plain_lengths.append(plain_length)
+        if entry is None:
+            self._index[key] = handle
+        elif isinstance(entry, list):
+            entry.append(handle)
+        else:
+            self._index[key] = [entry, handle]
+        return handle
+
+    def _check(self, handle):
+        if not 0 <= handle < len(self._refcounts) or not self._refcounts[handle]:
+            raise KeyError('No string for handle %d' % handle)
+
+    def compressed(self, handle):
+        """ :rtype: str
+            :return: The compressed form of the string for handle
+        """
+        self._check(handle)
+        offset = self._offsets[handle]
+        return _bytes_to_str(bytes(self._buffer[offset:offset + self._lengths[handle]]))
+
+    def lookup(self, handle):
+        """ :rtype: str
+            :return: The string for handle, decompressed, or from the cache
+        """
+        try:
+            return self._cache[handle]
+        except KeyError:
+            pass
+        output = decompress(self.compressed(handle), decompress_table=self.decompress_table, utf8=self.utf8)
+        if self.cache_size:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[handle] = output
         return output
+
+    def refcount(self, handle):
+        """ :rtype: int """
+        self._check(handle)
+        return self._refcounts[handle]
+
+    def release(self, handle):
+        """ Drop a reference to handle. Once the last is gone the handle may be reused by a later intern. """
+        self._check(handle)
+        self._refcounts[handle] -= 1
+        if self._refcounts[handle]:
+            return
+        self._cache.pop(handle, None)
+        offset, length = self._offsets[handle], self._lengths[handle]
+        key = hash(bytes(self._buffer[offset:offset + length]))
+        entry = self._index[key]
+        if isinstance(entry, list):
+            entry.remove(handle)
+            if len(entry) == 1:
+                self._index[key] = entry[0]
+        else:
+            del self._index[key]
+        self._offsets[handle] = -1
+        self._garbage += length
+        self._free.append(handle)
+
+    def compact(self):
+        """ Rebuild the buffer without the payloads of released handles. Handles are unchanged. """
+        buff = bytearray()
+        for handle, offset in enumerate(self._offsets):
+            if offset >= 0:
+                self._offsets[handle] = len(buff)
+                buff += self._buffer[offset:offset + self._lengths[handle]]
+        self._buffer = buff
+        self._garbage = 0
+
+    def __len__(self):
+        """ Number of distinct strings stored """
+        return len(self._offsets) - len(self._free)
+
+    def __contains__(self, handle):
+        return 0 <= handle < len(self._refcounts) and self._refcounts[handle] > 0
+
+    def stats(self):
+        """ :rtype: dict
+            :return: strings (distinct), references, plain_bytes (of all references), payload_bytes (stored, excluding
+                     garbage) and buffer_bytes (including garbage)
+        """
+        references = plain_bytes = 0
+        for refcount, plain_length in zip(self._refcounts, self._plain_lengths):
+            references += refcount
+            plain_bytes += refcount * plain_length
+        return {'strings': len(self), 'references': references, 'plain_bytes': plain_bytes,
+                'payload_bytes': len(self._buffer) - self._garbage, 'buffer_bytes': len(self._buffer)}
+
+
+def _trie_depth(compression_tree):
+    """ The furthest the compress tree walk can look ahead, the length of the longest entry """
+    depth = 0
+    nodes = [(compression_tree, 1)]
+    while nodes:
+        node, node_depth = nodes.pop()
+        for child in node:
+            if child is not None:
+                depth = max(depth, node_depth)
+                if child[1] is not None:
+                    nodes.append((child[1], node_depth + 1))
+    return depth
+
+
+class IncrementalCompressed(object):
+    """ A compressed string that grows by appends, for transcripts and logs. compressed is always identical to
+        compress(the whole text), but appending only re-encodes a short tail rather than the whole string.
+
+            transcript = IncrementalCompressed()
+            transcript.append('Alice: Hello\n')
+            transcript.append('Bob: Hi there\n')
+            transcript.compressed == compress('Alice: Hello\nBob: Hi there\n')  # True
+
+        The compress encoder's output before its last backtrack point can't change whatever comes next, provided no
+        tree walk reached the end of the text. That output is committed, and only the plain text from the backtrack
+        point on is kept, with the encoder's buffers, to carry on from. Once the backtrack point is more than
+        backtrack_limit characters back, the next mode switch has to commit, so the buffers are committed straight
+        away. The tail and buffers stay under backtrack_limit plus the longest entry plus one verbatim run (255), so
+        memory and the cost of an append don't grow with the text. Objects pickle, so can be stored between appends.
+
+        :param input_str Initial text
+        :param compression_tree As compress
+        :param backtracking As compress
+        :param backtrack_limit As compress
+        :param check_ascii Check appended text is ASCII
+        :param adaptive As compress
+    """
+
+    def __init__(self, input_str='', compression_tree=None, backtracking=True, backtrack_limit=BACKTRACK_LIMIT,
+                 check_ascii=True, adaptive=False):
+        self.compression_tree = compression_tree
+        self.backtracking = backtracking
+        self.backtrack_limit = backtrack_limit
+        self.check_ascii = check_ascii
+        self.adaptive = adaptive
+        self._depth = _trie_depth(compression_tree or _SMAZ_TREE or _smaz_tree())
+        self._length = 0
+        self._committed = []  # Output that later text can't change
+        self._tail = ''       # Plain text the encoder still needs
+        # Encoder state, positions relative to _tail. The backtrack point is before the tail once it is too far back to
+        # matter
+        self._state = _EncoderState()
+        self._compressed = None  # Cache for compressed
+        if input_str:
+            self.append(input_str)
+
+    def append(self, input_str):
+        """ Add input_str to the end, encoding as much as later appends can't change
+
+            :type input_str: str
+        """
+        if not input_str:
+            return
+        if self.check_ascii and not _check_ascii(input_str):
+            raise ValueError('SMAZ can only process ASCII text.')
+        self._length += len(input_str)
+        self._compressed = None
+        tail = self._tail + input_str
+        state = self._state
+        # Stop before any tree walk could reach the end of the text, so later text can't change what is encoded
+        _encode(tail, state, self.compression_tree or _SMAZ_TREE or _smaz_tree(), self.backtracking,
+                self.backtrack_limit, self.adaptive, stop=len(tail) - self._depth)
+        forced = self._forced(state.pos, state.last_backtrack_pos)
+        if forced:
+            self._commit_held()
+        if state.output:
+            self._committed.append("".join(state.output))
+            state.output = []
+        # The text from the backtrack point is only needed to merge, which a forced commit rules out
+        trim = state.pos if forced else state.last_backtrack_pos
+        self._tail = tail[trim:]
+        state.pos -= trim
+        state.last_backtrack_pos -= trim
+
+    def __iadd__(self, input_str):
+        self.append(input_str)
+        return self
+
+    def __len__(self):
+        """ Length of the plain text """
+        return self._length
+
+    @property
+    def compressed(self):
+        """ compress output for the whole text, finishing the encoding of the tail
+
+            :rtype: str
+        """
+        if self._compressed is None:
+            if len(self._committed) > 1:
+                self._committed = ["".join(self._committed)]
+            state = self._state.copy()
+            _encode(self._tail, state, self.compression_tree or _SMAZ_TREE or _smaz_tree(), self.backtracking,
+                    self.backtrack_limit, self.adaptive)
+            output = state.flush()
+            compressed = "".join(self._committed + output)
+            if len(compressed) > _worst_size(self._length):  # Pathological case detection, as compress
+                compressed = _encapsulate(self._decompress(compressed))
+            self._compressed = compressed
+        return self._compressed
+
+    def text(self):
+        """ :rtype: str
+            :return: The whole plain text, decompressed
+        """
+        return self._decompress(self.compressed)
+
+    def _decompress(self, compressed):
+        if self.compression_tree is None:
+            return decompress(compressed)
+        return decompress(compressed, decompress_table=_tree_decode_table(self.compression_tree))
+
+    def _forced(self, pos, last_backtrack_pos):
+        """ Whether the next mode switch (or the end) commits whatever the merge lengths, see compress """
+        return pos - last_backtrack_pos > self.backtrack_limit or not self.backtracking
+
+    def _commit_held(self):
+        """ Everything held will be committed in order at the next mode switch, so commit it now. The last code stays
+            in enc_buf, as a non-empty enc_buf is what marks the next verbatim character as a mode switch, and a
+            verbatim run gives up whole 255 character chunks (keeping enough for the adaptive check)
+        """
+        state = self._state
+        state.output.extend(state.backtrack_buff)
+        state.backtrack_buff = []
+        if state.enc_buf:
+            state.output.extend(state.enc_buf[:-1])
+            state.enc_buf = state.enc_buf[-1:]
+        if len(state.unmatched) >= 255 + ADAPTIVE_RUN:
+            chunks = (len(state.unmatched) - ADAPTIVE_RUN) // 255 * 255
+            state.output.extend(_encapsulate_list(state.unmatched[:chunks]))
+            state.unmatched = state.unmatched[chunks:]
+
+
+def _search_filter(pattern, decompress_table):
+    """ Build a regex that matches compressed data only if, for each distinct character in pattern, it contains a byte
+        that could have produced it: a code whose table entry contains the character, or the character itself as a
+        verbatim byte. The most selective (fewest candidate bytes) lookaheads go first.
+    """
+    import re
+    lookaheads = []
+    for ch in set(pattern):
+        evidence = set(chr(code) for code, entry in enumerate(decompress_table) if ch in entry)
+        evidence.add(ch)
+        lookaheads.append((len(evidence), '(?=.*?[%s])' % "".join(re.escape(x) for x in sorted(evidence))))
+    lookaheads.sort()
+    return re.compile("".join(x for _, x in lookaheads), re.DOTALL).match
+
+
+def search(pattern, records, decompress_table=None):
+    """ Find the compressed records whose decompressed text contains pattern. Records are first checked in the
+        compressed domain: every character of pattern has to come from a code whose table entry contains it, or from a
+        verbatim byte, so a record missing all such bytes for any one character can't match and is never decompressed.
+        The survivors are decompressed to confirm the match.
+
+        :type pattern: str
+        :type records: iterable of str
+        :type decompress_table: list
+
+        :param pattern The plain text to look for
+        :param records Compressed strings, as returned by compress
+        :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+
+        :rtype: generator of (int, str)
+        :return: (position in records, decompressed text) for each matching record
+    """
+    decompress_table = decompress_table or DECODE
+    search_filter = _search_filter(pattern, decompress_table)
+    for index, record in enumerate(records):
+        if search_filter(record):
+            text = decompress(record, decompress_table=decompress_table)
+            if pattern in text:
+                yield index, text
+
+
+INDEX_BLOCK_SIZE = 4096  # Default plain text distance between entries in a compress_indexed index
+
+
+def make_index(input_str, block=INDEX_BLOCK_SIZE, decompress_table=None):
+    """ Build a sparse index for SMAZ compressed data. SMAZ codes carry no context, so decoding can start at any code
+        boundary. This walks the codes (without decoding them) and records a boundary roughly every block characters
+        of plain text.
+
+        :type input_str: str
+        :type block: int
+        :type decompress_table: list
+
+        :param input_str Compressed data, as returned by compress
+        :param block Minimum plain text distance between index entries
+        :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+
+        :rtype: list
+        :return: A list of (plain text offset, compressed offset) tuples, starting with (0, 0)
+    """
+    decode_lengths = [len(x) for x in (decompress_table or DECODE)]
+    input_str_len = len(input_str or '')
+    index = [(0, 0)]
+    next_entry = block
+    plain_pos = pos = 0
+    while pos < input_str_len:
+        if plain_pos >= next_entry:
+            index.append((plain_pos, pos))
+            next_entry = plain_pos + block
+        ch = ord(input_str[pos])
+        if ch < 254:
+            plain_pos += decode_lengths[ch]
+            pos += 1
+        elif ch == 254:
+            plain_pos += 1
+            pos += 2
+        else:
+            run_len = ord(input_str[pos + 1]) + 1
+            plain_pos += run_len
+            pos += run_len + 2
+    return index
+
+
+def compress_indexed(input_str, block=INDEX_BLOCK_SIZE, decompress_table=None, **kwargs):
+    """ Compress input_str, and index the output for random access with decompress_range. The compressed output is
+        identical to compress(input_str, **kwargs), any extra keyword arguments are passed to compress.
+
+        :type input_str: str
+        :type block: int
+        :type decompress_table: list
+
+        :param input_str The ASCII str to be compressed
+        :param block Plain text distance between index entries, the most decompress_range will decode is two blocks
+                     plus the requested slice
+        :param decompress_table Alternative 253 entry decode table to compress and index with, by default uses SMAZ
+                                or the table of a compression_tree passed to compress
+
+        :rtype: tuple
+        :return: (compressed str, index) see make_index for the index format
+    """
+    compression_tree = kwargs.get('compression_tree')
+    if compression_tree is None and decompress_table is not None:
+        kwargs['compression_tree'] = make_trie(decompress_table)
+    elif compression_tree is not None and decompress_table is None:
+        decompress_table = _tree_decode_table(compression_tree)
+    output = compress(input_str, **kwargs)
+    return output, make_index(output, block, decompress_table)
+
+
+def decompress_range(input_str, index, start, stop=None, decompress_table=None):
+    """ Return decompress(input_str)[start:stop], decoding only the blocks that cover the slice. Negative offsets are
+        not supported.
+
+        :type input_str: str
+        :type index: list
+        :type start: int
+        :type stop: int
+        :type decompress_table: list
+
+        :param input_str Compressed data, as returned by compress
+        :param index The index for input_str, from compress_indexed or make_index
+        :param start First plain text offset to return
+        :param stop Plain text offset to stop at, by default the end of the text
+        :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+
+        :rtype: str
+        :return: The decompressed slice
+    """
+    import bisect
+    if start < 0 or (stop is not None and stop < 0):
+        raise ValueError('decompress_range does not support negative offsets')
+    first = bisect.bisect_right(index, (start, len(input_str))) - 1
+    plain_start, comp_start = index[first]
+    comp_stop = None
+    if stop is not None:
+        last = bisect.bisect_left(index, (stop, 0))
+        if last < len(index):
+            comp_stop = index[last][1]
+    text = decompress(input_str[comp_start:comp_stop], decompress_table=decompress_table)
+    return text[start - plain_start:None if stop is None else stop - plain_start]
+
+
+_DECODE_BYTES = [_str_to_bytes(x) for x in DECODE]
+
+
+_VALIDATE_REGEXES = None
+_CODE_LENGTH = dict((chr(code), len(x)) for code, x in enumerate(DECODE)).__getitem__
+
+
+def _validate_regexes():
+    """ Searches for the next escape byte, and for non-ASCII bytes. Compiled on first use """
+    global _VALIDATE_REGEXES
+    if _VALIDATE_REGEXES is None:
+        import re
+        _VALIDATE_REGEXES = (re.compile('[\xfe\xff]').search, re.compile('[^\x00-\x7f]').search)
+    return _VALIDATE_REGEXES
+
+
+def validate(input_str, check_ascii=False, raise_on_error=True, decompress_table=None):
+    """ Check that input_str is well formed SMAZ data without decompressing it: every code is in the table, every 254
+        escape is followed by a byte, and every 255 escape by a length and that many bytes plus one. Nothing is
+        allocated for the output, so this is much cheaper than decompress for rejecting bad input.
+
+        :type input_str: str
+        :type check_ascii: bool
+        :type raise_on_error: bool
+        :type decompress_table: list
+
+        :param check_ascii Also check that all verbatim bytes are ASCII, as decompress(check_ascii=True) would
+        :param raise_on_error Throw a ValueError on malformed input, if false, return None
+        :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+
+        :rtype: int
+        :return: The decompressed length
+    """
+    if decompress_table:
+        code_length = dict((chr(code), len(x)) for code, x in enumerate(decompress_table)).__getitem__
+    else:
+        code_length = _CODE_LENGTH
+    input_str_len = len(input_str or '')
+    next_escape, non_ascii = _VALIDATE_REGEXES or _validate_regexes()
+    output_len = pos = 0
+    try:
+        while pos < input_str_len:
+            # Runs of codes are summed in one go, only the escapes need walking
+            escape = next_escape(input_str, pos)
+            escape_pos = escape.start() if escape else input_str_len
+            if escape_pos > pos:
+                output_len += sum(map(code_length, input_str[pos:escape_pos]))
+                pos = escape_pos
+            if escape:
+                ch = ord(input_str[pos])
+                run_len = 1 if 254 == ch else ord(input_str[pos + 1]) + 1
+                pos += 1 if 254 == ch else 2
+                if pos + run_len > input_str_len:
+                    raise ValueError('Invalid input to decompress - buffer overflow')
+                if check_ascii and non_ascii(input_str, pos, pos + run_len):
+                    raise ValueError('Invalid input to decompress - non-ascii byte payload')
+                output_len += run_len
+                pos += run_len
+    except KeyError as e:
+        if raise_on_error:
+            raise ValueError('Invalid input to decompress - code %d is not in the table' % ord(e.args[0]))
+        else:
+            return None
+    except (IndexError, ValueError) as e:
+        if raise_on_error:
+            raise ValueError(str(e))
+        else:
+            return None
+    return output_len
+
+
+def validate_many(input_strs, check_ascii=False, decompress_table=None):
+    """ validate each of input_strs, returning a list of decompressed lengths, with None for malformed entries
+
+        :type input_strs: iterable of str
+        :type check_ascii: bool
+        :type decompress_table: list
+
+        :rtype: list
+    """
+    return [validate(x, check_ascii=check_ascii, raise_on_error=False, decompress_table=decompress_table)
+            for x in input_strs]
+
+
+def decompressed_length(input_str, decompress_table=None):
+    """ Returns the length decompress would produce for input_str, worked out from the code lengths and verbatim headers
+        without building any output.
+
+        :type input_str: str
+        :type decompress_table: list
+
+        :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+
+        :rtype: int
+        :return: The decompressed length, raises ValueError on malformed input
+    """
+    return validate(input_str, decompress_table=decompress_table)
+
+
+def decompress_into(input_str, output, offset=0, decompress_table=None):
+    """ Decode input_str straight into a caller supplied buffer, with no intermediate strings. Size the buffer with
+        decompressed_length, or decode many records one after another into a single arena.
+
+        :type input_str: str, or bytes, bytearray, memoryview or mmap (Python 3)
+        :type output: bytearray or memoryview
+        :type offset: int
+        :type decompress_table: list
+
+        :param input_str Compressed data, buffers are read in place
+        :param output Writable buffer to decode into
+        :param offset Position in output to start writing at
+        :param decompress_table Alternative 253 entry decode table, by default uses SMAZ
+
+        :rtype: int
+        :return: The number of bytes written, raises ValueError on malformed input or if output is too small
+    """
+    decode_bytes = _decode_table_bytes(decompress_table) if decompress_table else _DECODE_BYTES
+    if isinstance(input_str, _BUFFER_TYPES):
+        data = input_str
+    elif _BUFFER_TYPES:
+        data = _str_to_bytes(input_str or '')
+    else:
+        data = bytearray(input_str or '')  # Python 2, indexes as ints
+    base = memoryview(data)
+    view = base if base.format == 'B' else base.cast('B')
+    codes = view if _BUFFER_TYPES else data
+    input_len = len(view)
+    output_len = len(output)
+    out_pos = offset
+    pos = 0
+    try:
+        while pos < input_len:
+            ch = codes[pos]
+            pos += 1
+            if ch < 254:
+                entry = decode_bytes[ch]
+                end_pos = out_pos + len(entry)
+                if end_pos > output_len:
+                    raise ValueError('Output buffer too small for decompress_into')
+                output[out_pos:end_pos] = entry
+            else:
+                run_len = 1 if 254 == ch else codes[pos] + 1
+                if 255 == ch:
+                    pos += 1
+                if pos + run_len > input_len:
+                    raise ValueError('Invalid input to decompress - buffer overflow')
+                end_pos = out_pos + run_len
+                if end_pos > output_len:
+                    raise ValueError('Output buffer too small for decompress_into')
+                output[out_pos:end_pos] = view[pos:pos + run_len]  # Copied from the input, no intermediate string
+                pos += run_len
+            out_pos = end_pos
+    except IndexError as e:
+        raise ValueError(str(e))
+    finally:
+        if _BUFFER_TYPES:  # Python 3 views can be released
+            view.release()
+            base.release()
+    return out_pos - offset
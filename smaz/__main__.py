@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Command line tool for compressing line oriented files (SMS exports, URL lists, logs) record by record.
+
+Usage
+-----
+
+python -m smaz compress sms_corpus.txt sms_corpus.smaz --workers 4
+python -m smaz decompress sms_corpus.smaz sms_corpus.txt
+python -m smaz stats sms_corpus.txt
+
+Records are lines (without the newline), or with --length-prefixed varint length prefixed byte strings. Compressed
+output uses the framing in smaz.framing, one frame per record. If the last line has no newline, an empty frame with
+dictionary id UNTERMINATED follows it, so decompress leaves the newline off too. Files are streamed in batches, so
+memory use doesn't grow with the file. Use - for stdin or stdout. A summary of throughput and ratio is written to
+stderr at the end.
+
+Python 3.7+ only.
+"""
+
+import argparse
+import collections
+import sys
+import time
+
+from smaz import compress, compress_classic, decompress, _bytes_to_str, _str_to_bytes
+from smaz.framing import encode_frame, encode_varint, decode_varint, parse_frames, READ_SIZE
+
+__author__ = "Max Smith"
+
+BATCH_SIZE = 1000  # Records per batch handed to a worker
+UNTERMINATED = 0  # Dictionary id of the empty frame that marks a last line without a newline
+
+
+def _read_lines(fileobj, unterminated):
+    """ Lines without their newlines. If the last line has no newline, True is appended to unterminated """
+    for line in fileobj:
+        if line.endswith(b'\n'):
+            yield line[:-1]
+        else:
+            unterminated.append(True)
+            yield line
+
+
+def _read_length_prefixed(fileobj):
+    buff = bytearray()
+    pos = 0
+    while True:
+        header = decode_varint(buff, pos)
+        if header is not None and header[1] + header[0] <= len(buff):
+            length, start = header
+            yield bytes(buff[start:start + length])
+            pos = start + length
+            continue
+        data = fileobj.read(READ_SIZE)
+        if not data:
+            if pos < len(buff):
+                raise ValueError('Input ended part way through a record')
+            return
+        del buff[:pos]
+        pos = 0
+        buff += data
+
+
+def _read_frames(fileobj, unterminated):
+    """ Frame payloads. An UNTERMINATED marker is dropped, and True appended to unterminated """
+    buff = bytearray()
+    while True:
+        data = fileobj.read(READ_SIZE)
+        if not data:
+            if buff:
+                raise ValueError('Input ended part way through a frame')
+            return
+        buff += data
+        frames, consumed = parse_frames(buff)
+        payloads = []
+        for dict_id, payload in frames:
+            if dict_id == UNTERMINATED and not payload:
+                unterminated.append(True)
+            else:
+                payloads.append(bytes(payload))
+        frames = payload = None  # Release the views into the buffer, so it can be resized
+        del buff[:consumed]
+        for payload in payloads:
+            yield payload
+
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _compress_batch(records, utf8=False, classic=False):
+    """ Compress a batch of byte strings to frames, runs in the workers """
+    if utf8:
+        return [encode_frame(_str_to_bytes(compress(record.decode('utf-8'), utf8=True))) for record in records]
+    codec = compress_classic if classic else compress
+    return [encode_frame(_str_to_bytes(codec(_bytes_to_str(record)))) for record in records]
+
+
+def _decompress_batch(payloads, utf8=False):
+    """ Decompress a batch of payloads to byte strings, runs in the workers """
+    if utf8:
+        return [decompress(payload, utf8=True).encode('utf-8') for payload in payloads]
+    return [decompress(payload) for payload in payloads]
+
+
+def _map_batches(func, batches, workers, **kwargs):
+    """ Run func over the batches, in order, in a process pool if workers > 1. At most two batches per worker are in
+        flight at a time, so memory use stays bounded.
+    """
+    if workers <= 1:
+        for batch in batches:
+            yield batch, func(batch, **kwargs)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch, pool.submit(func, batch, **kwargs)))
+            if len(pending) >= workers * 2:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+
+class _Report(object):
+    """ Totals for the summary line """
+
+    def __init__(self):
+        self.records = 0
+        self.plain_bytes = 0
+        self.compressed_bytes = 0
+        self.start = time.time()
+
+    def summary(self, action):
+        elapsed = max(time.time() - self.start, 1e-9)
+        ratio = self.compressed_bytes / float(self.plain_bytes) if self.plain_bytes else 1.0
+        return '%s: %d records, %d -> %d bytes, ratio %.3f, %.2f seconds, %.2f MB/s' % (
+            action, self.records, self.plain_bytes, self.compressed_bytes, ratio, elapsed,
+            self.plain_bytes / elapsed / 1e6)
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin.buffer if 'r' in mode else sys.stdout.buffer
+    return open(path, mode)
+
+
+def _run_compress(args, report):
+    infile = _open(args.input, 'rb')
+    outfile = None if args.output is None else _open(args.output, 'wb')
+    unterminated = []
+    try:
+        records = _read_length_prefixed(infile) if args.length_prefixed else _read_lines(infile, unterminated)
+        for batch, frames in _map_batches(_compress_batch, _batches(records, args.batch_size), args.workers,
+                                          utf8=args.utf8, classic=args.classic):
+            report.records += len(batch)
+            report.plain_bytes += sum(len(record) for record in batch)
+            report.compressed_bytes += sum(len(frame) for frame in frames)
+            if outfile is not None:
+                outfile.write(b''.join(frames))
+        if unterminated and outfile is not None:
+            outfile.write(encode_frame(b'', UNTERMINATED))
+    finally:
+        if infile is not sys.stdin.buffer:
+            infile.close()
+        if outfile is not None and outfile is not sys.stdout.buffer:
+            outfile.close()
+
+
+def _run_decompress(args, report):
+    infile = _open(args.input, 'rb')
+    outfile = _open(args.output, 'wb')
+    unterminated = []
+    separator = b''  # Newlines go in front of the next line, so the last can be left off
+    try:
+        for batch, records in _map_batches(_decompress_batch, _batches(_read_frames(infile, unterminated),
+                                                                       args.batch_size), args.workers, utf8=args.utf8):
+            report.records += len(batch)
+            report.compressed_bytes += sum(len(payload) + len(encode_varint(len(payload) << 1)) for payload in batch)
+            report.plain_bytes += sum(len(record) for record in records)
+            if args.length_prefixed:
+                outfile.write(b''.join(encode_varint(len(record)) + record for record in records))
+            else:
+                outfile.write(separator + b'\n'.join(records))
+                separator = b'\n'
+        if separator and not unterminated:
+            outfile.write(separator)
+    finally:
+        if infile is not sys.stdin.buffer:
+            infile.close()
+        if outfile is not sys.stdout.buffer:
+            outfile.close()
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='python -m smaz', description='Compress line oriented files with SMAZ')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    for name, help_text in (('compress', 'Compress records to a framed file'),
+                            ('decompress', 'Decompress a framed file back to records'),
+                            ('stats', 'Report the ratio and throughput, without writing anything')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('input', help='Input file, - for stdin')
+        if name != 'stats':
+            command.add_argument('output', help='Output file, - for stdout')
+        command.add_argument('--length-prefixed', action='store_true',
+                             help='Records are varint length prefixed rather than lines')
+        command.add_argument('--utf8', action='store_true', help='Records are UTF-8 text, see compress(utf8=True)')
+        if name != 'decompress':
+            command.add_argument('--classic', action='store_true', help='Use compress_classic, ignored with --utf8')
+        command.add_argument('--workers', type=int, default=1, help='Worker processes (default 1, no pool)')
+        command.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Records per batch')
+        command.add_argument('--quiet', action='store_true', help="Don't write the summary to stderr")
+    return parser
+
+
+def main(argv=None):
+    """ Entry point for python -m smaz, returns the exit status """
+    args = _parser().parse_args(argv)
+    report = _Report()
+    try:
+        if args.command == 'decompress':
+            _run_decompress(args, report)
+        else:
+            if args.command == 'stats':
+                args.output = None
+            _run_compress(args, report)
+    except (ValueError, IOError) as e:
+        sys.stderr.write('python -m smaz %s: %s\n' % (args.command, e))
+        return 1
+    if not args.quiet:
+        sys.stderr.write(report.summary(args.command) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
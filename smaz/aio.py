@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+asyncio helpers for PySmaz, so compressing large strings doesn't block the event loop.
+
+Small inputs are cheap and are run inline. Larger ones are handed to an executor, and to stop the per-task dispatch
+overhead swamping the tiny amount of work per string, requests arriving within a short window are coalesced into a
+single executor call.
+
+Usage
+-----
+
+from smaz import aio
+compressed = await aio.compress('Hello World!')
+decompressed = await aio.decompress(compressed)
+
+Python 3.7+ only.
+"""
+
+import asyncio
+import weakref
+
+import smaz
+
+__author__ = "Max Smith"
+
+INLINE_THRESHOLD = 1024  # Inputs shorter than this are run inline on the event loop
+BATCH_WINDOW = 0.0005    # Seconds to wait for more requests before dispatching a batch to the executor
+MAX_BATCH_SIZE = 256     # Dispatch straight away once this many requests are waiting
+
+
+def _run_batch(batch):
+    """ Run a batch of (function, input_str, kwargs) in the executor, capturing exceptions per entry """
+    results = []
+    for func, input_str, kwargs in batch:
+        try:
+            results.append((True, func(input_str, **kwargs)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class AsyncCodec(object):
+    """ Non-blocking compress/decompress with micro-batching.
+
+        :param executor A concurrent.futures executor for large inputs, None uses the loop's default executor. Use a
+                        ProcessPoolExecutor if you need CPU parallelism rather than just an unblocked loop.
+        :param inline_threshold Inputs shorter than this are run inline
+        :param batch_window Seconds to wait for more requests before dispatching a batch
+        :param max_batch_size Dispatch straight away once this many requests are waiting
+    """
+
+    def __init__(self, executor=None, inline_threshold=INLINE_THRESHOLD, batch_window=BATCH_WINDOW,
+                 max_batch_size=MAX_BATCH_SIZE):
+        self.executor = executor
+        self.inline_threshold = inline_threshold
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.inline_calls = 0  # Statistics, handy for tuning the thresholds
+        self.batches = 0
+        self.batched_calls = 0
+        self._pending = weakref.WeakKeyDictionary()  # loop -> [list of (func, input_str, kwargs, future), timer]
+
+    async def compress(self, input_str, **kwargs):
+        """ As smaz.compress, takes the same keyword arguments """
+        return await self._submit(smaz.compress, input_str, kwargs)
+
+    async def decompress(self, input_str, **kwargs):
+        """ As smaz.decompress, takes the same keyword arguments """
+        return await self._submit(smaz.decompress, input_str, kwargs)
+
+    def _submit(self, func, input_str, kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not input_str or len(input_str) < self.inline_threshold:
+            self.inline_calls += 1
+            try:
+                future.set_result(func(input_str, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        pending = self._pending.get(loop)
+        if pending is None:
+            pending = self._pending[loop] = [[], None]
+        pending[0].append((func, input_str, kwargs, future))
+        if len(pending[0]) >= self.max_batch_size:
+            self._dispatch(loop)
+        elif pending[1] is None:
+            pending[1] = loop.call_later(self.batch_window, self._dispatch, loop)
+        return future
+
+    def _dispatch(self, loop):
+        """ Send everything waiting on loop to the executor as one call """
+        batch, timer = self._pending.pop(loop, ([], None))
+        if timer is not None:
+            timer.cancel()
+        if not batch:
+            return
+        self.batches += 1
+        self.batched_calls += len(batch)
+        work = loop.run_in_executor(self.executor, _run_batch, [(func, x, kw) for func, x, kw, _ in batch])
+        work.add_done_callback(lambda done: self._distribute(batch, done))
+
+    @staticmethod
+    def _distribute(batch, done):
+        if done.cancelled() or done.exception() is not None:
+            for _, _, _, future in batch:
+                if not future.done():
+                    if done.cancelled():
+                        future.cancel()
+                    else:
+                        future.set_exception(done.exception())
+            return
+        for (_, _, _, future), (ok, result) in zip(batch, done.result()):
+            if not future.done():
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+
+
+_default_codec = AsyncCodec()
+
+
+def set_executor(executor):
+    """ Set the executor used by the module level compress and decompress, None for the loop's default executor """
+    _default_codec.executor = executor
+
+
+async def compress(input_str, **kwargs):
+    """ Compress input_str without blocking the event loop, takes the same keyword arguments as smaz.compress """
+    return await _default_codec.compress(input_str, **kwargs)
+
+
+async def decompress(input_str, **kwargs):
+    """ Decompress input_str without blocking the event loop, takes the same keyword arguments as smaz.decompress """
+    return await _default_codec.decompress(input_str, **kwargs)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measure candidate decode tables on realistic data before rolling them out: bytes saved, throughput, how often each code
+is used and which entries are never used, per table, corpus and compression mode.
+
+Corpora are lists of records - compressed one by one - so a line by line corpus is a list of lines and a whole file
+corpus is a list of one string. load_corpus and data_corpora read files, such as the tests/data sets.
+
+Results are cached by a hash of the table, the corpus and the mode, so re-running an evaluation after adding a table
+only measures the new one. The default cache lives as long as the process, pass any mapping (a dict, or a shelve for a
+cache that survives restarts) to keep results elsewhere. Cached results keep the throughput of the run that measured
+them.
+
+Modes
+-----
+
+  classic         compress_classic, through compile_matcher for tables other than SMAZ
+  backtracking    compress
+  no_backtracking compress(backtracking=False)
+  adaptive        compress(adaptive=True)
+  optimal         compress_optimal
+
+Usage
+-----
+
+results = evaluate({'smaz': DECODE, 'urls': URL_TABLE}, data_corpora(lines=True))
+print(format_results(results))
+"""
+
+import collections
+import hashlib
+import os
+import time
+
+from smaz import compress, compress_classic, compress_optimal, compile_matcher, decompress, make_trie, DECODE
+
+__author__ = "Max Smith"
+
+MODES = ('classic', 'backtracking', 'no_backtracking', 'adaptive', 'optimal')
+DEFAULT_MODES = ('classic', 'backtracking', 'optimal')
+TEST_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'tests', 'data')
+
+_CACHE = {}  # Default results cache, key -> Evaluation fields
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.time  # Python 2
+
+_Evaluation = collections.namedtuple('Evaluation', ['table', 'corpus', 'mode', 'records', 'plain_bytes',
+                                                    'compressed_bytes', 'verbatim_bytes', 'seconds', 'code_counts'])
+
+
+class Evaluation(_Evaluation):
+    """ One table on one corpus in one mode. code_counts[code] is how many times each code of the table was output,
+        verbatim_bytes how many input bytes went out as verbatim bytes or runs.
+    """
+    __slots__ = ()
+
+    @property
+    def bytes_saved(self):
+        return self.plain_bytes - self.compressed_bytes
+
+    @property
+    def ratio(self):
+        """ Compressed size over plain size, lower is better """
+        return self.compressed_bytes / float(self.plain_bytes) if self.plain_bytes else 1.0
+
+    @property
+    def megabytes_per_second(self):
+        """ Compression throughput, of plain text """
+        return self.plain_bytes / self.seconds / 1e6 if self.seconds else 0.0
+
+    @property
+    def dead_entries(self):
+        """ Codes that were never output """
+        return [code for code, count in enumerate(self.code_counts) if not count]
+
+
+def load_corpus(path, lines=False):
+    """ Read a file as a corpus. Non-ASCII characters are dropped, as SMAZ can't encode them.
+
+        :type path: str
+        :type lines: bool
+        :param lines One record per line (empty lines are skipped), rather than the whole file as one
+
+        :rtype: list
+    """
+    with open(path, 'rb') as f:
+        text = f.read().decode('latin-1').encode('ascii', 'ignore').decode('ascii')
+    return [line for line in text.split('\n') if line] if lines else [text]
+
+
+def data_corpora(lines=False, data_dir=TEST_DATA):
+    """ The tests/data sets that are present, as a mapping of file name -> corpus. The larger files are in the
+        PySmaz repository rather than the package.
+
+        :type lines: bool
+        :rtype: dict
+    """
+    corpora = {}
+    if os.path.isdir(data_dir):
+        for name in sorted(os.listdir(data_dir)):
+            path = os.path.join(data_dir, name)
+            if os.path.isfile(path):
+                corpora[name] = load_corpus(path, lines)
+    return corpora
+
+
+def _digest(strs):
+    """ Hash of a list of strs, which can't be fooled by moving characters between them """
+    digest = hashlib.sha1()
+    for sstr in strs:
+        data = sstr.encode('utf-8')
+        digest.update(str(len(data)).encode('ascii') + b':')
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _count_codes(compressed, code_counts):
+    """ Add the codes in compressed to code_counts, return the number of verbatim bytes """
+    verbatim = 0
+    pos = 0
+    compressed_len = len(compressed)
+    while pos < compressed_len:
+        ch = ord(compressed[pos])
+        if ch < 254:
+            code_counts[ch] += 1
+            pos += 1
+        elif ch == 254:
+            verbatim += 1
+            pos += 2
+        else:
+            run_len = ord(compressed[pos + 1]) + 1
+            verbatim += run_len
+            pos += 2 + run_len
+    return verbatim
+
+
+def _codec(decode_table, mode):
+    """ A compress function for decode_table in mode """
+    if decode_table is DECODE:
+        tree = None
+    else:
+        tree = make_trie(decode_table)
+    if mode == 'classic':
+        matcher = None if tree is None else compile_matcher(decode_table)
+        return lambda text: compress_classic(text, matcher=matcher)
+    elif mode == 'backtracking':
+        return lambda text: compress(text, compression_tree=tree)
+    elif mode == 'no_backtracking':
+        return lambda text: compress(text, compression_tree=tree, backtracking=False)
+    elif mode == 'adaptive':
+        return lambda text: compress(text, compression_tree=tree, adaptive=True)
+    elif mode == 'optimal':
+        return lambda text: compress_optimal(text, compression_tree=tree)
+    raise ValueError('Unknown mode: %s, expected one of %s' % (mode, ', '.join(MODES)))
+
+
+def evaluate_one(decode_table, corpus, mode, table_name='table', corpus_name='corpus', check=True):
+    """ Measure one table on one corpus in one mode, without the cache
+
+        :type decode_table: list
+        :type corpus: list
+        :type mode: str
+        :param check Decompress everything and check it round trips, outside the timing
+
+        :rtype: Evaluation
+    """
+    codec = _codec(decode_table, mode)
+    start = _timer()
+    compressed = [codec(record) for record in corpus]
+    seconds = _timer() - start
+    code_counts = [0] * len(decode_table)
+    verbatim = 0
+    for record, output in zip(corpus, compressed):
+        verbatim += _count_codes(output, code_counts)
+        if check and decompress(output, decompress_table=decode_table) != record:
+            raise ValueError('Round trip failed for table %s on %s in mode %s' % (table_name, corpus_name, mode))
+    return Evaluation(table_name, corpus_name, mode, len(corpus), sum(len(record) for record in corpus),
+                      sum(len(output) for output in compressed), verbatim, seconds, code_counts)
+
+
+def evaluate(tables, corpora, modes=DEFAULT_MODES, cache=None, check=True):
+    """ Run every table over every corpus in every mode
+
+        :param tables Mapping of name -> decode table
+        :param corpora Mapping of name -> list of records, see load_corpus and data_corpora
+        :param modes Names from MODES
+        :param cache Mapping to keep results in, by default a cache that lasts as long as the process
+        :param check Check every record round trips, on the runs that aren't cached
+
+        :type tables: dict
+        :type corpora: dict
+        :type modes: tuple
+        :rtype: list
+        :return: Evaluations, in table, corpus, mode order
+    """
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError('Unknown mode: %s, expected one of %s' % (mode, ', '.join(MODES)))
+    if cache is None:
+        cache = _CACHE
+    table_digests = dict((name, _digest(table)) for name, table in tables.items())
+    corpus_digests = dict((name, _digest(corpus)) for name, corpus in corpora.items())
+    results = []
+    for table_name in sorted(tables):
+        for corpus_name in sorted(corpora):
+            for mode in modes:
+                key = '%s:%s:%s' % (table_digests[table_name], corpus_digests[corpus_name], mode)
+                fields = cache.get(key)
+                if fields is None:
+                    result = evaluate_one(tables[table_name], corpora[corpus_name], mode, table_name, corpus_name,
+                                          check)
+                    cache[key] = tuple(result[3:])
+                else:
+                    result = Evaluation(table_name, corpus_name, mode, *fields)
+                results.append(result)
+    return results
+
+
+def format_results(results):
+    """ The results as a table, one line per evaluation
+
+        :type results: list
+        :rtype: str
+    """
+    lines = ['%-12s %-22s %-16s %10s %10s %10s %7s %8s %5s' % ('table', 'corpus', 'mode', 'plain', 'compressed',
+                                                              'saved', 'ratio', 'MB/s', 'dead')]
+    for result in results:
+        lines.append('%-12s %-22s %-16s %10d %10d %10d %7.3f %8.2f %5d' % (
+            result.table, result.corpus, result.mode, result.plain_bytes, result.compressed_bytes, result.bytes_saved,
+            result.ratio, result.megabytes_per_second, len(result.dead_entries)))
+    return '\n'.join(lines)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+A length prefixed framing protocol for streams of SMAZ compressed messages, with wrappers for asyncio streams and file
+objects.
+
+Frame format
+------------
+
+  varint(payload length << 1 | has dictionary id)
+  varint(dictionary id)    - only present if the low bit above is set
+  payload                  - compress output, as bytes
+
+Varints are little endian base 128, as in protocol buffers. Messages without a dictionary id use the built in SMAZ
+table, otherwise the id is looked up in the dictionaries mapping (id -> decode table) passed to the reader and writer.
+
+Writers buffer frames until flushed, so a batch of messages goes out in a single write. Readers parse frames straight
+out of their receive buffer through memoryviews, without copying each frame.
+
+Usage
+-----
+
+reader, writer = await asyncio.open_connection(host, port)
+smaz_writer = SmazStreamWriter(writer)
+smaz_writer.write_many(['Hello', 'World'])
+await smaz_writer.drain()
+async for message in SmazStreamReader(reader):
+    print(message)
+
+Python 3.7+ only.
+"""
+
+from smaz import compress, decompress, make_trie, _str_to_bytes
+
+__author__ = "Max Smith"
+
+MAX_FRAME_SIZE = 1 << 24  # Refuse frames bigger than this, guards against garbage or hostile length prefixes
+READ_SIZE = 1 << 16       # Bytes to read from the underlying stream at a time
+
+
+def encode_varint(value):
+    """ Encode a non-negative int as a base 128 varint
+
+        :type value: int
+        :rtype: bytes
+    """
+    if value < 0:
+        raise ValueError('Varints must be non-negative: %d' % value)
+    output = bytearray()
+    while value > 0x7f:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
+
+
+def decode_varint(buff, pos=0):
+    """ Decode a varint from buff at pos
+
+        :type buff: bytes or bytearray or memoryview
+        :type pos: int
+
+        :rtype: tuple
+        :return: (value, position after the varint), or None if buff ends before the varint does
+    """
+    value = shift = 0
+    buff_len = len(buff)
+    while pos < buff_len:
+        byte = buff[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError('Invalid varint - too long')
+    return None
+
+
+def encode_frame(payload, dict_id=None):
+    """ Frame an already compressed payload
+
+        :type payload: bytes
+        :type dict_id: int
+
+        :rtype: bytes
+    """
+    if dict_id is None:
+        return encode_varint(len(payload) << 1) + payload
+    else:
+        return encode_varint(len(payload) << 1 | 1) + encode_varint(dict_id) + payload
+
+
+def parse_frames(buff, max_frame_size=MAX_FRAME_SIZE):
+    """ Parse the complete frames at the start of buff. The payloads are memoryview slices of buff, release them
+        (or let them go) before resizing a bytearray buff.
+
+        :type buff: bytes or bytearray or memoryview
+        :type max_frame_size: int
+
+        :rtype: tuple
+        :return: (list of (dict_id, payload memoryview), number of bytes consumed)
+    """
+    view = memoryview(buff)
+    frames = []
+    pos = 0
+    while True:
+        header = decode_varint(view, pos)
+        if header is None:
+            break
+        header, payload_pos = header
+        dict_id = None
+        if header & 1:
+            dict_id = decode_varint(view, payload_pos)
+            if dict_id is None:
+                break
+            dict_id, payload_pos = dict_id
+        payload_len = header >> 1
+        if payload_len > max_frame_size:
+            raise ValueError('Frame too large: %d bytes' % payload_len)
+        if payload_pos + payload_len > len(view):
+            break
+        frames.append((dict_id, view[payload_pos:payload_pos + payload_len]))
+        pos = payload_pos + payload_len
+    return frames, pos
+
+
+class _FrameEncoder(object):
+    """ Shared message -> frame logic for the writers """
+
+    def __init__(self, dictionaries=None):
+        self.dictionaries = dictionaries or {}
+        self._trees = {}
+        self._buffer = bytearray()
+
+    def _tree(self, dict_id):
+        if dict_id is None:
+            return None
+        tree = self._trees.get(dict_id)
+        if tree is None:
+            tree = self._trees[dict_id] = make_trie(self.dictionaries[dict_id])
+        return tree
+
+    def write(self, message, dict_id=None):
+        """ Compress and buffer a message, it isn't sent until the buffer is flushed
+
+            :type message: str
+            :type dict_id: int
+        """
+        payload = _str_to_bytes(compress(message, compression_tree=self._tree(dict_id)) or '')
+        self._buffer += encode_frame(payload, dict_id)
+
+    def write_many(self, messages, dict_id=None):
+        """ Compress and buffer a batch of messages """
+        for message in messages:
+            self.write(message, dict_id)
+
+    def _take_buffer(self):
+        data = self._buffer  # Handed over, not copied, a fresh buffer takes its place
+        self._buffer = bytearray()
+        return data
+
+
+class _FrameDecoder(object):
+    """ Shared frame -> message logic for the readers """
+
+    def __init__(self, dictionaries=None, max_frame_size=MAX_FRAME_SIZE):
+        self.dictionaries = dictionaries or {}
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._messages = []
+        self._next_message = 0
+
+    def _feed(self, data):
+        """ Add received bytes, and decode any complete frames """
+        self._buffer += data
+        frames, consumed = parse_frames(self._buffer, self.max_frame_size)
+        if self._next_message:
+            del self._messages[:self._next_message]
+            self._next_message = 0
+        self._messages.extend(self._decode(dict_id, payload) for dict_id, payload in frames)
+        frames = None  # Release the views into the buffer, so it can be resized
+        del self._buffer[:consumed]
+
+    def _decode(self, dict_id, payload):
+        table = None if dict_id is None else self.dictionaries[dict_id]
+        return decompress(str(payload, 'latin-1'), decompress_table=table)
+
+    def _pop_message(self):
+        if self._next_message < len(self._messages):
+            self._next_message += 1
+            return True, self._messages[self._next_message - 1]
+        return False, None
+
+    def _check_eof(self):
+        if self._buffer:
+            raise ValueError('Stream ended part way through a frame')
+
+
+class SmazStreamWriter(_FrameEncoder):
+    """ Writes SMAZ framed messages to an asyncio.StreamWriter. write and write_many only buffer, drain sends
+        everything buffered in one write and waits for the transport.
+
+        :param writer An asyncio.StreamWriter
+        :param dictionaries Mapping of dictionary id -> decode table for messages written with a dict_id
+    """
+
+    def __init__(self, writer, dictionaries=None):
+        super(SmazStreamWriter, self).__init__(dictionaries)
+        self.writer = writer
+
+    async def drain(self):
+        if self._buffer:
+            self.writer.write(self._take_buffer())
+        await self.writer.drain()
+
+    async def send(self, message, dict_id=None):
+        """ Write a single message and drain """
+        self.write(message, dict_id)
+        await self.drain()
+
+    async def close(self):
+        await self.drain()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class SmazStreamReader(_FrameDecoder):
+    """ Reads SMAZ framed messages from an asyncio.StreamReader. Also an async iterator over the messages.
+
+        :param reader An asyncio.StreamReader
+        :param dictionaries Mapping of dictionary id -> decode table for messages with a dictionary id
+        :param max_frame_size Refuse frames bigger than this
+    """
+
+    def __init__(self, reader, dictionaries=None, max_frame_size=MAX_FRAME_SIZE):
+        super(SmazStreamReader, self).__init__(dictionaries, max_frame_size)
+        self.reader = reader
+
+    async def read_message(self):
+        """ :rtype: str
+            :return: The next message, or None at the end of the stream
+        """
+        while True:
+            found, message = self._pop_message()
+            if found:
+                return message
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                self._check_eof()
+                return None
+            self._feed(data)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.read_message()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+class SmazFileWriter(_FrameEncoder):
+    """ The synchronous equivalent of SmazStreamWriter, for binary file objects """
+
+    def __init__(self, fileobj, dictionaries=None):
+        super(SmazFileWriter, self).__init__(dictionaries)
+        self.fileobj = fileobj
+
+    def flush(self):
+        if self._buffer:
+            self.fileobj.write(self._take_buffer())
+        self.fileobj.flush()
+
+
+class SmazFileReader(_FrameDecoder):
+    """ The synchronous equivalent of SmazStreamReader, for binary file objects. Also an iterator over the messages. """
+
+    def __init__(self, fileobj, dictionaries=None, max_frame_size=MAX_FRAME_SIZE):
+        super(SmazFileReader, self).__init__(dictionaries, max_frame_size)
+        self.fileobj = fileobj
+
+    def read_message(self):
+        """ :rtype: str
+            :return: The next message, or None at the end of the file
+        """
+        while True:
+            found, message = self._pop_message()
+            if found:
+                return message
+            data = self.fileobj.read(READ_SIZE)
+            if not data:
+                self._check_eof()
+                return None
+            self._feed(data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        message = self.read_message()
+        if message is None:
+            raise StopIteration
+        return message
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+A profiling build of compress and decompress, switched on at runtime, which adds up wall clock time and call counts
+per phase of the codec across many calls. Use it to see where the time goes when throughput drops, without running
+everything under cProfile.
+
+While a Profile is enabled, every compress and decompress call in the process (from any thread) runs the codec with
+a lap of the clock at each phase boundary, which gives identical output. Times include the cost of reading the clock,
+which is noticeable in the per token phases, so compare phases against each other rather than against unprofiled
+throughput. Totals from several threads are approximate, as they're added up without a lock.
+
+Phases
+------
+
+  compress      check_ascii, utf8_encode, case_folding, trie_walk, backtracking, encapsulate, join, worst_size_check
+  decompress    decode, verbatim, case_folding, join, utf8_decode, check_ascii, buffer (all of a bytes-like input)
+
+Usage
+-----
+
+with profile() as prof:
+    for message in messages:
+        compress(message)
+print(prof.format())
+
+Or profile the tests/data corpora from the command line:
+
+python -m smaz.profiling tests/data/alice29.txt tests/data/sms_corpus-NUS.txt --lines
+"""
+
+import contextlib
+import sys
+
+import smaz
+from smaz import _compress, _decompress, _timer, _bytes_to_str, _decompress_buffer, _BUFFER_TYPES, BACKTRACK_LIMIT, \
+    UTF8_DECODE
+
+__author__ = "Max Smith"
+
+COMPRESS_PHASES = ('check_ascii', 'utf8_encode', 'case_folding', 'trie_walk', 'backtracking', 'encapsulate', 'join',
+                   'worst_size_check')
+DECOMPRESS_PHASES = ('decode', 'verbatim', 'case_folding', 'join', 'utf8_decode', 'check_ascii', 'buffer')
+
+
+class Profile(object):
+    """ Per phase totals for compress and decompress calls made while enabled, see enable and profile.
+
+        For each function, totals[function] is [calls, seconds, input length, output length], and phases[function]
+        maps phase -> [seconds, count], where count is how many times the phase was entered.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.phases = {}
+        self.reset()
+
+    def reset(self):
+        """ Zero all the totals """
+        for function, names in (('compress', COMPRESS_PHASES), ('decompress', DECOMPRESS_PHASES)):
+            self.totals[function] = [0, 0.0, 0, 0]
+            self.phases[function] = dict((name, [0.0, 0]) for name in names)
+
+    def _add(self, function, seconds, input_len, output_len, phase_times, phase_counts):
+        totals = self.totals[function]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += input_len
+        totals[3] += output_len
+        phases = self.phases[function]
+        for name, phase_time in phase_times.items():
+            if phase_counts[name]:
+                phase = phases[name]
+                phase[0] += phase_time
+                phase[1] += phase_counts[name]
+
+    def report(self):
+        """ The totals as plain data
+
+            :rtype: dict
+            :return: function -> {'calls', 'seconds', 'input_bytes', 'output_bytes', 'megabytes_per_second',
+                     'phases': phase -> {'seconds', 'count', 'share'}}, share being the fraction of the function's time
+        """
+        result = {}
+        for function, (calls, seconds, input_len, output_len) in self.totals.items():
+            phases = {}
+            for name, (phase_time, count) in self.phases[function].items():
+                phases[name] = {'seconds': phase_time, 'count': count,
+                                'share': phase_time / seconds if seconds else 0.0}
+            result[function] = {'calls': calls, 'seconds': seconds, 'input_bytes': input_len,
+                                'output_bytes': output_len, 'phases': phases,
+                                'megabytes_per_second': input_len / seconds / 1e6 if seconds else 0.0}
+        return result
+
+    def format(self):
+        """ The report as a table, phases in order of time taken
+
+            :rtype: str
+        """
+        lines = []
+        for function, stats in sorted(self.report().items()):
+            if not stats['calls']:
+                continue
+            lines.append('%s: %d calls, %.4f seconds, %d -> %d bytes, %.2f MB/s' % (
+                function, stats['calls'], stats['seconds'], stats['input_bytes'], stats['output_bytes'],
+                stats['megabytes_per_second']))
+            for name, phase in sorted(stats['phases'].items(), key=lambda item: -item[1]['seconds']):
+                if phase['count']:
+                    lines.append('  %-18s %10.4f s %6.1f%% %10d' % (name, phase['seconds'], phase['share'] * 100,
+                                                                     phase['count']))
+        return '\n'.join(lines)
+
+    def enable(self):
+        """ Route compress and decompress through the profiling build, adding to this Profile """
+        smaz._PROFILER = self
+        return self
+
+    @staticmethod
+    def disable():
+        """ Go back to the normal codec """
+        smaz._PROFILER = None
+
+    def compress(self, input_str, check_ascii=True, raise_on_error=True, compression_tree=None, backtracking=True,
+                 pathological_case_detection=True, backtrack_limit=BACKTRACK_LIMIT, matcher=None, case_folding=False,
+                 utf8=False, utf8_table=None, adaptive=False):
+        """ smaz.compress, timed by phase, see there for the parameters """
+        if not input_str:
+            return input_str
+        times = dict.fromkeys(COMPRESS_PHASES, 0.0)
+        counts = dict.fromkeys(COMPRESS_PHASES, 0)
+        input_len = len(input_str)
+        start = _timer()
+        output = _compress(input_str, check_ascii, raise_on_error, compression_tree, backtracking,
+                           pathological_case_detection, backtrack_limit, matcher, case_folding, utf8, utf8_table,
+                           adaptive, times, counts)
+        self._add('compress', _timer() - start, input_len, len(output or ''), times, counts)
+        return output
+
+    def decompress(self, input_str, raise_on_error=True, check_ascii=False, decompress_table=None, case_folding=False,
+                   utf8=False, utf8_table=None):
+        """ smaz.decompress, timed by phase, see there for the parameters. Buffer input is timed as a whole,
+            as the buffer phase.
+        """
+        times = dict.fromkeys(DECOMPRESS_PHASES, 0.0)
+        counts = dict.fromkeys(DECOMPRESS_PHASES, 0)
+        start = _timer()
+        if isinstance(input_str, _BUFFER_TYPES):
+            output = _decompress_buffer(input_str, raise_on_error, check_ascii, decompress_table, case_folding, utf8,
+                                        utf8_table)
+            times['buffer'] = _timer() - start
+            counts['buffer'] = 1
+        elif not input_str:
+            return input_str
+        else:
+            output = _decompress(input_str, raise_on_error, check_ascii, decompress_table, case_folding, utf8,
+                                 utf8_table, times, counts)
+        self._add('decompress', _timer() - start, len(input_str), len(output or ''), times, counts)
+        return output
+
+
+def enable(prof=None):
+    """ Start profiling every compress and decompress call
+
+        :type prof: Profile
+        :param prof Profile to add to, by default a new one
+
+        :rtype: Profile
+    """
+    return (prof or Profile()).enable()
+
+
+def disable():
+    """ Stop profiling """
+    Profile.disable()
+
+
+@contextlib.contextmanager
+def profile(prof=None):
+    """ Context manager, profiles the calls made inside the with block, then puts back whatever was enabled before
+
+        :type prof: Profile
+        :param prof Profile to add to, by default a new one
+    """
+    previous = smaz._PROFILER
+    prof = enable(prof)
+    try:
+        yield prof
+    finally:
+        smaz._PROFILER = previous
+
+
+def profile_corpus(paths, lines=False, prof=None, **kwargs):
+    """ Compress and decompress files (such as the tests/data corpora) under a Profile, checking the round trip.
+        Non-ASCII characters are dropped, unless utf8=True is passed, when files are read as UTF-8.
+
+        :param paths Files to run through the codec
+        :param lines One call per line rather than per file
+        :param prof Profile to add to, by default a new one
+        :param kwargs Passed to compress, utf8, case_folding and decompress_table are passed on to decompress too
+
+        :type paths: list
+        :type lines: bool
+        :type prof: Profile
+        :rtype: Profile
+    """
+    decompress_kwargs = dict((key, kwargs[key]) for key in ('utf8', 'utf8_table', 'case_folding') if key in kwargs)
+    if kwargs.get('compression_tree') is not None:
+        raise ValueError('Pass decompress_table rather than compression_tree, so the round trip can be checked')
+    decode_table = kwargs.pop('decompress_table', None)
+    if decode_table is not None:
+        decompress_kwargs['decompress_table'] = decode_table
+        if kwargs.get('utf8'):
+            utf8_table = kwargs.get('utf8_table')
+            kwargs['compression_tree'] = smaz.make_trie(decode_table, UTF8_DECODE if utf8_table is None else utf8_table)
+        else:
+            kwargs['compression_tree'] = smaz.make_trie(decode_table)
+    with profile(prof) as prof:
+        for path in paths:
+            with open(path, 'rb') as f:
+                text = f.read().decode('utf-8' if kwargs.get('utf8') else 'latin-1', 'replace')
+            if not kwargs.get('utf8'):
+                text = _bytes_to_str(text.encode('ascii', 'ignore'))
+            for record in (text.split('\n') if lines else [text]):
+                if smaz.decompress(smaz.compress(record, **kwargs), **decompress_kwargs) != record:
+                    raise ValueError('Round trip failed for a record in %s' % path)
+    return prof
+
+
+def main(argv=None):
+    """ Entry point for python -m smaz.profiling, prints the report for the files named in argv """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m smaz.profiling',
+                                     description='Per phase timings of compress and decompress over files')
+    parser.add_argument('paths', nargs='+', help='Files to profile, such as the tests/data corpora')
+    parser.add_argument('--lines', action='store_true', help='One call per line rather than per file')
+    parser.add_argument('--utf8', action='store_true', help='Use compress(utf8=True)')
+    parser.add_argument('--no-backtracking', action='store_true', help='Use compress(backtracking=False)')
+    parser.add_argument('--adaptive', action='store_true', help='Use compress(adaptive=True)')
+    args = parser.parse_args(argv)
+    prof = profile_corpus(args.paths, lines=args.lines, utf8=args.utf8, backtracking=not args.no_backtracking,
+                          adaptive=args.adaptive)
+    sys.stdout.write(prof.format() + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+A compact binary codec for JSON-like records (dicts, lists, strings, numbers, booleans and None) where the string values
+are short text. Each string value is compressed on its own with SMAZ, optionally with a table trained for its field, and
+keys are written as small integer ids from a schema instead of repeating the key text in every record.
+
+Decoding is lazy: decode returns a read only mapping that finds fields by skipping over the others, and only
+decompresses a value when it is accessed.
+
+Format
+------
+
+  value  - tag byte, then:
+    NONE, FALSE, TRUE   - nothing
+    INT                 - zigzag varint
+    FLOAT               - 8 byte little endian double
+    STRING              - varint length, compress(value, utf8=True) output
+    LIST                - varint length, varint count, values
+    DICT                - varint length, varint count, (key, value) pairs
+
+  key    - varint(schema id + 1), or 0 followed by varint length and the UTF-8 key for keys not in the schema
+
+Varints are as in smaz.framing. The length in front of lists and dicts lets a reader skip them without parsing.
+
+Usage
+-----
+
+schema = Schema(['name', 'url', 'status'], tables={'url': URL_TABLE})
+data = schema.encode({'name': 'Salvatore', 'url': 'http://github.com/antirez/smaz', 'status': 'active'})
+record = schema.decode(data)
+record['status']  # Only this value is decompressed
+
+Python 3.7+ only.
+"""
+
+import struct
+from collections.abc import Mapping
+
+from smaz import compress, decompress, make_trie, UTF8_DECODE, _str_to_bytes
+from smaz.framing import encode_varint, decode_varint
+
+__author__ = "Max Smith"
+
+NONE, FALSE, TRUE, INT, FLOAT, STRING, LIST, DICT = range(8)
+
+_DOUBLE = struct.Struct('<d')
+_MAX_INT = 1 << 63  # Varints are limited to 64 bits
+
+
+def _read_varint(view, pos):
+    result = decode_varint(view, pos)
+    if result is None:
+        raise ValueError('Invalid record - truncated varint')
+    return result
+
+
+def _skip(view, pos):
+    """ Position just after the value starting at pos """
+    tag = view[pos]
+    pos += 1
+    if tag <= TRUE:
+        return pos
+    elif tag == INT:
+        return _read_varint(view, pos)[1]
+    elif tag == FLOAT:
+        return pos + _DOUBLE.size
+    elif tag <= DICT:
+        length, pos = _read_varint(view, pos)
+        return pos + length
+    raise ValueError('Invalid record - unknown tag %d' % tag)
+
+
+class Schema(object):
+    """ Maps keys to small integer ids, and fields to the decode tables their string values are compressed with.
+        Readers and writers must use the same schema, add new keys to the end of fields to stay compatible.
+
+        :param fields Key names, in id order
+        :param tables Mapping of key -> decode table, for string values under that key (at any depth). Other strings
+                      use the SMAZ table.
+
+        :type fields: list
+        :type tables: dict
+    """
+
+    def __init__(self, fields, tables=None):
+        self.fields = list(fields)
+        self._ids = dict((name, field_id) for field_id, name in enumerate(self.fields))
+        if len(self._ids) != len(self.fields):
+            raise ValueError('Duplicate keys in schema fields')
+        self.tables = dict(tables or {})
+        self._trees = dict((name, make_trie(table, UTF8_DECODE)) for name, table in self.tables.items())
+
+    @classmethod
+    def from_records(cls, records, tables=None):
+        """ Build a schema from sample records, with the most common keys getting the smallest ids """
+        counts = {}
+
+        def count(value):
+            if isinstance(value, dict):
+                for key, child in value.items():
+                    counts[key] = counts.get(key, 0) + 1
+                    count(child)
+            elif isinstance(value, (list, tuple)):
+                for child in value:
+                    count(child)
+        for record in records:
+            count(record)
+        return cls(sorted(counts, key=lambda key: (-counts[key], key)), tables)
+
+    def encode(self, record):
+        """ :type record: dict
+            :rtype: bytes
+        """
+        output = bytearray()
+        self._encode_value(record, None, output)
+        return bytes(output)
+
+    def decode(self, data):
+        """ Decode lazily, dicts are returned as LazyRecord mappings which decode each field on first access
+
+            :type data: bytes
+        """
+        view = memoryview(data)
+        value, end = self._decode_value(view, 0, None)
+        if end != len(view):
+            raise ValueError('Invalid record - trailing data')
+        return value
+
+    def _encode_value(self, value, field, output):
+        if value is None:
+            output.append(NONE)
+        elif value is True:
+            output.append(TRUE)
+        elif value is False:
+            output.append(FALSE)
+        elif isinstance(value, int):
+            if not -_MAX_INT <= value < _MAX_INT:
+                raise ValueError('Integer out of range for a record: %d' % value)
+            output.append(INT)
+            output += encode_varint(value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            output.append(FLOAT)
+            output += _DOUBLE.pack(value)
+        elif isinstance(value, str):
+            tree = self._trees.get(field)
+            payload = _str_to_bytes(compress(value, utf8=True, compression_tree=tree))
+            output.append(STRING)
+            output += encode_varint(len(payload))
+            output += payload
+        elif isinstance(value, (list, tuple)):
+            body = bytearray(encode_varint(len(value)))
+            for child in value:
+                self._encode_value(child, field, body)
+            output.append(LIST)
+            output += encode_varint(len(body))
+            output += body
+        elif isinstance(value, dict):
+            body = bytearray(encode_varint(len(value)))
+            for key, child in value.items():
+                field_id = self._ids.get(key)
+                if field_id is not None:
+                    body += encode_varint(field_id + 1)
+                elif isinstance(key, str):
+                    key_bytes = key.encode('utf-8')
+                    body.append(0)
+                    body += encode_varint(len(key_bytes))
+                    body += key_bytes
+                else:
+                    raise ValueError('Record keys must be strings: %r' % (key,))
+                self._encode_value(child, key, body)
+            output.append(DICT)
+            output += encode_varint(len(body))
+            output += body
+        else:
+            raise ValueError('Unsupported type in record: %s' % type(value).__name__)
+
+    def _decode_key(self, view, pos):
+        field_id, pos = _read_varint(view, pos)
+        if field_id:
+            try:
+                return self.fields[field_id - 1], pos
+            except IndexError:
+                raise ValueError('Invalid record - key id %d not in schema' % (field_id - 1))
+        length, pos = _read_varint(view, pos)
+        return str(view[pos:pos + length], 'utf-8'), pos + length
+
+    def _decode_value(self, view, pos, field):
+        """ :return: (value, position after it) """
+        tag = view[pos]
+        pos += 1
+        if tag == NONE:
+            return None, pos
+        elif tag == FALSE:
+            return False, pos
+        elif tag == TRUE:
+            return True, pos
+        elif tag == INT:
+            value, pos = _read_varint(view, pos)
+            return (value >> 1) ^ -(value & 1), pos
+        elif tag == FLOAT:
+            return _DOUBLE.unpack_from(view, pos)[0], pos + _DOUBLE.size
+        length, pos = _read_varint(view, pos)
+        end = pos + length
+        if end > len(view):
+            raise ValueError('Invalid record - truncated value')
+        if tag == STRING:
+            return decompress(view[pos:end], utf8=True, decompress_table=self.tables.get(field)), end
+        elif tag == LIST:
+            count, pos = _read_varint(view, pos)
+            output = []
+            for _ in range(count):
+                value, pos = self._decode_value(view, pos, field)
+                output.append(value)
+            return output, end
+        elif tag == DICT:
+            return LazyRecord(self, view[pos:end]), end
+        raise ValueError('Invalid record - unknown tag %d' % tag)
+
+
+class LazyRecord(Mapping):
+    """ A read only mapping over an encoded dict. Keys are indexed on first use by skipping over the values, and each
+        value is decoded (and cached) the first time it is accessed.
+    """
+    __slots__ = ('schema', '_view', '_index', '_cache')
+
+    def __init__(self, schema, view):
+        self.schema = schema
+        self._view = view
+        self._index = None
+        self._cache = {}
+
+    def _build_index(self):
+        view = self._view
+        count, pos = _read_varint(view, 0)
+        index = {}
+        for _ in range(count):
+            key, pos = self.schema._decode_key(view, pos)
+            index[key] = pos
+            pos = _skip(view, pos)
+        if pos != len(view):
+            raise ValueError('Invalid record - bad dict length')
+        self._index = index
+        return index
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if self._index is None:
+            self._build_index()
+        pos = self._index[key]
+        value = self._cache[key] = self.schema._decode_value(self._view, pos, key)[0]
+        return value
+
+    def __iter__(self):
+        if self._index is None:
+            self._build_index()
+        return iter(self._index)
+
+    def __len__(self):
+        if self._index is None:
+            self._build_index()
+        return len(self._index)
+
+    def to_dict(self):
+        """ Decode everything, into plain dicts and lists """
+        return dict((key, _to_plain(self[key])) for key in self)
+
+    def __repr__(self):
+        return 'LazyRecord(%r)' % self.to_dict()
+
+
+def _to_plain(value):
+    if isinstance(value, LazyRecord):
+        return value.to_dict()
+    elif isinstance(value, list):
+        return [_to_plain(x) for x in value]
+    return value
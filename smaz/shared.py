@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Flat SMAZ tables in shared memory or a memory mapped file, so a fleet of worker processes can share one copy of a
+dictionary instead of each building its own trie out of Python lists.
+
+A SharedTable is both a matcher (pass it as the matcher argument of compress and compress_classic) and a source of
+decode tables (pass table.decode_table as the decompress_table argument of decompress). The trie is walked straight
+out of the shared buffer through a memoryview, nothing is rebuilt when a process attaches.
+
+Layout
+------
+
+All fields are native endian uint32.
+
+  header    - magic, version, byte order check, entry count, node count, trie offset, entries offset, data offset
+  trie      - node count * 256 slots, slot for ord(ch) is (child node << 9) | 0x100 if an entry ends here | code
+  entries   - entry count + 1 offsets into data
+  data      - the decode table entries, latin-1 encoded, back to back
+
+Usage
+-----
+
+# In the parent
+table = SharedTable.create(MY_DECODE)
+
+# In a worker - or pass table to it, it pickles as a reference to the shared memory
+table = SharedTable.attach(name)
+compressed = compress(text, matcher=table)
+text = decompress(compressed, decompress_table=table.decode_table)
+
+Python 3.8+ only.
+"""
+
+import mmap
+import struct
+import sys
+from multiprocessing import shared_memory
+
+from smaz import DECODE, make_trie
+
+__author__ = "Max Smith"
+
+MAGIC = 0x545a4d53  # 'SMZT'
+VERSION = 1
+_BYTE_ORDER_CHECK = 0x01020304
+_HEADER = struct.Struct('=8I')
+
+
+def pack_table(decode_table=None):
+    """ Flatten decode_table, and the trie make_trie builds from it, into the shared layout
+
+        :type decode_table: list
+        :param decode_table Decode table to pack, by default uses SMAZ
+
+        :rtype: bytes
+    """
+    decode_table = decode_table or DECODE
+    tree = make_trie(decode_table)
+
+    # Number the nodes with children breadth first, the root is node 0 - which is never a child, so 0 means no child
+    nodes = [tree]
+    numbers = {id(tree): 0}
+    for node in nodes:
+        for child in node:
+            if child is not None and child[1] is not None:
+                numbers[id(child[1])] = len(nodes)
+                nodes.append(child[1])
+
+    trie = []
+    for node in nodes:
+        for child in node:
+            if child is None:
+                trie.append(0)
+            else:
+                byte_val, children = child
+                slot = 0 if children is None else numbers[id(children)] << 9
+                if byte_val is not None:
+                    slot |= 0x100 | ord(byte_val)
+                trie.append(slot)
+
+    data = [sstr.encode('latin-1') for sstr in decode_table]
+    offsets = [0]
+    for entry in data:
+        offsets.append(offsets[-1] + len(entry))
+
+    trie_pos = _HEADER.size
+    entries_pos = trie_pos + 4 * len(trie)
+    data_pos = entries_pos + 4 * len(offsets)
+    header = _HEADER.pack(MAGIC, VERSION, _BYTE_ORDER_CHECK, len(decode_table), len(nodes), trie_pos, entries_pos,
+                          data_pos)
+    return b''.join((header, struct.pack('=%dI' % len(trie), *trie), struct.pack('=%dI' % len(offsets), *offsets),
+                     b''.join(data)))
+
+
+class SharedTable(object):
+    """ A read only view of a packed table in a buffer, see create, attach, write_file and open_file to make one.
+
+        :param buff A buffer holding pack_table output
+        :param owner The SharedMemory or mmap backing buff, closed by close
+    """
+
+    def __init__(self, buff, owner=None):
+        self._owner = owner
+        self._view = memoryview(buff)
+        if len(self._view) < _HEADER.size:
+            raise ValueError('Not a SMAZ shared table - too short')
+        magic, version, check, entry_count, node_count, trie_pos, entries_pos, data_pos = \
+            _HEADER.unpack_from(self._view)
+        if magic != MAGIC or check != _BYTE_ORDER_CHECK:
+            raise ValueError('Not a SMAZ shared table, or written on a machine with a different byte order')
+        if version != VERSION:
+            raise ValueError('Unsupported SMAZ shared table version: %d' % version)
+        self._trie = self._view[trie_pos:entries_pos].cast('I')
+        self._entries = self._view[entries_pos:data_pos].cast('I')
+        self._data = self._view[data_pos:]
+        self.entry_count = entry_count
+        self.node_count = node_count
+        self._decode_table = None
+        self._codes = None
+        self._reduce_args = None
+
+    @classmethod
+    def create(cls, decode_table=None, name=None):
+        """ Publish decode_table in a new block of shared memory. The creator should unlink it when the fleet is done.
+
+            :type decode_table: list
+            :type name: str
+            :param name Name for the shared memory block, by default one is generated
+
+            :rtype: SharedTable
+        """
+        packed = pack_table(decode_table)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=len(packed))
+        shm.buf[:len(packed)] = packed
+        table = cls(shm.buf[:len(packed)], shm)
+        table._reduce_args = (_attach, (shm.name,))
+        return table
+
+    @classmethod
+    def attach(cls, name):
+        """ Attach to a table published by create in another process
+
+            :type name: str
+            :rtype: SharedTable
+        """
+        table = cls(*_attach_buffer(name))
+        table._reduce_args = (_attach, (name,))
+        return table
+
+    @staticmethod
+    def write_file(path, decode_table=None):
+        """ Publish decode_table as a file, for open_file to map """
+        with open(path, 'wb') as f:
+            f.write(pack_table(decode_table))
+
+    @classmethod
+    def open_file(cls, path):
+        """ Map a file written by write_file, read only
+
+            :type path: str
+            :rtype: SharedTable
+        """
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table = cls(mapped, mapped)
+        table._reduce_args = (_open_file, (path,))
+        return table
+
+    @property
+    def name(self):
+        """ The shared memory name to attach to, or None if the table isn't in shared memory """
+        return getattr(self._owner, 'name', None)
+
+    def entry(self, code):
+        """ :rtype: str
+            :return: The decode table entry for code
+        """
+        if not 0 <= code < self.entry_count:
+            raise IndexError('No entry for code %d' % code)
+        return str(self._data[self._entries[code]:self._entries[code + 1]], 'latin-1')
+
+    @property
+    def decode_table(self):
+        """ The decode table as a list, for the decompress_table argument of decompress. Built on first use. """
+        if self._decode_table is None:
+            self._decode_table = [self.entry(code) for code in range(self.entry_count)]
+        return self._decode_table
+
+    @property
+    def codes(self):
+        """ Mapping of entry -> encoded byte, as Matcher.codes """
+        if self._codes is None:
+            self._codes = dict((sstr, chr(code)) for code, sstr in enumerate(self.decode_table) if sstr)
+        return self._codes
+
+    def tokenize(self, input_str):
+        """ Split input_str into longest matches and single unmatched characters, as Matcher.tokenize
+
+            :type input_str: str
+            :rtype: list
+        """
+        trie = self._trie
+        tokens = []
+        tokens_append = tokens.append
+        input_str_len = len(input_str)
+        pos = 0
+        while pos < input_str_len:
+            node = 0
+            enc_len = 1  # With no match the token is a single character
+            j = pos
+            while j < input_str_len:  # Walk the flat trie for the longest matching sequence
+                ch = ord(input_str[j])
+                if ch > 255:
+                    break
+                slot = trie[node + ch]
+                j += 1
+                if slot & 0x100:
+                    enc_len = j - pos
+                node = (slot >> 9) << 8
+                if not node:
+                    break
+            tokens_append(input_str[pos:pos + enc_len])
+            pos += enc_len
+        return tokens
+
+    def close(self):
+        """ Release this process's view of the table, the shared memory itself is left for unlink """
+        self._trie.release()
+        self._entries.release()
+        self._data.release()
+        self._view.release()
+        if self._owner is not None:
+            self._owner.close()  # Kept, so unlink still works after close
+
+    def unlink(self):
+        """ Free the shared memory block, call once from the creator when no process needs the table any more. Can be
+            called before or after close.
+        """
+        if self._owner is not None and hasattr(self._owner, 'unlink'):
+            self._owner.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __reduce__(self):
+        """ Pickle as a reference to the shared memory or file, so workers attach rather than copy """
+        if self._reduce_args is None:
+            raise TypeError('Only tables in shared memory or a file can be pickled')
+        return self._reduce_args
+
+
+def _attach_buffer(name):
+    """ Open the shared memory name, without registering it for cleanup when this process exits """
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        # noinspection PyProtectedMember
+        resource_tracker.unregister(shm._name, 'shared_memory')  # Owned by the creator, not us
+    return shm.buf, shm
+
+
+def _attach(name):
+    return SharedTable.attach(name)
+
+
+def _open_file(path):
+    return SharedTable.open_file(path)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Transparent SMAZ compression of short text values in sqlite3 databases and dbm key-value stores.
+
+Values are stored as compress(value, utf8=True) output, so any text can be stored, and the ASCII parts compress.
+
+sqlite3
+-------
+
+register_sqlite() registers an adapter for SmazText values and a converter for columns declared SMAZ:
+
+register_sqlite()
+conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, body SMAZ)')
+conn.execute('INSERT INTO messages (body) VALUES (?)', (SmazText('Hello World'),))
+conn.execute('SELECT body FROM messages').fetchone()[0]  # 'Hello World'
+
+install_functions(conn) adds smaz_compress() and smaz_decompress() SQL functions, for use in queries, and
+executemany() compresses whole batches through compress_many.
+
+dbm
+---
+
+with SmazDbm(dbm.open(path, 'c')) as db:
+    db['greeting'] = 'Hello World'
+
+shelve isn't covered - its values are pickles, which SMAZ can't shrink.
+
+Python 3 only.
+"""
+
+import collections
+from collections.abc import MutableMapping
+
+from smaz import compress, decompress, compress_many, _str_to_bytes
+
+__author__ = "Max Smith"
+
+SQLITE_TYPE = 'SMAZ'  # Declared column type picked up by the converter, with detect_types=sqlite3.PARSE_DECLTYPES
+
+# Empty text is stored as this, a truncated escape that compress never outputs, because sqlite3 hands zero length values
+# to converters as None
+EMPTY_VALUE = b'\xfe'
+
+Savings = collections.namedtuple('Savings', ['values', 'plain_bytes', 'stored_bytes'])
+
+
+def encode_value(text):
+    """ Compress text to the bytes stored
+
+        :type text: str
+        :rtype: bytes
+    """
+    return _str_to_bytes(compress(text, utf8=True)) if text else EMPTY_VALUE
+
+
+def decode_value(data):
+    """ Decompress stored bytes back to text
+
+        :type data: bytes or memoryview
+        :rtype: str
+    """
+    return decompress(data, utf8=True) if data != EMPTY_VALUE else u''
+
+
+def encode_values(texts, threads=None):
+    """ encode_value for a batch, through compress_many
+
+        :type texts: list
+        :type threads: int
+        :rtype: list
+    """
+    return [_str_to_bytes(x) if x else EMPTY_VALUE for x in compress_many(texts, threads=threads, utf8=True)]
+
+
+class SmazText(str):
+    """ Marks a value to be stored compressed by the sqlite3 adapter """
+    __slots__ = ()
+
+
+def register_sqlite(sqlite3_module=None):
+    """ Register the SmazText adapter and the SMAZ column type converter with sqlite3 (module wide) """
+    if sqlite3_module is None:
+        import sqlite3 as sqlite3_module
+    sqlite3_module.register_adapter(SmazText, encode_value)
+    sqlite3_module.register_converter(SQLITE_TYPE, decode_value)
+
+
+def install_functions(conn):
+    """ Add smaz_compress(text) and smaz_decompress(blob) SQL functions to a connection. NULLs pass through. """
+    def sql_compress(text):
+        return None if text is None else encode_value(text)
+
+    def sql_decompress(data):
+        return None if data is None else decode_value(data)
+
+    try:
+        conn.create_function('smaz_compress', 1, sql_compress, deterministic=True)
+        conn.create_function('smaz_decompress', 1, sql_decompress, deterministic=True)
+    except TypeError:  # deterministic is 3.8+
+        conn.create_function('smaz_compress', 1, sql_compress)
+        conn.create_function('smaz_decompress', 1, sql_decompress)
+
+
+def executemany(conn, sql, rows, columns, threads=None):
+    """ conn.executemany, with the given columns of each row compressed as one batch
+
+        :param conn A sqlite3 connection
+        :param sql The statement, as for executemany
+        :param rows Parameter sequences
+        :param columns Indexes of the parameters to compress
+        :param threads Passed to compress_many
+
+        :type rows: list
+        :type columns: list
+    """
+    rows = [list(row) for row in rows]
+    for column in columns:
+        texts = [row[column] for row in rows]
+        present = [i for i, text in enumerate(texts) if text is not None]
+        for i, data in zip(present, encode_values([texts[i] for i in present], threads)):
+            rows[i][column] = data
+    return conn.executemany(sql, rows)
+
+
+def sqlite_savings(conn, table, column):
+    """ Measure the space saved in a compressed column
+
+        :type table: str
+        :type column: str
+        :rtype: Savings
+    """
+    values = plain_bytes = stored_bytes = 0
+    for data, in conn.execute('SELECT CAST("%s" AS BLOB) FROM "%s" WHERE "%s" IS NOT NULL' % (column, table, column)):
+        values += 1
+        stored_bytes += len(data)
+        plain_bytes += len(decode_value(data).encode('utf-8'))
+    return Savings(values, plain_bytes, stored_bytes)
+
+
+class SmazDbm(MutableMapping):
+    """ A dbm style key-value store with text values compressed transparently. Keys are passed through untouched.
+
+        :param db A dbm object, or anything else mapping keys to bytes
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, key):
+        return decode_value(self.db[key])
+
+    def __setitem__(self, key, value):
+        self.db[key] = encode_value(value)
+
+    def __delitem__(self, key):
+        del self.db[key]
+
+    def __iter__(self):
+        return iter(self.db.keys())
+
+    def __len__(self):
+        return len(self.db)
+
+    def __contains__(self, key):
+        return key in self.db
+
+    def update_many(self, items, threads=None):
+        """ Store many (key, value) pairs, compressing the values as one batch through compress_many """
+        items = list(items.items() if hasattr(items, 'items') else items)
+        for (key, _), data in zip(items, encode_values([value for _, value in items], threads)):
+            self.db[key] = data
+
+    def savings(self):
+        """ :rtype: Savings """
+        values = plain_bytes = stored_bytes = 0
+        for key in self.db.keys():
+            data = self.db[key]
+            values += 1
+            stored_bytes += len(data)
+            plain_bytes += len(decode_value(data).encode('utf-8'))
+        return Savings(values, plain_bytes, stored_bytes)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
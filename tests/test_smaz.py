@@ -17,8 +17,40 @@ import os
 
 from smaz import compress, decompress, _encapsulate, DECODE, _check_ascii, \
                  make_trie, SMAZ_TREE, _worst_size, _encapsulate_list, \
-                 compress_no_backtracking, compress_classic
+                 compress_no_backtracking, compress_classic, compress_auto, decompress_auto, AUTO_RAW, \
+                 AUTO_SMAZ, AUTO_ZLIB, SmazStr, search, \
+                 _search_filter, compress_indexed, decompress_range, make_index, \
+                 decompressed_length, decompress_into, validate, validate_many, \
+                 compile_matcher, make_bigram_table, _bigram_table, freeze_trie, compile_dictionary, \
+                 compress_many, decompress_many, CASE_FOLD_CODE, UTF8_DECODE, InternPool, compress_to_fit, \
+                 compress_optimal, _run_size, IncrementalCompressed, BACKTRACK_LIMIT, AUTO_SAMPLE_SIZE, \
+                 AUTO_ESTIMATE_SLACK, _zlib_compress, _ZLIB_HAS_ZDICT
+from smaz import profiling, evaluate
 
+try:
+    import asyncio
+    import io
+    import socket
+    from smaz import aio, framing
+    from smaz import __main__ as cli
+    from smaz import records
+except (ImportError, SyntaxError):
+    aio = framing = cli = records = None  # Python 2
+
+try:
+    import multiprocessing
+    import pickle
+    import tempfile
+    from smaz import shared
+except ImportError:
+    shared = None  # Before Python 3.8
+
+try:
+    import dbm.dumb
+    import sqlite3
+    from smaz import stores
+except (ImportError, SyntaxError):
+    stores = None  # Python 2
 
 __author__ = "Max Smith"
 
@@ -29,6 +61,8 @@ except NameError:
     pass
 
 if sys.version_info[0] >= 3:
+    unichr = chr
+
     def fixstr(x):
         return bytes(x, 'ISO-8859-1','ignore')
 else:
@@ -678,6 +712,15 @@ class TestSmaz(TestSmazBase):
         self.assertRaises(ValueError, make_trie, ['b', 'b'])
         self.assertRaises(ValueError, make_trie, ['%d' % i for i in xrange(257)])
 
+    def test_import_time(self):
+        """ Test (but don't assert the timing) that importing smaz doesn't build the default trie """
+        import subprocess
+        script = ('import time; tick = time.time(); import smaz; tock = time.time(); '
+                  'print("%f %s" % (tock - tick, smaz._SMAZ_TREE is None))')
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=_here('..')).decode('ascii').split()
+        print('import smaz took %s seconds' % output[0])
+        self.assertEqual('True', output[1])
+
     def test_quick_string_check(self):
         """ A quick performant sanity check of strings """
         self.performance_string(MOBYDICK_CHAPTER1, 200, 1, 100, 2)
@@ -773,3 +816,1369 @@ class TestCorpusVsSmaz(TestSmazBase):
     def test_the_leeds_internet_corpus_english_urls(self):
         """ from http://corpus.leeds.ac.uk/internet.html, 40k urls """
         self.corpus_line_by_line(_here('data', 'final-url-en.txt'))
+
+
+class TestCompressAuto(TestSmazBase):
+    def test_round_trip(self):
+        """ Every tagged output decodes back to the input, whichever codec was picked """
+        for test in TEST_DATA_LIST + (MOBYDICK_PARAGRAPH1, MOBYDICK_CHAPTER1, u'caf\xe9 cr\xe8me', chr(0) * 1000):
+            self.assertEqual(test, decompress_auto(compress_auto(test)))
+
+    def test_picks_smallest(self):
+        """ The auto codec is never worse than SMAZ or raw plus the tag byte """
+        for test in TEST_DATA_LIST + (MOBYDICK_PARAGRAPH1,):
+            if test:
+                self.assertTrue(len(compress_auto(test)) <= min(len(compress(test)), len(test)) + 1)
+
+    def test_expected_choices(self):
+        self.assertEqual(ord(compress_auto('the end')[0]), AUTO_SMAZ)
+        self.assertEqual(ord(compress_auto('#')[0]), AUTO_RAW)
+        self.assertEqual(ord(compress_auto(MOBYDICK_CHAPTER1)[0]), AUTO_ZLIB)
+        self.assertEqual(compress_auto(''), '')
+
+    def test_estimate_is_not_a_bound(self):
+        """ A sampled estimate a little worse than the best so far doesn't stop SMAZ being tried """
+        if not _ZLIB_HAS_ZDICT:
+            return
+        head = ''.join(chr(random.Random(26).randint(33, 126)) for _ in xrange(600))
+        pessimistic = 0
+        for k in xrange(0, 512, 64):
+            for n in xrange(300, 1600, 100):
+                test = head[:k] + MOBYDICK_CHAPTER1[:n]
+                if len(test) <= AUTO_SAMPLE_SIZE:
+                    continue
+                zlib_len = len(_zlib_compress(test.encode('ascii')))
+                smaz_len = min(len(compress(test)), len(compress_classic(test)))
+                estimate = len(compress_classic(test[:AUTO_SAMPLE_SIZE])) * len(test) // AUTO_SAMPLE_SIZE
+                if zlib_len < estimate <= zlib_len * AUTO_ESTIMATE_SLACK:
+                    pessimistic += 1
+                    self.assertEqual(min(smaz_len, zlib_len) + 1, len(compress_auto(test)))
+        self.assertTrue(pessimistic > 0)
+
+        # Estimate worse than zlib, and zlib does win
+        test = ('abcdefghijklmnopqrstuvwxyz0123456789' * 10)[:180] + MOBYDICK_CHAPTER1[:200]
+        self.assertEqual(AUTO_ZLIB, ord(compress_auto(test)[0]))
+        self.assertEqual(test, decompress_auto(compress_auto(test)))
+
+        # Estimate worse than zlib, but SMAZ wins
+        test = MOBYDICK_CHAPTER1[:700]
+        self.assertEqual(AUTO_SMAZ, ord(compress_auto(test)[0]))
+
+    def test_zlib_skipped(self):
+        """ zlib isn't tried when SMAZ already beats the smallest deflate stream """
+        import smaz
+        calls = []
+
+        def zlib_compress(data, level=9):
+            calls.append(data)
+            return _zlib_compress(data, level)
+        smaz._zlib_compress = zlib_compress
+        try:
+            for test in ('a', 'the', 'the end', '#', 'of the', 'http://'):
+                self.assertEqual(test, decompress_auto(compress_auto(test)))
+            self.assertEqual([], calls)
+            compress_auto(MOBYDICK_PARAGRAPH1)
+            self.assertEqual(_ZLIB_HAS_ZDICT, len(calls) == 1)
+        finally:
+            smaz._zlib_compress = _zlib_compress
+        if _ZLIB_HAS_ZDICT:
+            for size in xrange(1, 2000):
+                self.assertTrue(smaz._zlib_min_size(size) <= len(_zlib_compress(b'a' * size)))
+
+    def test_bad_tag(self):
+        self.assertRaises(ValueError, decompress_auto, chr(200) + 'abc')
+        self.assertEqual(decompress_auto(chr(200) + 'abc', raise_on_error=False), None)
+        self.assertEqual(decompress_auto(chr(AUTO_ZLIB) + 'abc', raise_on_error=False), None)
+
+
+class TestSmazStr(TestSmazBase):
+    def test_round_trip(self):
+        for test in (x for x in TEST_DATA_LIST if x is not None):
+            value = SmazStr(test)
+            self.assertEqual(test, str(value))
+            self.assertEqual(len(test), len(value))
+            self.assertEqual(compress(test), value.compressed)
+
+    def test_equality_and_hashing(self):
+        """ Lookups are done on the compressed form """
+        names = set(SmazStr(x) for x in TEST_DATA_LIST if x is not None)
+        self.assertTrue(SmazStr('the end') in names)
+        self.assertFalse(SmazStr('the ends') in names)
+        self.assertEqual(SmazStr('Salvatore'), SmazStr('Salvatore'))
+        self.assertNotEqual(SmazStr('Salvatore'), SmazStr('Max'))
+        self.assertNotEqual(SmazStr('Salvatore'), 'Salvatore')
+        self.assertEqual({SmazStr('key'): 1}[SmazStr('key')], 1)
+
+    def test_from_compressed(self):
+        """ Non-canonical encodings still compare equal """
+        text = 'GRAND CONTESTED ELECTION FOR THE PRESIDENCY OF THE UNITED STATES.'
+        self.assertEqual(SmazStr.from_compressed(compress_classic(text)), SmazStr(text))
+        self.assertEqual(SmazStr.from_compressed(_encapsulate(text)), SmazStr(text))
+
+    def test_slots(self):
+        self.assertFalse(hasattr(SmazStr('abc'), '__dict__'))
+        self.assertEqual(repr(SmazStr('abc')), "SmazStr('abc')")
+
+    def test_pickle(self):
+        import pickle
+        for test in ('', 'abc', 'x' * 300, MOBYDICK_CHAPTER1):
+            value = pickle.loads(pickle.dumps(SmazStr(test), 2))
+            self.assertEqual(SmazStr(test), value)
+            self.assertEqual(test, str(value))
+            self.assertEqual(len(test), len(value))
+
+    def test_memory(self):
+        """ Each value is one bytes object, so a batch takes less memory than the plain strs """
+        lines = [x for x in MOBYDICK_CHAPTER1.split('\n') if x]
+        sentences = MOBYDICK_CHAPTER1.split('. ')
+        for texts, saving in ((lines, 0.2), (sentences, 0.3)):
+            plain = sum(sys.getsizeof(x) for x in texts)
+            compact = sum(sys.getsizeof(SmazStr(x)) for x in texts)
+            self.assertTrue(compact < plain * (1 - saving), (compact, plain))
+
+
+class TestSearch(TestSmazBase):
+    def test_search(self):
+        """ search agrees with decompress and 'in' """
+        texts = [x for x in TEST_DATA_LIST if x] + MOBYDICK_CHAPTER1.split('\n')
+        records = [compress(x) for x in texts]
+        for pattern in ('the', 'Ishmael', 'http://', 'zz', '@', ' ', 'q', '.com', '1000', 'not in any of them'):
+            expected = [(i, x) for i, x in enumerate(texts) if pattern in x]
+            self.assertEqual(expected, list(search(pattern, records)))
+        self.assertEqual(len(list(search('', records))), len(records))
+
+    def test_search_rejects_without_decompressing(self):
+        """ Records without evidence for the pattern are rejected in the compressed domain """
+        search_filter = _search_filter('Q', DECODE)
+        self.assertFalse(search_filter(compress('the quick fox')))
+        self.assertTrue(search_filter(compress('Quantum')))
+        self.assertFalse(_search_filter('the', DECODE)(compress('@@@@@')))
+        self.assertTrue(_search_filter('', DECODE)(compress('@@@@@')))
+
+
+class TestIndexed(TestSmazBase):
+    def test_range(self):
+        """ Slices agree with slicing the full decompressed text """
+        output, index = compress_indexed(MOBYDICK_CHAPTER1, block=256)
+        self.assertEqual(output, compress(MOBYDICK_CHAPTER1))
+        self.assertTrue(len(index) > 10)
+        text_len = len(MOBYDICK_CHAPTER1)
+        for start, stop in ((0, 0), (0, 1), (0, 256), (255, 257), (1000, 5000), (text_len - 5, text_len),
+                            (text_len - 5, text_len + 100), (text_len + 1, text_len + 2), (17, None)):
+            self.assertEqual(MOBYDICK_CHAPTER1[start:stop], decompress_range(output, index, start, stop))
+        self.assertRaises(ValueError, decompress_range, output, index, -1)
+
+    def test_index_on_code_boundaries(self):
+        """ Every index entry decodes on its own, including over long verbatim runs """
+        text = ('@' * 600 + ' the end ') * 20
+        output, index = compress_indexed(text, block=100)
+        for plain_pos, comp_pos in index:
+            self.assertEqual(text[plain_pos:], decompress(output[comp_pos:]))
+        self.assertEqual([(0, 0)], make_index(''))
+
+    def test_custom_table(self):
+        """ Offsets come from the caller's table, passed as a decode table or a tree """
+        table = ['Ishmael', 'whale', ' ', 'e', 'wh', 'the ', 'and ']
+        tree = make_trie(table)
+        for kwargs in ({'decompress_table': table}, {'compression_tree': tree}):
+            output, index = compress_indexed(MOBYDICK_CHAPTER1, block=128, **kwargs)
+            self.assertEqual(compress(MOBYDICK_CHAPTER1, compression_tree=tree), output)
+            self.assertEqual(make_index(output, 128, table), index)
+            for plain_pos, comp_pos in index:
+                self.assertEqual(MOBYDICK_CHAPTER1[plain_pos:], decompress(output[comp_pos:], decompress_table=table))
+            self.assertEqual(MOBYDICK_CHAPTER1[1000:3000], decompress_range(output, index, 1000, 3000,
+                                                                           decompress_table=table))
+
+
+class TestDecompressInto(TestSmazBase):
+    def test_length(self):
+        for test in TEST_DATA_LIST + (MOBYDICK_CHAPTER1,):
+            self.assertEqual(len(test or ''), decompressed_length(compress(test)))
+        self.assertRaises(ValueError, decompressed_length, chr(255) + chr(255))
+        self.assertRaises(ValueError, decompressed_length, chr(254))
+
+    def test_into_arena(self):
+        """ Decode many records back to back into one preallocated buffer """
+        texts = [x for x in TEST_DATA_LIST if x]
+        records = [compress(x) for x in texts]
+        arena = bytearray(sum(decompressed_length(x) for x in records))
+        offset = 0
+        for record in records:
+            offset += decompress_into(record, arena, offset)
+        self.assertEqual(offset, len(arena))
+        self.assertEqual(fixstr("".join(texts)), bytes(arena))
+
+        view = memoryview(bytearray(20))
+        self.assertEqual(7, decompress_into(compress('the end'), view, 3))
+        self.assertEqual(fixstr('the end'), view[3:10].tobytes())
+
+    def test_into_inputs(self):
+        """ Verbatim runs, custom tables and, on Python 3, buffer inputs """
+        rnd = random.Random(30)
+        noise = ''.join(chr(rnd.randint(0, 127)) for _ in xrange(700))
+        table = ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1']
+        tree = make_trie(table)
+        for test in (noise, MOBYDICK_PARAGRAPH1 + noise[:300], 'abcd xyz1 #'):
+            for compressed, decompress_table in ((compress(test), None),
+                                                 (compress(test, compression_tree=tree), table)):
+                inputs = [compressed]
+                if sys.version_info[0] >= 3:
+                    data = compressed.encode('latin-1')
+                    inputs += [data, bytearray(data), memoryview(data)]
+                for input_data in inputs:
+                    output = bytearray(len(test) + 2)
+                    self.assertEqual(len(test), decompress_into(input_data, output, 1,
+                                                                decompress_table=decompress_table))
+                    self.assertEqual(fixstr(test), bytes(output[1:-1]))
+
+    def test_into_errors(self):
+        self.assertRaises(ValueError, decompress_into, compress('the end'), bytearray(6))
+        self.assertRaises(ValueError, decompress_into, chr(255) + chr(255), bytearray(300))
+        self.assertRaises(ValueError, decompress_into, chr(254), bytearray(300))
+
+
+class TestValidate(TestSmazBase):
+    def test_valid(self):
+        for test in TEST_DATA_LIST + (MOBYDICK_CHAPTER1,):
+            self.assertEqual(len(test or ''), validate(compress(test), check_ascii=True))
+            self.assertEqual(len(test or ''), validate(_encapsulate(test)))
+
+    def test_invalid(self):
+        """ The same cases that decompress rejects """
+        buffer_overflow = chr(255) + chr(255)
+        multibyte_non_ascii = chr(255) + chr(1) + chr(200) + chr(200)
+        singlebyte_non_ascii = chr(254) + chr(129)
+        self.assertRaises(ValueError, validate, buffer_overflow)
+        self.assertRaises(ValueError, validate, chr(254))
+        self.assertRaises(ValueError, validate, chr(255))
+        self.assertEqual(2, validate(multibyte_non_ascii))
+        self.assertEqual(1, validate(singlebyte_non_ascii))
+        self.assertRaises(ValueError, validate, multibyte_non_ascii, check_ascii=True)
+        self.assertEqual(None, validate(singlebyte_non_ascii, check_ascii=True, raise_on_error=False))
+        self.assertRaises(ValueError, validate, chr(5), decompress_table=['a', 'b'])
+
+    def test_validate_many(self):
+        self.assertEqual([7, None, 0, 1], validate_many([compress('the end'), chr(255), '', chr(254) + 'a']))
+
+    @heavytest
+    def test_random_input_agrees_with_decompress(self):
+        """ validate accepts exactly what decompress accepts """
+        allbytes = [chr(i) for i in xrange(256)]
+        randominput = "".join(random.choice(allbytes) for _ in xrange(10000))
+        for i in xrange(2048):
+            test = randominput[i:i + random.randint(0, 64)]
+            output = decompress(test, raise_on_error=False, check_ascii=True)
+            self.assertEqual(None if output is None else len(output),
+                             validate(test, raise_on_error=False, check_ascii=True))
+
+
+class TestAio(TestSmazBase):
+    def setUp(self):
+        if aio is None:
+            self.skipTest('asyncio not available')
+
+    def test_round_trip(self):
+        """ Small inputs run inline, large ones are batched, both agree with the sync API """
+        codec = aio.AsyncCodec(inline_threshold=100, batch_window=0.01)
+        texts = [MOBYDICK_CHAPTER1[i:i + 50 * (i % 7)] for i in xrange(0, 2000, 50)]
+
+        async def run():
+            compressed = await asyncio.gather(*(codec.compress(x) for x in texts))
+            decompressed = await asyncio.gather(*(codec.decompress(x) for x in compressed))
+            return compressed, decompressed
+
+        compressed, decompressed = asyncio.run(run())
+        self.assertEqual([compress(x) for x in texts], compressed)
+        self.assertEqual(texts, decompressed)
+        self.assertTrue(codec.inline_calls > 0)
+        self.assertTrue(codec.batched_calls > codec.batches > 0)
+
+    def test_max_batch_size(self):
+        codec = aio.AsyncCodec(inline_threshold=0, batch_window=10, max_batch_size=4)
+
+        async def run():
+            return await asyncio.gather(*(codec.compress('the end %d' % i) for i in xrange(8)))
+
+        self.assertEqual([compress('the end %d' % i) for i in xrange(8)], asyncio.run(run()))
+        self.assertEqual(2, codec.batches)
+
+    def test_errors(self):
+        """ Errors are raised in the awaiting task, and don't affect the rest of the batch """
+        codec = aio.AsyncCodec(inline_threshold=0)
+
+        async def run():
+            return await asyncio.gather(codec.compress(chr(129) * 10), codec.compress('the end'),
+                                        codec.decompress(chr(255) + chr(255)), aio.compress(chr(129)),
+                                        return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(isinstance(results[0], ValueError))
+        self.assertEqual(compress('the end'), results[1])
+        self.assertTrue(isinstance(results[2], ValueError))
+        self.assertTrue(isinstance(results[3], ValueError))
+
+
+class TestFraming(TestSmazBase):
+    def setUp(self):
+        if framing is None:
+            self.skipTest('asyncio not available')
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1):
+            encoded = framing.encode_varint(value)
+            self.assertEqual((value, len(encoded)), framing.decode_varint(encoded))
+            self.assertEqual(None, framing.decode_varint(encoded[:-1]))
+        self.assertRaises(ValueError, framing.encode_varint, -1)
+
+    def test_parse_frames(self):
+        """ Partial frames are left in the buffer """
+        data = framing.encode_frame(b'abc') + framing.encode_frame(b'', 7) + framing.encode_frame(b'xyz' * 100, 300)
+        for cut in xrange(len(data) + 1):
+            frames, consumed = framing.parse_frames(data[:cut])
+            self.assertEqual(sum(len(framing.encode_frame(bytes(p), d)) for d, p in frames), consumed)
+        frames, consumed = framing.parse_frames(data)
+        self.assertEqual([(None, b'abc'), (7, b''), (300, b'xyz' * 100)], [(d, bytes(p)) for d, p in frames])
+        self.assertEqual(len(data), consumed)
+        self.assertRaises(ValueError, framing.parse_frames, framing.encode_frame(b'abc'), 2)
+
+    def test_file_round_trip(self):
+        messages = [x for x in TEST_DATA_LIST if x] + MOBYDICK_CHAPTER1.split('\n')
+        dictionaries = {1: ['Ishmael', 'whale', ' ', 'e']}
+        stream = io.BytesIO()
+        writer = framing.SmazFileWriter(stream, dictionaries)
+        writer.write_many(messages)
+        writer.write('Ishmael, whale', dict_id=1)
+        writer.flush()
+        stream.seek(0)
+        self.assertEqual(messages + ['Ishmael, whale'], list(framing.SmazFileReader(stream, dictionaries)))
+
+        stream = io.BytesIO(stream.getvalue()[:-1])
+        self.assertRaises(ValueError, list, framing.SmazFileReader(stream, dictionaries))
+
+    def test_socketpair(self):
+        """ Batched writes over a local socket pair """
+        messages = MOBYDICK_CHAPTER1.split('\n') * 20
+
+        async def run():
+            left, right = socket.socketpair()
+            _, raw_writer = await asyncio.open_connection(sock=left)
+            raw_reader, _ = await asyncio.open_connection(sock=right)
+            writer = framing.SmazStreamWriter(raw_writer)
+            reader = framing.SmazStreamReader(raw_reader)
+            writer.write_many(messages)
+            await writer.send('the end')
+            await writer.close()
+            return [x async for x in reader]
+
+        self.assertEqual(messages + ['the end'], asyncio.run(run()))
+
+
+class TestCompileMatcher(TestSmazBase):
+    def test_identical_output(self):
+        """ The specialized matcher finds exactly the same matches as the trie """
+        matcher = compile_matcher()
+        self.assertTrue(matcher is compile_matcher(DECODE))  # Cached
+        for test in TEST_DATA_LIST + (MOBYDICK_CHAPTER1, "".join(DECODE), 'http://www.example.com/the/which'):
+            self.assertEqual(compress(test), compress(test, matcher=matcher))
+            self.assertEqual(compress_classic(test), compress_classic(test, matcher=matcher))
+            self.assertEqual(compress(test, backtracking=False), compress(test, backtracking=False, matcher=matcher))
+
+    def test_custom_table(self):
+        table = ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1']
+        matcher = compile_matcher(table)
+        tree = make_trie(table)
+        for test in ('abcdxyz1', 'abcabcxyz', 'ab' * 300 + 'q', 'xyz1' * 70, 'bcdbcda', 'abxyzbc', '@'):
+            self.assertEqual(compress(test, compression_tree=tree), compress(test, matcher=matcher))
+            self.assertEqual(test, decompress(compress(test, matcher=matcher), decompress_table=table))
+        self.assertRaises(ValueError, compile_matcher, ['%d' % i for i in xrange(257)])
+
+    def test_random_text(self):
+        matcher = compile_matcher()
+        ascii_chars = [chr(i) for i in xrange(127)] + DECODE
+        for _ in xrange(200):
+            test = "".join(random.choice(ascii_chars) for _ in xrange(random.randint(1, 300)))
+            self.assertEqual(compress(test), compress(test, matcher=matcher))
+            self.assertEqual(compress_classic(test), compress_classic(test, matcher=matcher))
+
+    def test_matcher_performance(self):
+        """ The specialized matcher pays off for compress_classic, and is only printed for compress. The gain is small
+            next to timing noise on a busy machine, so compress_classic gets three attempts.
+        """
+        import timeit
+        matcher = compile_matcher()
+        for name, func in (('compress', compress), ('compress_classic', compress_classic)):
+            for _ in xrange(3):
+                trie = min(timeit.repeat(lambda: func(MOBYDICK_CHAPTER1), number=3, repeat=5))
+                specialized = min(timeit.repeat(lambda: func(MOBYDICK_CHAPTER1, matcher=matcher), number=3, repeat=5))
+                if func is compress or specialized < trie:
+                    break
+            print('%s trie: %f specialized matcher: %f' % (name, trie, specialized))
+            if func is compress_classic:
+                self.assertTrue(specialized < trie, (specialized, trie))
+
+
+class TestBigramTable(TestSmazBase):
+    @staticmethod
+    def walk(tree, sstr):
+        """ The plain trie walk the bigram table short cuts: (encoded byte, length) of the longest match """
+        enc_byte, enc_len = None, 0
+        node = tree
+        for j, ch in enumerate(sstr):
+            child = node[ord(ch)]
+            if child is None:
+                break
+            if child[0] is not None:
+                enc_byte, enc_len = child[0], j + 1
+            node = child[1]
+            if node is None:
+                break
+        return enc_byte, enc_len
+
+    def test_table_matches_trie(self):
+        for table in (DECODE, ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1', 'q']):
+            tree = make_trie(table)
+            bigrams = make_bigram_table(tree)
+            self.assertEqual(128 * 128, len(bigrams))
+            for a in xrange(128):
+                for b in xrange(128):
+                    enc_byte, enc_len, node, j = bigrams[a << 7 | b]
+                    if node is None:  # Nothing longer, so the entry is the final answer
+                        self.assertEqual(self.walk(tree, chr(a) + chr(b)), (enc_byte, enc_len if enc_byte else 0))
+                    else:
+                        self.assertEqual(2, j)
+                        self.assertTrue(node is tree[a][1][b][1])
+
+    def test_custom_tree(self):
+        table = ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1', 'q']
+        tree = make_trie(table)
+        self.assertTrue(_bigram_table(tree) is _bigram_table(tree))  # Built once per tree
+        for test in ('abcdxyz1', 'abcabcxyz', 'ab' * 300 + 'q', 'q', 'xq', 'bcdbcda', 'abxyzbc', '@@'):
+            self.assertEqual(test, decompress(compress(test, compression_tree=tree), decompress_table=table))
+
+    def test_table_lives_on_the_trie(self):
+        """ Each trie keeps its own table, however many come and go """
+        import pickle
+        for i in xrange(200):
+            table = ['ab', 'abcd', 'b', 'bcd', 'x' * (i % 7 + 1), 'q' + str(i)]
+            for tree in (make_trie(table), freeze_trie(make_trie(table))):
+                test = 'abcd' + 'x' * (i % 7 + 1) + 'q' + str(i)
+                self.assertEqual(test, decompress(compress(test, compression_tree=tree), decompress_table=table))
+                self.assertTrue(_bigram_table(tree) is tree.bigrams)
+                unpickled = pickle.loads(pickle.dumps(tree))
+                self.assertEqual(tree, unpickled)
+                self.assertEqual(compress(test, compression_tree=tree), compress(test, compression_tree=unpickled))
+
+    def test_built_once(self):
+        """ Repeated calls with the same tree, of any kind, don't rebuild the table """
+        import smaz
+        builds = []
+
+        def counting(tree):
+            builds.append(tree)
+            return make_bigram_table(tree)
+        smaz.make_bigram_table = counting
+        try:
+            trie = make_trie(['ab', 'abcd', 'b', 'bcd', 'whale'])
+            for tree in (trie, list(trie), tuple(trie)):
+                del builds[:]
+                for _ in xrange(10):
+                    self.assertEqual('whale', decompress(compress('whale', compression_tree=tree),
+                                                         decompress_table=['ab', 'abcd', 'b', 'bcd', 'whale']))
+                self.assertTrue(len(builds) <= 1, len(builds))
+        finally:
+            smaz.make_bigram_table = make_bigram_table
+
+    def test_non_ascii(self):
+        """ Characters outside the table fall back to the trie walk """
+        for test in ('caf\xe9 the', '\xe9', 'the\xff', '\xff\xfethe', 'the end\x80'):
+            self.assertEqual(compress(test, check_ascii=False),
+                             compress(test, check_ascii=False, matcher=compile_matcher()))
+            self.assertEqual(test, decompress(compress(test, check_ascii=False)))
+            self.assertEqual(test, decompress(compress_classic(test)))
+
+
+def _shared_worker(args):
+    """ Runs in a pool worker, compresses with a table passed through pickle """
+    table, text = args
+    return compress(text, matcher=table)
+
+
+class TestShared(TestSmazBase):
+    def setUp(self):
+        if shared is None:
+            self.skipTest('multiprocessing.shared_memory not available')
+
+    def check_table(self, table, decode_table):
+        tree = make_trie(decode_table)
+        self.assertEqual(list(decode_table), table.decode_table)
+        for test in TEST_DATA_LIST + (MOBYDICK_CHAPTER1, "".join(decode_table), 'http://www.example.com/'):
+            if test:
+                self.assertEqual(compress(test, compression_tree=tree), compress(test, matcher=table))
+                self.assertEqual(test, decompress(compress(test, matcher=table), decompress_table=table.decode_table))
+
+    def test_shared_memory(self):
+        custom = ['Ishmael', 'whale', ' ', 'e', 'wh', 'Ish']
+        for decode_table in (DECODE, custom):
+            table = shared.SharedTable.create(decode_table)
+            try:
+                with shared.SharedTable.attach(table.name) as attached:
+                    self.check_table(attached, decode_table)
+                with pickle.loads(pickle.dumps(table)) as unpickled:  # Pickles as a reference, not a copy
+                    self.assertEqual(table.name, unpickled.name)
+                    self.check_table(unpickled, decode_table)
+                self.assertTrue(len(pickle.dumps(table)) < 200)
+            finally:
+                table.close()
+                table.unlink()  # Still works after close
+            self.assertRaises(FileNotFoundError, shared.SharedTable.attach, table.name)
+
+    def test_file(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            shared.SharedTable.write_file(path)
+            with shared.SharedTable.open_file(path) as table:
+                self.check_table(table, DECODE)
+                self.assertEqual(None, table.name)
+            with open(path, 'r+b') as f:
+                f.write(b'junk')
+            self.assertRaises(ValueError, shared.SharedTable.open_file, path)
+        finally:
+            os.remove(path)
+
+    def test_workers(self):
+        table = shared.SharedTable.create()
+        try:
+            pool = multiprocessing.Pool(2)
+            try:
+                texts = MOBYDICK_CHAPTER1.split('\n')
+                self.assertEqual([compress(x) for x in texts],
+                                 pool.map(_shared_worker, [(table, x) for x in texts]))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            table.unlink()
+            table.close()
+        self.assertRaises(FileNotFoundError, shared.SharedTable.attach, table.name)
+
+    def test_matcher_only(self):
+        """ Compressing through a SharedTable doesn't build the default trie """
+        import smaz
+        table = shared.SharedTable.create()
+        smaz_tree = smaz._SMAZ_TREE
+        smaz._SMAZ_TREE = None
+        try:
+            for test in (MOBYDICK_CHAPTER1, 'http://www.example.com/'):
+                self.assertEqual(test, decompress(compress(test, matcher=table), decompress_table=table.decode_table))
+            self.assertEqual(None, smaz._SMAZ_TREE)
+        finally:
+            smaz._SMAZ_TREE = smaz_tree
+            table.unlink()
+            table.close()
+
+
+class TestCompressMany(TestSmazBase):
+    def test_freeze_trie(self):
+        tree = make_trie(DECODE)
+        frozen = freeze_trie(tree)
+        self.assertTrue(isinstance(frozen, tuple))
+        self.assertTrue(all(node is None or node[1] is None or isinstance(node[1], tuple) for node in frozen))
+        for test in TEST_DATA_LIST + (MOBYDICK_CHAPTER1,):
+            self.assertEqual(compress(test, compression_tree=tree), compress(test, compression_tree=frozen))
+
+    def test_dictionary(self):
+        self.assertTrue(compile_dictionary() is compile_dictionary(DECODE))
+        table = ['Ishmael', 'whale', ' ', 'e', 'wh']
+        dictionary = compile_dictionary(table)
+        self.assertTrue(dictionary.tree.bigrams is not None)  # Built up front, compress only reads it
+        self.assertEqual([(x[0], x[1], x[3]) for x in make_bigram_table(make_trie(table))],
+                         [(x[0], x[1], x[3]) for x in dictionary.tree.bigrams])
+        for test in (MOBYDICK_CHAPTER1, 'whale whale', 'Ishmael'):
+            self.assertEqual(compress(test, compression_tree=make_trie(table)), dictionary.compress(test))
+            self.assertEqual(test, dictionary.decompress(dictionary.compress(test)))
+
+    def test_compress_many(self):
+        texts = [x for x in TEST_DATA_LIST if x] + MOBYDICK_CHAPTER1.split('\n')
+        compressed = [compress(x) for x in texts]
+        for threads in (None, 1, 2, 4, 8):
+            self.assertEqual(compressed, compress_many(texts, threads=threads))
+            self.assertEqual(texts, decompress_many(compressed, threads=threads))
+        self.assertEqual([], compress_many([], threads=4))
+        dictionary = compile_dictionary(['Ishmael', 'whale', ' ', 'e', 'wh'])
+        self.assertEqual(texts, decompress_many(compress_many(texts, threads=3, dictionary=dictionary), threads=3,
+                                                dictionary=dictionary))
+        self.assertRaises(ValueError, compress_many, ['fine', '\xe9'], threads=2)
+
+    def test_many_custom_table(self):
+        table = ['Ishmael', 'whale', ' ', 'e', 'wh']
+        tree = make_trie(table)
+        texts = ['whale whale Ishmael', 'the whale', 'Call me Ishmael']
+        compressed = compress_many(texts, threads=2, compression_tree=tree)
+        self.assertEqual([compress(x, compression_tree=tree) for x in texts], compressed)
+        self.assertEqual(texts, decompress_many(compressed, threads=2, decompress_table=table))
+        self.assertEqual(texts, [decompress(x, decompress_table=table) for x in compressed])
+        dictionary = compile_dictionary(table)
+        self.assertRaises(ValueError, compress_many, texts, dictionary=dictionary, compression_tree=tree)
+        self.assertRaises(ValueError, decompress_many, compressed, dictionary=dictionary, decompress_table=table)
+
+    def test_scaling(self):
+        """ Test (but don't assert) how compress_many scales with threads """
+        texts = MOBYDICK_CHAPTER1.split('\n') * 20
+        for threads in (1, 2, 4, 8):
+            tick = datetime.datetime.now()
+            compress_many(texts, threads=threads)
+            tock = datetime.datetime.now()
+            print('compress_many threads: %d gil: %s time: %f' % (
+                threads, getattr(sys, '_is_gil_enabled', lambda: True)(), self.timedelta_to_float(tock - tick)))
+
+
+class TestCaseFolding(TestSmazBase):
+    def round_trip(self, test, **kwargs):
+        compressed = compress(test, case_folding=True, **kwargs)
+        self.assertEqual(test, decompress(compressed, case_folding=True))
+        return compressed
+
+    def test_modifiers(self):
+        modifier = chr(CASE_FOLD_CODE)
+        self.assertEqual(modifier + compress('hello'), self.round_trip('Hello'))
+        self.assertEqual(compress('the end'), self.round_trip('the end'))  # Nothing to fold
+        self.assertTrue(self.round_trip('HELLO WORLD').startswith(modifier * 2))
+        self.assertEqual(compress('the'), self.round_trip('The')[1:])  # "The" gives up its code to the modifier
+
+    def test_round_trip(self):
+        for test in TEST_DATA_LIST + (MOBYDICK_CHAPTER1, MOBYDICK_CHAPTER1.upper(), MOBYDICK_CHAPTER1.title()):
+            if test:
+                self.round_trip(test)
+        ascii_chars = [chr(i) for i in xrange(128)] + DECODE + ['THE', 'Of', 'AND', 'Which']
+        for _ in xrange(500):
+            self.round_trip("".join(random.choice(ascii_chars) for _ in xrange(random.randint(1, 80))))
+
+    def test_custom_tree(self):
+        table = ['hello', ' ', 'world', 'wor']
+        compressed = compress('Hello WORLD world', case_folding=True, compression_tree=make_trie(table))
+        self.assertEqual('Hello WORLD world', decompress(compressed, case_folding=True, decompress_table=table))
+
+    def test_title_case(self):
+        """ Title and upper case text should compress better with case folding """
+        for transform in (lambda x: x.title(), lambda x: x.upper()):
+            lines = [transform(x) for x in MOBYDICK_CHAPTER1.split('\n') if x]
+            self.assertTrue(sum(len(self.round_trip(x)) for x in lines) < sum(len(compress(x)) for x in lines))
+
+    def test_invalid(self):
+        modifier = chr(CASE_FOLD_CODE)
+        for test in (modifier, modifier + chr(254) + 'a', modifier * 2, modifier * 2 + chr(3) + 'ab',
+                     modifier * 2 + chr(0) + modifier, modifier * 2 + chr(0) + chr(255)):
+            self.assertRaises(ValueError, decompress, test, case_folding=True)
+            self.assertEqual(None, decompress(test, case_folding=True, raise_on_error=False))
+
+
+class TestUtf8(TestSmazBase):
+    MIXED = [u'caf\u00e9', u'M\u00fcller\u2019s \u201cquote\u201d',
+             u'na\u00efve r\u00e9sum\u00e9 \u2014 d\u00e9j\u00e0 vu',
+             u'\u041f\u0440\u0438\u0432\u0435\u0442 \u043c\u0438\u0440', u'\u65e5\u672c\u8a9e', u'plain ascii',
+             u'\u00e9', u'x' * 255 + u'\u00e9', u'\u0436' * 300, u'\U0001f600 emoji']
+
+    def test_round_trip(self):
+        for test in self.MIXED + [x for x in TEST_DATA_LIST if x]:
+            for utf8_table in (None, [], UTF8_DECODE[:3]):
+                compressed = compress(test, utf8=True, utf8_table=utf8_table)
+                self.assertEqual(test, decompress(compressed, utf8=True, utf8_table=utf8_table))
+        chars = [unichr(i) for i in xrange(128)] + DECODE + UTF8_DECODE + [u'\u0436', u'\u4e2d']
+        for _ in xrange(300):
+            test = u"".join(random.choice(chars) for _ in xrange(random.randint(1, 300)))
+            self.assertEqual(test, decompress(compress(test, utf8=True), utf8=True))
+
+    def test_secondary_table(self):
+        """ Common accented characters and punctuation get two byte codes, rather than a verbatim run """
+        self.assertEqual(compress('caf') + chr(254) + chr(128), compress(u'caf\u00e9', utf8=True))
+        for test in self.MIXED[:3]:
+            self.assertTrue(len(compress(test, utf8=True)) < len(compress(test, utf8=True, utf8_table=[])))
+        self.assertEqual(compress('the end'), compress(u'the end', utf8=True))  # ASCII is unchanged
+
+    def test_custom_tree(self):
+        table = ['caf', 'the', ' ']
+        tree = make_trie(table, UTF8_DECODE)
+        compressed = compress(u'the caf\u00e9', utf8=True, compression_tree=tree)
+        self.assertEqual(u'the caf\u00e9', decompress(compressed, utf8=True, decompress_table=table))
+        self.assertRaises(ValueError, make_trie, table, [unichr(0x100 + i) for i in xrange(129)])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, decompress, chr(254) + chr(255), utf8=True)  # Past the end of the table
+        self.assertRaises(ValueError, decompress, chr(255) + chr(0) + chr(0xc3), utf8=True)  # Truncated character
+        self.assertEqual(None, decompress(chr(254) + chr(0xf0), utf8=True, raise_on_error=False))
+        self.assertRaises(ValueError, compress, u'Caf\u00e9', utf8=True, case_folding=True)
+
+
+class TestAdaptive(TestSmazBase):
+    def test_round_trip(self):
+        rnd = random.Random(45)
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(3000))
+        for test in (MOBYDICK_CHAPTER1, noise, MOBYDICK_CHAPTER1[:500] + noise[:200] + MOBYDICK_CHAPTER1[500:900],
+                     'x', 'the', 'zq#the xq#k', '@@@ @@@ a', 'a' * 1000, noise[:10] + 'e' + noise[10:20]):
+            self.assertEqual(test, decompress(compress(test, adaptive=True)))
+        self.assertEqual('', compress('', adaptive=True))
+
+    def test_noise(self):
+        """ One character codes inside a verbatim run are passed over """
+        self.assertEqual(_encapsulate('zq#e@k'), compress('zq#e@k', adaptive=True))
+        self.assertEqual(len(compress('zq#e@k')), len(compress('zq#e@k', adaptive=True)))
+
+    def test_ratio(self):
+        """ At most 0.15% larger than the default on the test corpora, as the compress docstring says """
+        rnd = random.Random(45)
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(20000))
+        corpora = [MOBYDICK_CHAPTER1, noise, ''.join(MOBYDICK_CHAPTER1[i:i + 400] + noise[i:i + 200]
+                                                     for i in xrange(0, 10000, 600))]
+        for test_file in ('alice29.txt', 'cp.html', 'fields.c'):
+            try:
+                with open(_here('data', test_file), 'rb') as f:
+                    corpora.append(''.join(x for x in f.read().decode('latin-1') if ord(x) < 128))
+            except IOError:
+                pass
+        for text in corpora:
+            default, adaptive = len(compress(text)), len(compress(text, adaptive=True))
+            self.assertTrue(adaptive <= default * 1.0015, (default, adaptive))
+            self.assertTrue(adaptive <= len(compress_no_backtracking(text)))
+
+    def test_performance(self):
+        rnd = random.Random(45)
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(20000))
+        for name, text in (('english', MOBYDICK_CHAPTER1 * 3), ('random', noise)):
+            timings = {}
+            for mode, kwargs in (('default', {}), ('backtracking=False', {'backtracking': False}),
+                                 ('adaptive', {'adaptive': True})):
+                start = datetime.datetime.now()
+                for _ in xrange(5):
+                    size = len(compress(text, **kwargs))
+                timings[mode] = ((datetime.datetime.now() - start).total_seconds(), size)
+            print('%s: %s' % (name, ', '.join('%s %.3fs %d bytes' % (mode, t, size)
+                                              for mode, (t, size) in sorted(timings.items()))))
+
+
+class TestProfiling(TestSmazBase):
+    def tearDown(self):
+        profiling.disable()
+
+    def test_identical_output(self):
+        rnd = random.Random(46)
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(2000))
+        tests = [MOBYDICK_CHAPTER1, noise, 'x', 'the', '  Y OF', MOBYDICK_CHAPTER1[:300] + noise[:300]]
+        modes = [{}, {'backtracking': False}, {'adaptive': True}, {'pathological_case_detection': False},
+                 {'backtrack_limit': 10}, {'matcher': compile_matcher()}]
+        expected = [[compress(test, **kwargs) for test in tests] for kwargs in modes]
+        text = u'caf\u00e9 \u201cquoted\u201d \u4e2d'
+        expected_utf8 = compress(text, utf8=True)
+        expected_folded = compress('The Cat SAT', case_folding=True)
+        with profiling.profile() as prof:
+            self.assertEqual(expected, [[compress(test, **kwargs) for test in tests] for kwargs in modes])
+            for row in expected:
+                self.assertEqual(tests, [decompress(x) for x in row])
+            self.assertEqual(expected_utf8, compress(text, utf8=True))
+            self.assertEqual(text, decompress(expected_utf8, utf8=True))
+            self.assertEqual(expected_folded, compress('The Cat SAT', case_folding=True))
+            self.assertEqual('The Cat SAT', decompress(expected_folded, case_folding=True))
+            self.assertEqual('', compress(''))
+            self.assertRaises(ValueError, compress, '\xff')
+            self.assertEqual(None, compress('\xff', raise_on_error=False))
+            self.assertRaises(ValueError, decompress, '\xff\x05ab')
+            self.assertEqual(None, decompress('\xfe\x80', check_ascii=True, raise_on_error=False))
+        self.assertEqual(len(tests) * len(modes) + 3, prof.totals['compress'][0])
+
+    def test_report(self):
+        with profiling.profile() as prof:
+            for line in MOBYDICK_CHAPTER1.split('\n'):
+                decompress(compress(line))
+        compress('not counted')
+        report = prof.report()
+        lines = [x for x in MOBYDICK_CHAPTER1.split('\n') if x]
+        for function in ('compress', 'decompress'):
+            stats = report[function]
+            self.assertEqual(len(lines), stats['calls'])
+            shares = sum(phase['share'] for phase in stats['phases'].values())
+            self.assertTrue(0.5 < shares <= 1.0001, shares)
+        compress_phases = report['compress']['phases']
+        self.assertEqual(len(lines), compress_phases['check_ascii']['count'])
+        self.assertTrue(compress_phases['trie_walk']['count'] > len(lines))
+        self.assertEqual(0, compress_phases['utf8_encode']['count'])
+        self.assertEqual(sum(len(x) for x in lines), report['compress']['input_bytes'])
+        self.assertEqual(report['compress']['output_bytes'], report['decompress']['input_bytes'])
+        self.assertTrue('trie_walk' in prof.format())
+        prof.reset()
+        self.assertEqual(0, prof.report()['compress']['calls'])
+
+    def test_nesting(self):
+        outer = profiling.enable()
+        with profiling.profile() as inner:
+            compress('inner')
+        compress('outer')
+        profiling.disable()
+        compress('neither')
+        self.assertEqual(1, inner.totals['compress'][0])
+        self.assertEqual(1, outer.totals['compress'][0])
+
+    def test_corpus(self):
+        paths = [_here('data', x) for x in ('alice29.txt', 'sms_corpus-NUS.txt') if os.path.exists(_here('data', x))]
+        if not paths:
+            return
+        prof = profiling.profile_corpus(paths[:1], lines=True)
+        self.assertTrue(prof.totals['compress'][0] > 1000)
+        prof = profiling.profile_corpus(paths[:1], utf8=True, decompress_table=DECODE)
+        self.assertEqual(1, prof.report()['decompress']['phases']['utf8_decode']['count'])
+
+    def test_corpus_utf8_table(self):
+        """ An empty secondary table is used as given, not replaced by UTF8_DECODE """
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        try:
+            os.write(handle, u'caf\xe9 cr\xe8me na\xefve \u00fcber'.encode('utf-8'))
+            os.close(handle)
+            prof = profiling.profile_corpus([path], utf8=True, decompress_table=DECODE, utf8_table=[])
+            self.assertEqual(1, prof.totals['decompress'][0])
+        finally:
+            os.remove(path)
+
+
+class TestCompressToFit(TestSmazBase):
+    def check_fit(self, text, max_bytes):
+        compressed, consumed = compress_to_fit(text, max_bytes)
+        self.assertTrue(len(compressed) <= max_bytes)
+        self.assertEqual(text[:consumed], decompress(compressed) if compressed else '')
+        return compressed, consumed
+
+    def test_budgets(self):
+        rnd = random.Random(47)
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(300))
+        for text in (MOBYDICK_CHAPTER1[:600], noise, MOBYDICK_CHAPTER1[:200] + noise[:100], 'Y OF', 'x', 'the'):
+            full = len(compress(text))
+            consumed = [self.check_fit(text, max_bytes)[1] for max_bytes in xrange(full + 3)]
+            self.assertEqual(consumed, sorted(consumed))  # More room never means less text
+            self.assertEqual(0, consumed[0])
+            self.assertEqual(len(text), consumed[full])
+            self.assertEqual(compress(text), compress_to_fit(text, full + 2)[0])
+
+    def test_longest_prefix(self):
+        """ At least as much text as the longest prefix compress fits in the budget """
+        for start in xrange(0, 2000, 397):
+            text = MOBYDICK_CHAPTER1[start:start + 200]
+            for max_bytes in (1, 5, 20, 60, 140):
+                consumed = self.check_fit(text, max_bytes)[1]
+                longest = max(n for n in xrange(len(text) + 1) if len(compress(text[:n]) or '') <= max_bytes)
+                self.assertTrue(consumed >= longest, (text, max_bytes, consumed, longest))
+
+    def test_longest_prefix_noise(self):
+        """ Long random text, where codes are sparse and backtracking merges long runs """
+        rnd = random.Random(43)
+        for alphabet in (None, 'the and of e t a ', 'xyzqk#@!'):
+            text = ''.join(chr(rnd.randint(32, 126)) if alphabet is None or rnd.random() < 0.5 else rnd.choice(alphabet)
+                           for _ in xrange(700))
+            sizes = [len(compress(text[:n]) or '') for n in xrange(len(text) + 1)]
+            for max_bytes in xrange(1, sizes[-1] + 3):
+                consumed = self.check_fit(text, max_bytes)[1]
+                longest = max(n for n, size in enumerate(sizes) if size <= max_bytes)
+                self.assertTrue(consumed >= longest, (max_bytes, consumed, longest))
+
+    def test_sms(self):
+        text = MOBYDICK_CHAPTER1.replace('\n', ' ')
+        pos = 0
+        slots = []
+        while pos < len(text):
+            compressed, consumed = self.check_fit(text[pos:], 140)
+            slots.append(compressed)
+            pos += consumed
+        self.assertEqual(text, ''.join(decompress(x) for x in slots))
+        self.assertTrue(len(slots) < len(text) / 140.0)
+
+    def test_errors(self):
+        self.assertEqual(('', 0), compress_to_fit('', 10))
+        self.assertEqual(('', 0), compress_to_fit('the', 0))
+        self.assertRaises(ValueError, compress_to_fit, 'the', -1)
+        self.assertRaises(ValueError, compress_to_fit, '\xff the', 10)
+
+
+class TestDecompressBuffer(TestSmazBase):
+    def setUp(self):
+        if sys.version_info[0] < 3:
+            self.skipTest('Buffers are decompressed as str on Python 2')
+
+    def test_types(self):
+        compressed = fixstr(compress(MOBYDICK_CHAPTER1))
+        expected = fixstr(MOBYDICK_CHAPTER1)
+        for buff in (compressed, bytearray(compressed), memoryview(compressed), memoryview(compressed).cast('c'),
+                     memoryview(b'xx' + compressed)[2:]):
+            self.assertEqual(expected, decompress(buff))
+        self.assertEqual(b'', decompress(b''))
+        self.assertEqual(b'', decompress(memoryview(b'')))
+
+    def test_mmap(self):
+        import mmap
+        compressed = fixstr(compress(MOBYDICK_CHAPTER1 * 20))
+        with tempfile.TemporaryFile() as f:
+            f.write(compressed)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.assertEqual(fixstr(MOBYDICK_CHAPTER1 * 20), decompress(mapped))
+            finally:
+                mapped.close()  # Fails if decompress left a view of it open
+
+    def test_modes(self):
+        table = ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1', 'q']
+        tests = [('abcdxyz1 @@ q', {'decompress_table': table}, {'compression_tree': make_trie(table)}),
+                 ('The Cat SAT on THE mat', {'case_folding': True}, {'case_folding': True})]
+        for text, decompress_kwargs, compress_kwargs in tests:
+            compressed = fixstr(compress(text, **compress_kwargs))
+            self.assertEqual(fixstr(text), decompress(compressed, **decompress_kwargs))
+        text = u'caf\u00e9 \u201cquoted\u201d \u4e2d\u6587 ' * 3
+        self.assertEqual(text, decompress(fixstr(compress(text, utf8=True)), utf8=True))
+
+    def test_errors(self):
+        for bad in (b'\xff\x05ab', b'\xfe', b'\xff'):
+            self.assertRaises(ValueError, decompress, bad)
+            self.assertRaises(ValueError, decompress, memoryview(bad))
+            self.assertEqual(None, decompress(bytearray(bad), raise_on_error=False))
+        self.assertRaises(ValueError, decompress, b'\xfe\x80', check_ascii=True)
+        self.assertEqual(b'\x80', decompress(b'\xfe\x80'))
+        self.assertRaises(ValueError, decompress, b'\xfe\xf0', utf8=True)
+
+    def test_profiled(self):
+        with profiling.profile() as prof:
+            self.assertEqual(b'the', decompress(fixstr(compress('the'))))
+        self.assertEqual(1, prof.report()['decompress']['phases']['buffer']['count'])
+
+
+class TestCompressOptimal(TestSmazBase):
+    def test_never_longer(self):
+        rnd = random.Random(49)
+        alphabet = 'the andofXYZ#@ \n!q'
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(2000))
+        tests = [MOBYDICK_CHAPTER1, noise, MOBYDICK_CHAPTER1[:500] + noise[:300], 'Y OF', 'x', 'the', ' ' * 600]
+        tests += [''.join(rnd.choice(alphabet) for _ in xrange(rnd.randint(1, 40))) for _ in xrange(500)]
+        for test in tests:
+            compressed = compress_optimal(test)
+            self.assertEqual(test, decompress(compressed))
+            self.assertTrue(len(compressed) <= len(compress(test)), test)
+            self.assertTrue(len(compressed) <= len(compress_classic(test)), test)
+        self.assertTrue(len(compress_optimal(MOBYDICK_CHAPTER1)) < len(compress(MOBYDICK_CHAPTER1)))
+
+    def test_brute_force(self):
+        """ Matches an exhaustive search over every way to split short strings """
+        table = ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1', 'q', 'cdx']
+        tree = make_trie(table)
+
+        def shortest(text):
+            if not text:
+                return 0
+            options = [_run_size(n) + shortest(text[n:]) for n in xrange(1, len(text) + 1)]
+            options += [1 + shortest(text[len(entry):]) for entry in table if text.startswith(entry)]
+            return min(options)
+        for text in ('abcdxyz1', 'abcdx', 'bcdxq@', 'q@q@q', '@b@', 'abcabcxyz', 'xyz@bcdx'):
+            compressed = compress_optimal(text, compression_tree=tree)
+            self.assertEqual(text, decompress(compressed, decompress_table=table))
+            self.assertEqual(shortest(text), len(compressed))
+
+    def test_errors(self):
+        self.assertEqual('', compress_optimal(''))
+        self.assertRaises(ValueError, compress_optimal, '\xff')
+        self.assertEqual(None, compress_optimal('\xff', raise_on_error=False))
+
+
+class TestEvaluate(TestSmazBase):
+    def test_evaluate(self):
+        alternative = list(DECODE)
+        alternative[200] = 'Ishmael'
+        tables = {'smaz': DECODE, 'ishmael': alternative}
+        corpora = {'lines': [x for x in MOBYDICK_CHAPTER1.split('\n') if x], 'whole': [MOBYDICK_CHAPTER1]}
+        cache = {}
+        results = evaluate.evaluate(tables, corpora, evaluate.MODES, cache=cache)
+        self.assertEqual(2 * 2 * len(evaluate.MODES), len(results))
+        self.assertEqual(len(results), len(cache))
+        by_key = dict(((x.table, x.corpus, x.mode), x) for x in results)
+        for corpus_name, corpus in corpora.items():
+            for mode, codec in (('classic', compress_classic), ('backtracking', compress),
+                                ('optimal', compress_optimal)):
+                result = by_key['smaz', corpus_name, mode]
+                self.assertEqual(sum(len(codec(x)) for x in corpus), result.compressed_bytes)
+                self.assertEqual(sum(len(x) for x in corpus), result.plain_bytes)
+                self.assertEqual(result.plain_bytes - result.compressed_bytes, result.bytes_saved)
+                self.assertTrue(sum(result.code_counts) + result.verbatim_bytes < result.compressed_bytes)
+            self.assertTrue(by_key['smaz', corpus_name, 'optimal'].ratio <= by_key['smaz', corpus_name, 'classic'].ratio)
+            dead = by_key['smaz', corpus_name, 'backtracking'].dead_entries
+            self.assertTrue(0 not in dead and 1 not in dead)  # ' ' and 'the'
+            self.assertTrue(len(dead) > 10)
+            self.assertTrue(by_key['ishmael', corpus_name, 'backtracking'].code_counts[200] > 0)
+        self.assertEqual(1, by_key['smaz', 'whole', 'classic'].records)
+        self.assertTrue('ishmael' in evaluate.format_results(results))
+
+        # Re-runs come from the cache, including the timings
+        again = evaluate.evaluate(tables, corpora, evaluate.MODES, cache=cache)
+        self.assertEqual([x.seconds for x in results], [x.seconds for x in again])
+        cache.clear()
+        self.assertEqual(2, len(evaluate.evaluate(tables, {'other': ['the end']}, ('classic',), cache=cache)))
+        self.assertEqual(2, len(cache))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, evaluate.evaluate, {'smaz': DECODE}, {'c': ['the']}, ('fastest',))
+        broken = list(DECODE)
+        broken[0] = 'x'  # Not a valid table for itself - decompress doesn't match
+        self.assertRaises(ValueError, evaluate.evaluate_one, broken, ['the box'], 'classic')
+
+    def test_data_corpora(self):
+        corpora = evaluate.data_corpora(lines=True, data_dir=_here('data'))
+        if 'fields.c' not in corpora:
+            return
+        result = evaluate.evaluate({'smaz': DECODE}, {'fields.c': corpora['fields.c']}, ('backtracking',))[0]
+        self.assertTrue(0 < result.ratio < 1)
+        self.assertTrue(result.megabytes_per_second > 0)
+
+
+class TestIncrementalCompressed(TestSmazBase):
+    def test_identical(self):
+        """ Matches compress of the whole text, however it was split into appends """
+        rnd = random.Random(50)
+        alphabet = 'the andofXYZ#@ \n!q'
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(1500))
+        tests = [MOBYDICK_CHAPTER1, noise, MOBYDICK_CHAPTER1[:500] + noise[:300] + MOBYDICK_CHAPTER1[500:900], 'Y OF',
+                 ' Y OF Y OF', 'x']
+        tests += [''.join(rnd.choice(alphabet) for _ in xrange(rnd.randint(1, 200))) for _ in xrange(50)]
+        table = ['ab', 'abcd', 'b', 'bcd', 'x', 'xyz1', 'q', 'the']
+        for kwargs in ({}, {'backtracking': False}, {'adaptive': True}, {'backtrack_limit': 10},
+                       {'compression_tree': make_trie(table)}):
+            for test in tests:
+                incremental = IncrementalCompressed(**kwargs)
+                pos = 0
+                while pos < len(test):
+                    step = rnd.choice((1, 1, 2, 3, 7, 20, 100))
+                    incremental.append(test[pos:pos + step])
+                    pos += step
+                    if rnd.random() < 0.05:
+                        self.assertEqual(compress(test[:pos], **kwargs), incremental.compressed)
+                self.assertEqual(compress(test, **kwargs), incremental.compressed)
+                self.assertEqual(test, incremental.text())
+                self.assertEqual(len(test), len(incremental))
+
+    def test_transcript(self):
+        transcript = IncrementalCompressed('Alice: Hello\n')
+        transcript += 'Bob: Hi there\n'
+        self.assertEqual(compress('Alice: Hello\nBob: Hi there\n'), transcript.compressed)
+        transcript.append('')
+        self.assertEqual('', IncrementalCompressed().compressed)
+        self.assertRaises(ValueError, transcript.append, '\xff')
+
+        lines = MOBYDICK_CHAPTER1.split('\n')
+        for line in lines:
+            transcript.append(line + '\n')
+            self.assertTrue(len(transcript._tail) < BACKTRACK_LIMIT + 20)  # Only a short tail is re-encoded
+        self.assertEqual(compress('Alice: Hello\nBob: Hi there\n' + MOBYDICK_CHAPTER1 + '\n'), transcript.compressed)
+
+    def test_bounded(self):
+        """ Text that's all codes, or has no codes at all, doesn't grow the re-encoded tail or the held buffers """
+        rnd = random.Random(50)
+        noise = ''.join(chr(rnd.randint(32, 126)) for _ in xrange(20000))
+        for text, kwargs in (('the cat sat on the mat. ', {}), ('the cat sat on the mat. ', {'backtracking': False}),
+                             (noise, {'compression_tree': make_trie(['the', 'cat'])})):
+            incremental = IncrementalCompressed(**kwargs)
+            appended = []
+            for i in xrange(8000):
+                chunk = text[i * 24 % len(text):][:24]
+                incremental.append(chunk)
+                appended.append(chunk)
+                state = incremental._state
+                held = len(state.unmatched) + len(state.backtrack_buff) + len(state.enc_buf)
+                self.assertTrue(len(incremental._tail) <= BACKTRACK_LIMIT + 30, len(incremental._tail))
+                self.assertTrue(held <= BACKTRACK_LIMIT + 260, held)
+            self.assertEqual(compress(''.join(appended), **kwargs), incremental.compressed)
+
+    def test_pickle(self):
+        import pickle
+        incremental = IncrementalCompressed(MOBYDICK_CHAPTER1[:1000])
+        restored = pickle.loads(pickle.dumps(incremental))
+        restored.append(MOBYDICK_CHAPTER1[1000:])
+        self.assertEqual(compress(MOBYDICK_CHAPTER1), restored.compressed)
+
+
+class TestCli(TestSmazBase):
+    def setUp(self):
+        if cli is None:
+            self.skipTest('Python 3.7+ only')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def path(self, name, data=None):
+        path = os.path.join(self.directory, name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def test_lines(self):
+        data = MOBYDICK_CHAPTER1.encode('ascii')
+        for workers in ('1', '2'):
+            self.assertEqual(0, cli.main(['compress', self.path('in.txt', data), self.path('out.smaz'), '--quiet',
+                                          '--workers', workers, '--batch-size', '7']))
+            self.assertEqual(0, cli.main(['decompress', self.path('out.smaz'), self.path('out.txt'), '--quiet',
+                                          '--workers', workers]))
+            self.assertEqual(data, self.read('out.txt'))
+        lines = MOBYDICK_CHAPTER1.split('\n')[:-1]  # Ends with a newline
+        frames, consumed = framing.parse_frames(self.read('out.smaz'))
+        self.assertEqual([compress(x) or '' for x in lines], [bytes(p).decode('latin-1') for _, p in frames])
+
+    def test_last_line(self):
+        """ Files round trip whether or not they end with a newline """
+        for data in (b'', b'\n', b'\n\n', b'abc', b'abc\n', b'the end\nthe', b'the\n\nend',
+                     MOBYDICK_CHAPTER1.rstrip('\n').encode('ascii')):
+            for workers, batch_size in (('1', '1'), ('2', '2'), ('1', '1000')):
+                self.assertEqual(0, cli.main(['compress', self.path('in.txt', data), self.path('out.smaz'), '--quiet',
+                                              '--workers', workers, '--batch-size', batch_size]))
+                self.assertEqual(0, cli.main(['decompress', self.path('out.smaz'), self.path('out.txt'), '--quiet',
+                                              '--workers', workers, '--batch-size', batch_size]))
+                self.assertEqual(data, self.read('out.txt'))
+
+    def test_length_prefixed_utf8(self):
+        records = [u'caf\u00e9', u'', u'line\nbreak', u'M\u00fcller'] * 50
+        data = b''.join(framing.encode_varint(len(x.encode('utf-8'))) + x.encode('utf-8') for x in records)
+        args = ['--quiet', '--utf8', '--length-prefixed']
+        self.assertEqual(0, cli.main(['compress', self.path('in.bin', data), self.path('out.smaz')] + args))
+        self.assertEqual(0, cli.main(['decompress', self.path('out.smaz'), self.path('out.bin')] + args))
+        self.assertEqual(data, self.read('out.bin'))
+        self.assertEqual(1, cli.main(['compress', self.path('bad.bin', data[:-1]), self.path('out.smaz')] + args))
+
+    def test_stats(self):
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.assertEqual(0, cli.main(['stats', self.path('in.txt', MOBYDICK_CHAPTER1.encode('ascii'))]))
+            summary = sys.stderr.getvalue()
+            self.assertEqual(1, cli.main(['stats', self.path('bad.txt', u'caf\u00e9'.encode('utf-8'))]))
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(summary.startswith('stats: %d records' % MOBYDICK_CHAPTER1.count('\n')))
+        print(summary)
+
+
+class TestStores(TestSmazBase):
+    VALUES = [x for x in TEST_DATA_LIST if x] + [u'caf\u00e9', u'', u'M\u00fcller\u2019s']
+
+    def setUp(self):
+        if stores is None:
+            self.skipTest('Python 3 only')
+        stores.register_sqlite()
+        self.conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, body SMAZ)')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def bodies(self):
+        return [x for x, in self.conn.execute('SELECT body FROM messages ORDER BY id')]
+
+    def test_adapter(self):
+        for value in self.VALUES:
+            self.conn.execute('INSERT INTO messages (body) VALUES (?)', (stores.SmazText(value),))
+        self.conn.execute('INSERT INTO messages (body) VALUES (NULL)')
+        self.assertEqual(self.VALUES + [None], self.bodies())
+        stored = self.conn.execute('SELECT CAST(body AS BLOB) FROM messages WHERE id = 1').fetchone()[0]
+        self.assertEqual(compress(self.VALUES[0]).encode('latin-1'), stored)
+
+    def test_executemany(self):
+        stores.executemany(self.conn, 'INSERT INTO messages (id, body) VALUES (?, ?)',
+                           [(i, x) for i, x in enumerate(self.VALUES + [None])], [1], threads=2)
+        self.assertEqual(self.VALUES + [None], self.bodies())
+        savings = stores.sqlite_savings(self.conn, 'messages', 'body')
+        self.assertEqual(len(self.VALUES), savings.values)
+        self.assertEqual(sum(len(x.encode('utf-8')) for x in self.VALUES), savings.plain_bytes)
+        self.assertTrue(savings.stored_bytes < savings.plain_bytes)
+
+    def test_functions(self):
+        stores.install_functions(self.conn)
+        self.conn.execute("INSERT INTO messages (body) VALUES (smaz_compress('the end'))")
+        self.assertEqual('the end', self.conn.execute('SELECT smaz_decompress(body) FROM messages').fetchone()[0])
+        self.assertEqual(None, self.conn.execute('SELECT smaz_compress(NULL)').fetchone()[0])
+
+    def test_dbm(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'values')
+        try:
+            with stores.SmazDbm(dbm.dumb.open(path, 'c')) as db:
+                db['first'] = self.VALUES[0]
+                db.update_many(('key%d' % i, x) for i, x in enumerate(self.VALUES))
+                del db['first']
+            with stores.SmazDbm(dbm.dumb.open(path, 'r')) as db:
+                self.assertEqual(len(self.VALUES), len(db))
+                self.assertEqual(dict(('key%d' % i, x) for i, x in enumerate(self.VALUES)),
+                                 dict((k.decode('ascii'), db[k]) for k in db))
+                self.assertTrue('key0' in db and 'first' not in db)
+                self.assertTrue(db.savings().stored_bytes < db.savings().plain_bytes)
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_benchmark(self):
+        """ Test (but don't assert) bulk insert and point read times against uncompressed storage """
+        with open(_here('data', 'sms_corpus-NUS.txt'), 'rb') as f:
+            lines = [x.decode('utf-8', 'replace') for x in f.read().split(b'\n')[:5000]]
+        self.conn.execute('CREATE TABLE plain (id INTEGER PRIMARY KEY, body TEXT)')
+        for table, insert in (('plain', self.conn.executemany),
+                              ('messages', lambda sql, rows: stores.executemany(self.conn, sql, rows, [0]))):
+            tick = datetime.datetime.now()
+            insert('INSERT INTO %s (body) VALUES (?)' % table, [(x,) for x in lines])
+            tock = datetime.datetime.now()
+            for i in xrange(1, len(lines), 7):
+                self.conn.execute('SELECT body FROM %s WHERE id = ?' % table, (i,)).fetchone()
+            tack = datetime.datetime.now()
+            print('%s: bulk insert %f point reads %f' % (table, self.timedelta_to_float(tock - tick),
+                                                          self.timedelta_to_float(tack - tock)))
+        print(stores.sqlite_savings(self.conn, 'messages', 'body'))
+
+
+class TestRecords(TestSmazBase):
+    RECORDS = [
+        {'name': 'Salvatore', 'url': 'http://github.com/antirez/smaz', 'status': 'active', 'id': 1},
+        {'name': u'Ren\u00e9', 'status': 'pending review', 'id': -2 ** 63, 'score': 0.25, 'flags': [True, False, None],
+         'nested': {'url': 'http://www.example.com/', 'empty': '', 'list': [{'name': 'x'}, [], {}]}},
+        {'unknown key': 'the end', 'id': 2 ** 63 - 1},
+        {},
+    ]
+
+    def setUp(self):
+        if records is None:
+            self.skipTest('Python 3.7+ only')
+        self.schema = records.Schema(['name', 'url', 'status', 'id', 'score', 'flags', 'nested', 'list', 'empty'],
+                                     tables={'url': ['http://', 'www.', '.com', 'github', '/']})
+
+    def test_round_trip(self):
+        for record in self.RECORDS:
+            decoded = self.schema.decode(self.schema.encode(record))
+            self.assertTrue(isinstance(decoded, records.LazyRecord))
+            self.assertEqual(record, decoded.to_dict())
+            self.assertEqual(sorted(record), sorted(decoded))
+        schema = records.Schema.from_records(self.RECORDS)
+        self.assertEqual('id', schema.fields[0])  # Most common
+        self.assertEqual(self.RECORDS[1], schema.decode(schema.encode(self.RECORDS[1])).to_dict())
+
+    def test_lazy(self):
+        """ Only the fields accessed are decompressed """
+        data = self.schema.encode(self.RECORDS[1])
+        decoded = self.schema.decode(data)
+        calls = []
+        original = records.decompress
+        records.decompress = lambda *args, **kwargs: calls.append(args) or original(*args, **kwargs)
+        try:
+            self.assertEqual('pending review', decoded['status'])
+            self.assertEqual(1, len(calls))
+            self.assertEqual('http://www.example.com/', decoded['nested']['url'])
+            self.assertEqual(2, len(calls))
+            self.assertEqual('pending review', decoded['status'])  # Cached
+            self.assertEqual(2, len(calls))
+        finally:
+            records.decompress = original
+        self.assertRaises(KeyError, decoded.__getitem__, 'missing')
+
+        empty = self.schema.decode(self.schema.encode({}))
+        indexed = []
+        build_index = records.LazyRecord._build_index
+        records.LazyRecord._build_index = lambda record: indexed.append(record) or build_index(record)
+        try:
+            self.assertEqual(0, len(empty))
+            self.assertEqual([], list(empty))
+            self.assertRaises(KeyError, empty.__getitem__, 'name')
+            self.assertEqual(1, len(indexed))  # An empty index is still an index
+        finally:
+            records.LazyRecord._build_index = build_index
+
+    def test_compact(self):
+        """ Smaller than per record JSON, and per record JSON with zlib """
+        import json
+        lines = MOBYDICK_CHAPTER1.split('\n')
+        sample = [{'id': i, 'status': 'active', 'url': 'http://www.example.com/%d' % i, 'text': x}
+                  for i, x in enumerate(lines)]
+        encoded = sum(len(self.schema.encode(x)) for x in sample)
+        as_json = [json.dumps(x).encode('ascii') for x in sample]
+        self.assertTrue(encoded < sum(len(zlib.compress(x, 9)) for x in as_json) < sum(len(x) for x in as_json))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.schema.encode, {'id': 2 ** 63})
+        self.assertRaises(ValueError, self.schema.encode, {'id': object()})
+        self.assertRaises(ValueError, self.schema.encode, {1: 'x'})
+        data = self.schema.encode(self.RECORDS[0])
+        self.assertRaises(ValueError, self.schema.decode, data + b'\x00')
+        self.assertRaises(ValueError, lambda: self.schema.decode(data[:-1]).to_dict())
+        self.assertRaises(ValueError, records.Schema, ['a', 'a'])
+
+
+class TestInternPool(TestSmazBase):
+    def test_dedup(self):
+        pool = InternPool()
+        lines = MOBYDICK_CHAPTER1.split('\n')
+        handles = [pool.intern(x) for x in lines * 3]
+        self.assertEqual(handles[:len(lines)] * 3, handles)
+        self.assertEqual(len(set(lines)), len(pool))
+        for handle, line in zip(handles, lines * 3):
+            self.assertEqual(line, pool.lookup(handle))
+            self.assertEqual(compress(line) or '', pool.compressed(handle))
+        stats = pool.stats()
+        self.assertEqual(3 * len(lines), stats['references'])
+        self.assertEqual(3 * sum(len(x) for x in lines), stats['plain_bytes'])
+        self.assertEqual(sum(len(compress(x) or '') for x in set(lines)), stats['payload_bytes'])
+
+    def test_release(self):
+        pool = InternPool(cache_size=2)
+        first = pool.intern('the first string')
+        self.assertEqual(first, pool.intern('the first string'))
+        second = pool.intern('the second string')
+        self.assertEqual(2, pool.refcount(first))
+        pool.release(first)
+        self.assertEqual('the first string', pool.lookup(first))
+        pool.release(first)
+        self.assertFalse(first in pool)
+        self.assertRaises(KeyError, pool.lookup, first)
+        self.assertRaises(KeyError, pool.release, first)
+        third = pool.intern('a third')  # Reuses the released handle
+        self.assertEqual(first, third)
+        self.assertEqual('a third', pool.lookup(third))
+        self.assertTrue(pool.stats()['buffer_bytes'] > pool.stats()['payload_bytes'])
+        pool.compact()
+        self.assertEqual(pool.stats()['buffer_bytes'], pool.stats()['payload_bytes'])
+        self.assertEqual('the second string', pool.lookup(second))
+        self.assertEqual('a third', pool.lookup(third))
+
+    def test_hash_collisions(self):
+        """ Payloads with the same hash are still told apart """
+        pool = InternPool()
+        pool._index = CollidingDict()
+        strings = ['alpha', 'beta', 'gamma', 'alpha']
+        handles = [pool.intern(x) for x in strings]
+        self.assertEqual([0, 1, 2, 0], handles)
+        pool.release(1)
+        self.assertEqual(['alpha', 'gamma'], [pool.lookup(x) for x in (0, 2)])
+        self.assertEqual(2, pool.intern('gamma'))
+
+    def test_utf8(self):
+        pool = InternPool(utf8=True)
+        handle = pool.intern(u'caf\u00e9')
+        self.assertEqual(u'caf\u00e9', pool.lookup(handle))
+        self.assertEqual(5, pool.stats()['plain_bytes'])
+
+
+class CollidingDict(dict):
+    """ Every key hashes the same, for TestInternPool """
+    def get(self, key, default=None):
+        return dict.get(self, 0, default)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, 0)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, 0, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, 0)